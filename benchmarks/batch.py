@@ -0,0 +1,35 @@
+"""Throughput of analyse_many() over every module in the standard library,
+in files per second, for several numbers of processes.
+
+    python benchmarks/batch.py [processes ...]
+"""
+
+import glob
+import os
+import sys
+import sysconfig
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from importmagic.batch import analyse_many  # noqa: E402
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or sorted(set([1, 2, os.cpu_count() or 1]))
+    stdlib = sysconfig.get_paths()['stdlib']
+    filenames = sorted(glob.glob(os.path.join(stdlib, '**', '*.py'), recursive=True))
+    print('%d files' % len(filenames))
+    for processes in counts:
+        for ordered in (True, False):
+            start = time.perf_counter()
+            failed = sum(1 for _, unresolved, _ in analyse_many(filenames, processes=processes,
+                                                                ordered=ordered)
+                         if unresolved is None)
+            elapsed = time.perf_counter() - start
+            print('%2d processes, %-9s %8.0f files/s (%d failed)' % (
+                processes, 'ordered' if ordered else 'unordered', len(filenames) / elapsed, failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Throughput of BulkScorer against SymbolIndex.symbol_scores_many(), in
+symbols per second, over every name in the bundled test index and a batch
+of dotted references.
+
+    python benchmarks/bulk_scores.py
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from importmagic import bulk  # noqa: E402
+from importmagic.bulk import BulkScorer  # noqa: E402
+from importmagic.index import SymbolIndex  # noqa: E402
+
+
+def main():
+    filename = os.path.join(os.path.dirname(__file__), '..', 'importmagic', 'test_index.json')
+    with open(filename) as fd:
+        # Repeated queries would otherwise be answered from the query cache.
+        index = SymbolIndex.deserialize(fd, query_cache_size=0)
+    index.symbol_scores('warmup')
+    paths = [entry[3] for entry in index._scope_table() if entry[3]]
+    batches = [
+        ('names', sorted(index.names())),
+        ('dotted', [path + '.' + name for path in paths for name in list(index.find(path)._tree)[:3]]),
+    ]
+
+    engines = [('symbol_scores_many', index)]
+    for use_numpy in (False, True):
+        if use_numpy and bulk.numpy is None:
+            print('NumPy is not installed, skipping the vectorized engine')
+            continue
+        scorer = BulkScorer(index, use_numpy=use_numpy)
+        start = time.perf_counter()
+        scorer._flat()
+        print('flattening (%s) %8.1f ms' % ('numpy' if use_numpy else 'python',
+                                             (time.perf_counter() - start) * 1000))
+        engines.append(('bulk, numpy' if use_numpy else 'bulk, python', scorer))
+
+    for label, batch in batches:
+        for limit in (None, 1):
+            print('%d %s, limit=%s' % (len(batch), label, limit))
+            for engine, scorer in engines:
+                start = time.perf_counter()
+                scorer.symbol_scores_many(batch, limit=limit)
+                first = time.perf_counter() - start
+                elapsed = min(timeit.repeat(lambda: scorer.symbol_scores_many(batch, limit=limit),
+                                            number=1, repeat=3))
+                print('  %-20s %10.0f symbols/s (first batch %10.0f symbols/s)' % (
+                    engine, len(batch) / elapsed, len(batch) / first))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Latency of SymbolIndex.fuzzy() on a synthetic index of 500k names.
+
+    python benchmarks/fuzzy.py [names]
+"""
+
+import os
+import random
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from importmagic.index import SymbolIndex  # noqa: E402
+
+
+SYLLABLES = ['ba', 'co', 'de', 'fi', 'ga', 'he', 'in', 'jo', 'ka', 'lo', 'ma', 'ne', 'or',
+             'pa', 'qu', 're', 'si', 'ta', 'ul', 've', 'wi', 'xe', 'yo', 'za', 'st', 'th', 'er',
+             'an', 'ing', 'ent', 'ion', 'ate', 'ize', 'con', 'pro', 'ter', 'ex', 'um', 'ly']
+
+
+def synthetic_names(count, seed=0):
+    """Identifier-like names, from a vocabulary of a few thousand words."""
+    rng = random.Random(seed)
+    words = sorted(set(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4)))
+                       for _ in range(4000)))
+    names = set()
+    while len(names) < count:
+        parts = [rng.choice(words) for _ in range(rng.randint(1, 3))]
+        if rng.random() < 0.5:
+            name = '_'.join(parts)
+        else:
+            name = ''.join(part.capitalize() for part in parts)
+        names.add(name + (str(rng.randint(0, 9)) if rng.random() < 0.1 else ''))
+    return sorted(names)
+
+
+def typo(name, rng):
+    i = rng.randrange(len(name))
+    kind = rng.choice('dsit')
+    if kind == 'd':
+        return name[:i] + name[i + 1:]
+    if kind == 's':
+        return name[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + name[i + 1:]
+    if kind == 'i':
+        return name[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + name[i:]
+    i = min(i, len(name) - 2)
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    names = synthetic_names(count)
+    index = SymbolIndex(query_cache_size=0)
+    per_module = 100
+    for start in range(0, len(names), per_module):
+        with index.enter('module%d' % (start // per_module), location='3') as module:
+            for name in names[start:start + per_module]:
+                module.add(name, 1.0)
+
+    start = time.time()
+    index._completions()
+    print('%d names, completions built in %.2fs' % (len(names), time.time() - start))
+    start = time.time()
+    index._fuzzy_postings()
+    print('trigram postings built in %.2fs' % (time.time() - start))
+
+    rng = random.Random(1)
+    queries = [typo(rng.choice(names), rng) for _ in range(200)]
+    queries += ['defualtdict', 'OrderDict', 'np', 'xyzzy']
+    number = 3
+    times = []
+    hits = 0
+    for query in queries:
+        times.append(min(timeit.repeat(lambda: index.fuzzy(query), number=number, repeat=3)) / number)
+        hits += bool(index.fuzzy(query))
+    times.sort()
+    print('%d queries, %d with matches' % (len(queries), hits))
+    for label, value in (('median', times[len(times) // 2]), ('p90', times[len(times) * 9 // 10]),
+                         ('max', times[-1]), ('mean', sum(times) / len(times))):
+        print('  %-8s %8.3f ms' % (label, value * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""Size and load time of the bundled test index before and after
+SymbolIndex.prune().
+
+    python benchmarks/prune.py
+"""
+
+import os
+import sys
+import timeit
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from importmagic.index import SymbolIndex  # noqa: E402
+
+
+def load_time(data):
+    return min(timeit.repeat(lambda: SymbolIndex.deserialize(StringIO(data)), number=1, repeat=5))
+
+
+def main():
+    filename = os.path.join(os.path.dirname(__file__), '..', 'importmagic', 'test_index.json')
+    with open(filename) as fd:
+        original = fd.read()
+    index = SymbolIndex.deserialize(StringIO(original))
+    original = index.serialize()
+    stats = index.prune()
+    pruned = index.serialize()
+    print('dropped %(leaves)d leaves and %(subtrees)d subtrees' % stats)
+    print('size       %10d -> %10d bytes' % (len(original), len(pruned)))
+    print('load time  %10.1f -> %10.1f ms' % (load_time(original) * 1000, load_time(pruned) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Microbenchmark of SymbolIndex.symbol_scores() and symbol_scores_many() against
+the bundled test index.
+
+    python benchmarks/symbol_scores.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from importmagic.index import SymbolIndex  # noqa: E402
+
+
+SYMBOLS = ['basename', 'os.path.join', 'path', 'Error', 'defaultdict', 'sys.path',
+           'iso8859_6.Codec', 'doesnotexist']
+
+
+def main():
+    filename = os.path.join(os.path.dirname(__file__), '..', 'importmagic', 'test_index.json')
+    with open(filename) as fd:
+        # Repeated queries would otherwise be answered from the query cache.
+        index = SymbolIndex.deserialize(fd, query_cache_size=0)
+    index.symbol_scores('warmup')
+    number = 20
+    for limit in (None, 1):
+        print('limit=%s' % limit)
+        total = 0.0
+        for symbol in SYMBOLS:
+            elapsed = min(timeit.repeat(lambda: index.symbol_scores(symbol, limit=limit),
+                                        number=number, repeat=3))
+            total += elapsed
+            print('  %-20s %8.3f ms/query' % (symbol, elapsed / number * 1000))
+        print('  %-20s %8.3f ms/query' % ('mean', total / number / len(SYMBOLS) * 1000))
+
+    # A file with many missing names, resolved as _process_imports() does.
+    batch = sorted(index._tree)[::max(1, len(index._tree) // 60)] + SYMBOLS
+    number = 5
+    for label, run in (
+            ('one at a time', lambda: [index.symbol_scores(s, limit=1) for s in batch]),
+            ('symbol_scores_many', lambda: index.symbol_scores_many(batch, limit=1))):
+        elapsed = min(timeit.repeat(run, number=number, repeat=3))
+        print('%d symbols, %-20s %8.3f ms' % (len(batch), label, elapsed / number * 1000))
+
+    with open(filename) as fd:
+        cached = SymbolIndex.deserialize(fd)
+    cached.symbol_scores_many(batch, limit=1)
+    elapsed = min(timeit.repeat(lambda: cached.symbol_scores_many(batch, limit=1),
+                                number=number, repeat=3))
+    print('%d symbols, %-20s %8.3f ms' % (len(batch), 'cached', elapsed / number * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Benchmark of Scope.from_source() and find_unresolved_and_unreferenced_symbols()
+on a generated 50k line module with many top level names and nested scopes,
+of Scope.from_source() on an expression nested deeper than the recursion
+limit, and of IncrementalScope.update() after a one line edit.
+
+    python benchmarks/symbols.py [lines]
+"""
+
+import ast
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from importmagic.symbols import IncrementalScope, Scope  # noqa: E402
+
+
+FUNCTION = '''\
+def func_{i}(arg, *args, **kwargs):
+    local_{i} = func_{prev}(arg) + helper_{i}.value
+    for item in args:
+        if item is not None:
+            local_{i} += os.path.join(item, str(local_{i}))
+
+    def inner(x):
+        def innermost(y):
+            return x + y + local_{i} + undefined_{i}
+        return [innermost(z) for z in range(x)]
+
+    try:
+        return inner(local_{i})
+    except (ValueError, errors.Error):
+        return None
+
+
+class Class_{i}(Base_{prev}, object):
+    attr = func_{i}
+
+    def method(self, value):
+        with open(value) as fd:
+            data = fd.read()
+        return self.attr(data, Class_{prev})
+
+'''
+
+
+def generate(lines):
+    chunks = []
+    i = 0
+    while len(chunks) * FUNCTION.count('\n') < lines:
+        chunks.append(FUNCTION.format(i=i, prev=max(0, i - 1)))
+        i += 1
+    return 'import os\n\n\n' + ''.join(chunks)
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    source = generate(lines)
+    print('%d lines' % source.count('\n'))
+    start = time.perf_counter()
+    tree = ast.parse(source)
+    print('ast.parse()                %8.1f ms' % ((time.perf_counter() - start) * 1000))
+    start = time.perf_counter()
+    scope = Scope.from_source(tree)
+    print('Scope.from_source()        %8.1f ms' % ((time.perf_counter() - start) * 1000))
+    start = time.perf_counter()
+    unresolved, unreferenced = scope.find_unresolved_and_unreferenced_symbols()
+    print('find_unresolved_and_...()  %8.1f ms' % ((time.perf_counter() - start) * 1000))
+    print('%d unresolved, %d unreferenced' % (len(unresolved), len(unreferenced)))
+
+    tree = ast.parse('x = ' + ' + '.join('a%d' % i for i in range(2000)))
+    start = time.perf_counter()
+    Scope.from_source(tree)
+    print('2000 nested operands       %8.1f ms' % ((time.perf_counter() - start) * 1000))
+
+    incremental = IncrementalScope(source)
+    lines = source.splitlines(True)
+    middle = len(lines) // 2
+    lines[middle] = '#' + lines[middle]
+    start = time.perf_counter()
+    incremental.update(''.join(lines))
+    incremental.find_unresolved_and_unreferenced_symbols()
+    print('one line edit, incremental %8.1f ms' % ((time.perf_counter() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main()
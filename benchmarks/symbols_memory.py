@@ -0,0 +1,51 @@
+"""Peak memory and allocations of Scope.from_source() on a generated module
+(see benchmarks/symbols.py), excluding the parsed AST.
+
+    python benchmarks/symbols_memory.py [lines]
+"""
+
+import ast
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from importmagic.symbols import Scope  # noqa: E402
+from symbols import generate  # noqa: E402
+
+
+def count_scopes(scope):
+    count = 0
+    scopes = [scope]
+    while scopes:
+        count += 1
+        scopes.extend(scopes.pop()._children)
+    return count
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    tree = ast.parse(generate(lines))
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    scope = Scope.from_source(tree)
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    gc.collect()
+    retained = sys.getallocatedblocks() - blocks
+    print('%d lines, %d scopes' % (lines, count_scopes(scope)))
+    print('peak while analysing   %8.1f MiB' % (peak / 2.0 ** 20))
+    print('retained by the Scope  %8.1f MiB' % (current / 2.0 ** 20))
+    print('retained allocations   %8d' % retained)
+    print('largest allocation sites:')
+    for stat in snapshot.statistics('lineno')[:5]:
+        print('  %s' % stat)
+
+
+if __name__ == '__main__':
+    main()
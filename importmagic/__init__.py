@@ -7,5 +7,5 @@ __author__ = 'Alec Thomas <alec@swapoff.org>'
 __version__ = '0.2.0'
 
 from importmagic.importer import Import, Imports, get_update, update_imports
-from importmagic.index import SymbolIndex
-from importmagic.symbols import Scope
+from importmagic.index import BackgroundIndex, LayeredSymbolIndex, SymbolIndex
+from importmagic.symbols import IncrementalScope, Scope
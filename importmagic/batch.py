@@ -0,0 +1,93 @@
+"""Find unresolved and unreferenced symbols in many sources, in parallel.
+
+analyse_many() parses and analyses sources in a pool of worker processes,
+sending them in chunks, and streams the results back as they complete. Only
+a bounded number of chunks is in flight at once, so arbitrarily long inputs
+(eg. every file in a large repository) are consumed lazily.
+"""
+
+import collections
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+from importmagic.symbols import Scope
+from importmagic.util import parse_ast
+
+
+logger = logging.getLogger(__name__)
+
+
+# Chunks queued per worker process, beyond the one it is working on.
+PREFETCH = 2
+
+
+def analyse_many(items, processes=None, chunksize=16, ordered=True, define_builtins=True):
+    """Analyse many sources, yielding (path, unresolved, unreferenced) for each.
+
+    unresolved and unreferenced are as returned by
+    Scope.find_unresolved_and_unreferenced_symbols(), or None if the source
+    could not be read or parsed.
+
+    :param items: Iterable of file names to read, or (path, source) pairs
+        where path is only used to label the result.
+    :param processes: Number of worker processes, defaulting to the number
+        of CPUs. With 1, sources are analysed in this process.
+    :param chunksize: Number of items sent to a worker at once.
+    :param ordered: Whether to yield results in the order of items, rather
+        than as they complete.
+    :param define_builtins: As for Scope.from_source().
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1:
+        for item in items:
+            yield _analyse(item, define_builtins)
+        return
+    items = iter(items)
+    limit = processes * (1 + PREFETCH)
+    executor = ProcessPoolExecutor(max_workers=processes)
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < limit:
+                chunk = list(islice(items, chunksize))
+                if not chunk:
+                    break
+                pending.append(executor.submit(_analyse_chunk, chunk, define_builtins))
+            if not pending:
+                break
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+            for future in done:
+                for result in future.result():
+                    yield result
+    finally:
+        # Also reached if the caller stops iterating early.
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _analyse_chunk(items, define_builtins):
+    return [_analyse(item, define_builtins) for item in items]
+
+
+def _analyse(item, define_builtins):
+    if isinstance(item, tuple):
+        path, source = item
+    else:
+        path, source = item, None
+    try:
+        if source is None:
+            with open(path, 'rb') as fd:
+                source = fd.read()
+        scope = Scope.from_source(parse_ast(source, path), define_builtins=define_builtins)
+    except (IOError, OSError, SyntaxError, ValueError, RecursionError) as e:
+        logger.debug('failed to analyse %s: %s', path, e)
+        return path, None, None
+    unresolved, unreferenced = scope.find_unresolved_and_unreferenced_symbols()
+    return path, unresolved, unreferenced
@@ -0,0 +1,47 @@
+import itertools
+
+import pytest
+
+from importmagic.batch import analyse_many
+from importmagic.symbols import Scope
+
+
+SOURCES = [('mod%d' % i, 'import os\n\ndef f%d():\n    return os.path.join(x%d)\n' % (i, i))
+           for i in range(40)]
+
+
+def expected(source):
+    return Scope.from_source(source).find_unresolved_and_unreferenced_symbols()
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_analyse_many_ordered(processes):
+    results = list(analyse_many(SOURCES, processes=processes, chunksize=3))
+    assert [path for path, _, _ in results] == [path for path, _ in SOURCES]
+    for (path, source), (_, unresolved, unreferenced) in zip(SOURCES, results):
+        assert (unresolved, unreferenced) == expected(source)
+
+
+def test_analyse_many_unordered(tmpdir):
+    filename = tmpdir.join('module.py')
+    filename.write('print(undefined)\n')
+    items = SOURCES + [str(filename), ('broken', 'def (:'), str(tmpdir.join('missing.py'))]
+    results = dict((path, (unresolved, unreferenced)) for path, unresolved, unreferenced
+                   in analyse_many(items, processes=2, chunksize=5, ordered=False))
+    assert len(results) == len(items)
+    assert results[str(filename)] == (set(['undefined']), set())
+    assert results['broken'] == results[str(tmpdir.join('missing.py'))] == (None, None)
+    assert results['mod7'] == expected(SOURCES[7][1])
+
+
+def test_analyse_many_consumes_items_lazily():
+    consumed = []
+
+    def items():
+        for i in itertools.count():
+            consumed.append(i)
+            yield ('mod%d' % i, 'x = y%d\n' % i)
+
+    results = list(itertools.islice(analyse_many(items(), processes=2, chunksize=4), 10))
+    assert [unresolved for _, unresolved, _ in results] == [set(['y%d' % i]) for i in range(10)]
+    assert len(consumed) < 100
@@ -0,0 +1,303 @@
+"""Score many symbols at once against a flattened copy of a SymbolIndex.
+
+SymbolIndex.symbol_scores_many() walks the tree one scope and one symbol at
+a time. For bulk work, eg. rescoring every reference in a project, BulkScorer
+instead flattens the index into parallel arrays, one entry per name in each
+scope, and matches a whole batch of symbols against them. With NumPy
+installed the matching and scoring is vectorized, otherwise the same arrays
+are walked in pure Python.
+"""
+
+import array
+import heapq
+import logging
+
+from importmagic.index import LOCATION_BOOSTS, describe_match
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class _FlatIndex(object):
+    """The entries of every scope in a SymbolIndex, as parallel arrays.
+
+    Scopes are numbered by their position in SymbolIndex._scope_table(), so
+    aliased scopes appear once per path, as they do in symbol_scores().
+
+    Per scope: scale, location code (an index into locations) and boost.
+    Per entry: name id, parent scope, value (a name's score, or a package's
+    own score), kind (the ord() of its SymbolIndex.KINDS code, 'm' for
+    packages, 0 if unknown) and, for packages, the scope it leads to (or -1
+    for names).
+    """
+
+    def __init__(self, index):
+        table = index._scope_table()
+        scopes = dict((entry[3], i) for i, entry in enumerate(table))
+        self.names = {}
+        self.locations = []
+        self.paths = []
+        self.parts = []
+        self.scope_scale = array.array('d')
+        self.scope_location = array.array('B')
+        self.scope_boost = array.array('d')
+        self.entry_name = array.array('q')
+        self.entry_parent = array.array('q')
+        self.entry_value = array.array('d')
+        self.entry_kind = bytearray()
+        self.entry_child = array.array('q')
+        # The entry leading to each scope, -1 for the root.
+        self.scope_entry = array.array('q', [-1]) * len(table)
+        for i, (scope, scale, boost, path, parts, _) in enumerate(table):
+            if scope.location not in self.locations:
+                self.locations.append(scope.location)
+            self.paths.append(path)
+            self.parts.append(parts)
+            self.scope_scale.append(scale)
+            self.scope_location.append(self.locations.index(scope.location))
+            for key, value in scope._tree.items():
+                self.entry_name.append(self.names.setdefault(key, len(self.names)))
+                self.entry_parent.append(i)
+                if type(value) is float:
+                    self.entry_value.append(value)
+                    self.entry_kind.append(ord(scope._kinds.get(key, '\0')))
+                    self.entry_child.append(-1)
+                else:
+                    child = scopes[path + '.' + key if path else key]
+                    self.entry_value.append(value.score)
+                    self.entry_kind.append(ord('m'))
+                    self.entry_child.append(child)
+                    self.scope_entry[child] = len(self.entry_child) - 1
+        self.names_by_id = list(self.names)
+        boosts = [LOCATION_BOOSTS.get(location, 1.0) for location in self.locations]
+        self.scope_boost.extend(boosts[code] for code in self.scope_location)
+
+        # Entries grouped by name: those named n are
+        # by_name[starts[n]:starts[n + 1]].
+        counts = [0] * (len(self.names) + 1)
+        for name in self.entry_name:
+            counts[name + 1] += 1
+        for n in range(len(self.names)):
+            counts[n + 1] += counts[n]
+        self.starts = array.array('q', counts)
+        self.by_name = array.array('q', bytes(8 * len(self.entry_name)))
+        filled = list(counts)
+        for entry, name in enumerate(self.entry_name):
+            self.by_name[filled[name]] = entry
+            filled[name] += 1
+
+        # The entry with a given name in a given scope.
+        self.children = dict(((self.entry_parent[entry], name), entry)
+                             for entry, name in enumerate(self.entry_name))
+
+        # (last entry, number of entries) of a match -> (package, reference|None)
+        self.described = {}
+
+    def describe(self, last, matched):
+        """Return the (package, reference|None) of a match of matched entries ending in last."""
+        key = (last, matched)
+        if key not in self.described:
+            entries = [last]
+            while len(entries) < matched:
+                entries.insert(0, self.scope_entry[self.entry_parent[entries[0]]])
+            sub_path = [self.names_by_id[self.entry_name[entry]] for entry in entries]
+            first = sub_path[0]
+            if self.entry_child[last] < 0:
+                sub_path.insert(len(sub_path) - 1, None)
+            scope = self.entry_parent[entries[0]]
+            self.described[key] = describe_match(first, sub_path, self.paths[scope],
+                                                 self.parts[scope])
+        return self.described[key]
+
+
+class _NumpyArrays(object):
+    """_FlatIndex arrays as NumPy arrays, with a sorted key for child lookups."""
+
+    def __init__(self, flat):
+        self.scope_scale = numpy.frombuffer(flat.scope_scale, dtype=numpy.float64)
+        self.scope_boost = numpy.frombuffer(flat.scope_boost, dtype=numpy.float64)
+        self.entry_parent = numpy.frombuffer(flat.entry_parent, dtype=numpy.int64)
+        self.entry_value = numpy.frombuffer(flat.entry_value, dtype=numpy.float64)
+        self.entry_kind = numpy.frombuffer(bytes(flat.entry_kind), dtype=numpy.uint8)
+        self.entry_child = numpy.frombuffer(flat.entry_child, dtype=numpy.int64)
+        self.starts = numpy.frombuffer(flat.starts, dtype=numpy.int64)
+        self.by_name = numpy.frombuffer(flat.by_name, dtype=numpy.int64)
+        # parent * len(names) + name, sorted, to look up entries by scope and name.
+        self.stride = max(1, len(flat.names))
+        keys = self.entry_parent * self.stride + numpy.frombuffer(flat.entry_name,
+                                                                  dtype=numpy.int64)
+        self.key_order = numpy.argsort(keys, kind='stable')
+        self.keys = keys[self.key_order]
+
+
+class BulkScorer(object):
+    """Score batches of symbols exactly as SymbolIndex.symbol_scores() does.
+
+    The index is flattened on first use, and again whenever it changes.
+
+    :param index: The SymbolIndex to score against.
+    :param use_numpy: Whether to vectorize with NumPy. Defaults to doing so
+        if it is installed.
+    """
+
+    def __init__(self, index, use_numpy=None):
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise ImportError('use_numpy requires NumPy, which is not installed')
+        self.index = index
+        self.use_numpy = use_numpy
+        self._flat_at = None
+
+    def symbol_scores(self, symbol, limit=None, kinds=None):
+        """See SymbolIndex.symbol_scores()."""
+        return self.symbol_scores_many([symbol], limit=limit, kinds=kinds)[symbol]
+
+    def symbol_scores_many(self, symbols, limit=None, kinds=None):
+        """See SymbolIndex.symbol_scores_many()."""
+        results = dict((symbol, []) for symbol in symbols)
+        if not results or limit is not None and limit <= 0:
+            return results
+        flat, arrays = self._flat()
+        described = flat.described
+        # Names of unknown kind match any kinds.
+        allowed = None if kinds is None else set([0] + [ord(kind) for kind in kinds])
+        if arrays is None:
+            candidates = self._candidates(flat, list(results), allowed)
+        else:
+            candidates = self._numpy_candidates(flat, arrays, list(results), limit, allowed)
+        for symbol, found in candidates:
+            if limit is not None and len(found) > limit:
+                # Ties with the last score may sort either way, so keep them all.
+                least = heapq.nlargest(limit, [score for score, _, _ in found])[-1]
+                found = [candidate for candidate in found if candidate[0] >= least]
+            scores = results[symbol]
+            for score, last, matched in found:
+                match = described.get((last, matched))
+                if match is None:
+                    match = flat.describe(last, matched)
+                scores.append((score,) + match)
+            scores.sort(reverse=True)
+            if limit is not None:
+                del scores[limit:]
+        return results
+
+    def _flat(self):
+        state = self.index._root._state
+        generation = state.generation
+        if self._flat_at is None or self._flat_at[0] != generation:
+            with state.lock:
+                flat = _FlatIndex(self.index)
+            arrays = _NumpyArrays(flat) if self.use_numpy else None
+            logger.debug('flattened index into %d scopes and %d entries',
+                         len(flat.paths), len(flat.entry_name))
+            self._flat_at = (generation, (flat, arrays))
+        return self._flat_at[1]
+
+    def _candidates(self, flat, symbols, allowed):
+        # Yield (symbol, [(score, last entry matched, number of entries matched)])
+        # for each symbol, keeping matches whose last entry has an allowed kind.
+        entry_child = flat.entry_child
+        entry_kind = flat.entry_kind
+        entry_value = flat.entry_value
+        entry_parent = flat.entry_parent
+        scope_boost = flat.scope_boost
+        children = flat.children
+        for symbol in symbols:
+            ids = [flat.names.get(segment, -1) for segment in symbol.split('.')]
+            if ids[0] < 0:
+                continue
+            found = []
+            for i in range(flat.starts[ids[0]], flat.starts[ids[0] + 1]):
+                entry = flat.by_name[i]
+                matched = [entry]
+                while entry_child[entry] >= 0 and len(matched) < len(ids):
+                    entry = children.get((entry_child[entry], ids[len(matched)]))
+                    if entry is None:
+                        break
+                    matched.append(entry)
+                if allowed is not None and entry_kind[matched[-1]] not in allowed:
+                    continue
+                score = 0.0
+                for entry in reversed(matched):
+                    score = (score + entry_value[entry]) * scope_boost[entry_parent[entry]]
+                if score > 0.1:
+                    found.append((score * flat.scope_scale[entry_parent[matched[0]]],
+                                  matched[-1], len(matched)))
+            yield symbol, found
+
+    def _numpy_candidates(self, flat, arrays, symbols, limit, allowed):
+        # As _candidates(), matching every symbol's candidates at once.
+        split = [symbol.split('.') for symbol in symbols]
+        lengths = numpy.fromiter(map(len, split), dtype=numpy.int64, count=len(split))
+        get = flat.names.get
+        ids = numpy.full((len(symbols), lengths.max()), -1, dtype=numpy.int64)
+        ids[numpy.repeat(numpy.arange(len(symbols)), lengths),
+            numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)] = \
+            numpy.fromiter((get(segment, -1) for segments in split for segment in segments),
+                           dtype=numpy.int64, count=lengths.sum())
+        depth = ids.shape[1]
+
+        # One candidate per entry named after a symbol's first segment.
+        first = ids[:, 0]
+        known = first >= 0
+        lo = numpy.where(known, arrays.starts[numpy.maximum(first, 0)], 0)
+        counts = numpy.where(known, arrays.starts[first + 1] - lo, 0)
+        owner = numpy.repeat(numpy.arange(len(symbols)), counts)
+        offsets = numpy.arange(len(owner)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        entry = arrays.by_name[lo[owner] + offsets]
+
+        # Follow the remaining segments down through packages.
+        levels = [entry]
+        matched = numpy.ones(len(owner), dtype=numpy.int64)
+        alive = numpy.ones(len(owner), dtype=bool)
+        for level in range(1, depth):
+            child = arrays.entry_child[entry]
+            names = ids[owner, level]
+            alive &= (child >= 0) & (names >= 0)
+            keys = child[alive] * arrays.stride + names[alive]
+            found = numpy.minimum(numpy.searchsorted(arrays.keys, keys), len(arrays.keys) - 1)
+            hit = arrays.keys[found] == keys
+            alive[alive] = hit
+            entry = entry.copy()
+            entry[alive] = arrays.key_order[found[hit]]
+            matched += alive
+            levels.append(entry)
+            if not alive.any():
+                break
+
+        # Score from the deepest match outwards, as SymbolIndex._score_key() does.
+        score = numpy.zeros(len(owner))
+        for level in range(len(levels) - 1, -1, -1):
+            entry = levels[level]
+            scored = (score + arrays.entry_value[entry]) * \
+                arrays.scope_boost[arrays.entry_parent[entry]]
+            score = numpy.where(matched > level, scored, score)
+        keep = score > 0.1
+        if allowed is not None:
+            keep &= numpy.isin(arrays.entry_kind[levels[-1]], list(allowed))
+        keep = numpy.nonzero(keep)[0]
+        score = score[keep] * arrays.scope_scale[arrays.entry_parent[levels[0][keep]]]
+        owner = owner[keep]
+        matched = matched[keep]
+        last = levels[-1][keep]
+
+        starts = numpy.searchsorted(owner, numpy.arange(len(symbols) + 1))
+        if limit is not None:
+            # Keep the best limit of each symbol, and any ties with the last.
+            order = numpy.lexsort((-score, owner))
+            owner, score, matched, last = owner[order], score[order], matched[order], last[order]
+            rank = numpy.arange(len(owner)) - starts[owner]
+            least = score[numpy.minimum(starts[owner] + limit, starts[owner + 1]) - 1]
+            keep = (rank < limit) | (score >= least)
+            owner, score, matched, last = owner[keep], score[keep], matched[keep], last[keep]
+            starts = numpy.searchsorted(owner, numpy.arange(len(symbols) + 1))
+
+        found = list(zip(score.tolist(), last.tolist(), matched.tolist()))
+        starts = starts.tolist()
+        return [(symbol, found[starts[row]:starts[row + 1]]) for row, symbol in enumerate(symbols)]
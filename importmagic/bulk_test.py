@@ -0,0 +1,65 @@
+import pytest
+
+from importmagic import bulk
+from importmagic.bulk import BulkScorer
+from importmagic.index import SymbolIndex
+
+
+ENGINES = [False, pytest.param(True, marks=pytest.mark.skipif(
+    bulk.numpy is None, reason='NumPy is not installed'))]
+
+
+@pytest.mark.parametrize('use_numpy', ENGINES)
+def test_bulk_scores_match_symbol_scores(index, use_numpy):
+    scorer = BulkScorer(index, use_numpy=use_numpy)
+    names = sorted(index.names())[::40]
+    paths = [entry[3] for entry in index._scope_table() if entry[3]][::20]
+    symbols = names + paths + [path + '.' + name for path in paths[::5] for name in names[::25]]
+    symbols += ['os.path.join', 'path.join', 'os.path.join.attr', 'os.unknown', 'unknown',
+                'unknown.attr', 'basename']
+    for limit in (None, 1, 3):
+        expected = index.symbol_scores_many(symbols, limit=limit)
+        assert scorer.symbol_scores_many(symbols, limit=limit) == expected
+    assert scorer.symbol_scores('os.path.join') == index.symbol_scores('os.path.join')
+    assert scorer.symbol_scores_many([]) == {}
+    assert scorer.symbol_scores_many(['os'], limit=0) == {'os': []}
+
+
+@pytest.mark.parametrize('use_numpy', ENGINES)
+def test_bulk_scores_filter_kinds(index, use_numpy):
+    scorer = BulkScorer(index, use_numpy=use_numpy)
+    symbols = sorted(index.names())[::40] + ['os.path', 'os.path.join', 'path.join',
+                                             'os.path.join.attr', 'unknown']
+    for kinds in ('c', 'f', 'm', 'cf', 'vib', ''):
+        for limit in (None, 2):
+            expected = index.symbol_scores_many(symbols, limit=limit, kinds=kinds)
+            assert scorer.symbol_scores_many(symbols, limit=limit, kinds=kinds) == expected
+    assert scorer.symbol_scores('os.path', kinds='m') == index.symbol_scores('os.path', kinds='m')
+
+    tree = SymbolIndex()
+    with tree.enter('mod') as mod:
+        mod.add('Thing', 1.0, 'c')
+        mod.add('thing', 1.0, 'f')
+        mod.add('other', 1.0)
+        with mod.enter('Thing') as sub:
+            sub.add('attr', 1.0, 'v')
+    scorer = BulkScorer(tree, use_numpy=use_numpy)
+    symbols = ['Thing', 'thing', 'other', 'mod', 'mod.Thing', 'mod.thing.attr', 'Thing.attr']
+    for kinds in ('c', 'f', 'v', 'm', 'cv'):
+        expected = tree.symbol_scores_many(symbols, kinds=kinds)
+        assert scorer.symbol_scores_many(symbols, kinds=kinds) == expected
+    assert scorer.symbol_scores('thing', kinds='c') == []
+    assert scorer.symbol_scores('other', kinds='c')[0][1:] == ('mod', 'other')
+
+
+@pytest.mark.parametrize('use_numpy', ENGINES)
+def test_bulk_scores_follow_changes(use_numpy):
+    tree = SymbolIndex()
+    with tree.enter('mod') as mod:
+        mod.add('func', 1.1)
+    scorer = BulkScorer(tree, use_numpy=use_numpy)
+    assert scorer.symbol_scores('func') == tree.symbol_scores('func')
+    with tree.enter('mod2') as mod2:
+        mod2.add('func', 2.0)
+    assert scorer.symbol_scores('func') == tree.symbol_scores('func')
+    assert scorer.symbol_scores('func')[0][1:] == ('mod2', 'func')
@@ -0,0 +1,338 @@
+"""Persistent caches of query results and source analyses, so short-lived
+processes can skip loading the index and parsing unchanged sources."""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+from importmagic import __version__
+from importmagic.importer import Imports, apply_update, get_update
+from importmagic.symbols import Scope
+from importmagic.util import BloomFilter, get_cache_dir
+
+
+logger = logging.getLogger(__name__)
+
+
+# Name of the store in get_cache_dir().
+STORE_FILE = 'cache.sqlite'
+
+# Keys per query, below SQLite's default limit on host parameters.
+_BATCH_SIZE = 500
+
+# What a cached analysis depends on besides the source: the analyser, and the
+# grammar it was parsed with.
+ANALYSIS_VERSION = '%s:%d.%d' % (__version__, sys.version_info[0], sys.version_info[1])
+
+
+def file_hash(filename, extra=''):
+    """Return the sha1 hex digest of a file's contents and extra, or None if it doesn't exist."""
+    digest = hashlib.sha1()
+    try:
+        with open(filename, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1 << 16), b''):
+                digest.update(chunk)
+    except (IOError, OSError):
+        return None
+    digest.update(extra.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def file_stamp(filename):
+    """Return a string that changes whenever filename is rewritten, or None if it doesn't exist.
+
+    It is made of the file's inode, size and modification time, so it is
+    much cheaper than file_hash() but may change without the contents doing
+    so.
+    """
+    try:
+        st = os.stat(filename)
+    except (IOError, OSError):
+        return None
+    return '%d:%d:%d' % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def source_hash(source):
+    """Return the sha1 hex digest of source."""
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8', 'surrogatepass')
+    return hashlib.sha1(source).hexdigest()
+
+
+class CacheStore(object):
+    """A key/value store of JSON values in SQLite.
+
+    Values live in namespaces, and are tagged with the version of whatever
+    they were computed from (eg. the hash of an index). Only values of the
+    requested version are returned; purge() drops the others.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename or os.path.join(get_cache_dir(), STORE_FILE)
+        self._db = sqlite3.connect(self.filename, timeout=5.0)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                             ' namespace TEXT NOT NULL, key TEXT NOT NULL,'
+                             ' version TEXT NOT NULL, value TEXT NOT NULL,'
+                             ' PRIMARY KEY (namespace, key))')
+
+    def get_many(self, namespace, version, keys):
+        """Return a dict of the keys that have a value of this version."""
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), _BATCH_SIZE):
+            batch = keys[i:i + _BATCH_SIZE]
+            rows = self._db.execute(
+                'SELECT key, value FROM entries WHERE namespace = ? AND version = ?'
+                ' AND key IN (%s)' % ', '.join('?' * len(batch)),
+                [namespace, version] + batch)
+            for key, value in rows:
+                found[key] = json.loads(value)
+        return found
+
+    def get(self, namespace, version, key, default=None):
+        return self.get_many(namespace, version, [key]).get(key, default)
+
+    def put_many(self, namespace, version, items):
+        """Store (key, value) pairs, replacing any older versions."""
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO entries (namespace, key, version, value)'
+                ' VALUES (?, ?, ?, ?)',
+                [(namespace, key, version, json.dumps(value)) for key, value in items])
+
+    def put(self, namespace, version, key, value):
+        self.put_many(namespace, version, [(key, value)])
+
+    def purge(self, namespace, version):
+        """Delete values in namespace that are not of this version."""
+        with self._db:
+            self._db.execute('DELETE FROM entries WHERE namespace = ? AND version != ?',
+                             (namespace, version))
+
+    def close(self):
+        self._db.close()
+
+
+class CachedIndex(object):
+    """Answer queries for a cached index file from a CacheStore.
+
+    symbol_scores(), symbol_scores_many() and location_for() answers,
+    including empty ones, are stored under the hash of the index file. The
+    index itself is only loaded, by load(), the first time a query isn't in
+    the store. When the index file is rebuilt or refreshed its hash
+    changes, and the answers for older versions are dropped. The hash is
+    itself stored, under the file's file_stamp(), so the file is only read
+    when it has been rewritten.
+
+    A Bloom filter of every name in the index (see SymbolIndex.names()) is
+    stored with the answers. Symbols whose first segment isn't in it can't
+    match anything, and are answered without loading the index; these are
+    counted in prefilter_rejects.
+
+    Answers are only stored for complete indexes (see
+    SymbolIndex.build_index()), as building resumes when a partial index is
+    loaded.
+
+    :param filename: The index file, eg. get_index_file().
+    :param load: Called with no arguments to get the SymbolIndex stored in
+        filename. It may rebuild or update the file.
+    :param store: A CacheStore. Defaults to one in get_cache_dir().
+    :param key: Anything else the answers depend on, eg. index rules.
+    """
+
+    def __init__(self, filename, load, store=None, key=''):
+        self._filename = filename
+        self._load = load
+        self._store = store or CacheStore()
+        self._key = key
+        self._namespace = os.path.abspath(filename)
+        self._version = self._file_version()
+        self._index = None
+        self._names = None
+        if self._version is not None:
+            names = self._store.get('names:' + self._namespace, self._version, '')
+            if names is not None:
+                self._names = BloomFilter.loads(names)
+        self.prefilter_rejects = 0
+
+    @property
+    def index(self):
+        """The SymbolIndex, loaded on first use."""
+        return self.load()
+
+    def load(self):
+        """Load the index now, if it isn't already, and return it."""
+        if self._index is None:
+            self._index = self._load()
+            version = self._file_version()
+            if version != self._version:
+                logger.debug('index %s changed, dropping cached queries', self._filename)
+                self._version = version
+                self._names = None
+            if version is not None:
+                for kind in ('scores', 'location', 'names'):
+                    self._store.purge('%s:%s' % (kind, self._namespace), version)
+            if self._names is None and self._cacheable():
+                self._names = BloomFilter.from_strings(self._index.names())
+                self._store.put('names:' + self._namespace, version, '', self._names.dumps())
+        return self._index
+
+    def symbol_scores(self, symbol, limit=None, kinds=None):
+        return self.symbol_scores_many([symbol], limit=limit, kinds=kinds)[symbol]
+
+    def symbol_scores_many(self, symbols, limit=None, kinds=None):
+        """See SymbolIndex.symbol_scores_many()."""
+        query = [limit] if kinds is None else [limit, ''.join(sorted(set(kinds)))]
+        keys = dict((json.dumps([symbol] + query), symbol) for symbol in symbols)
+        namespace = 'scores:' + self._namespace
+        found = {}
+        if self._version is not None:
+            found = self._store.get_many(namespace, self._version, keys)
+        results = dict((keys[key], [tuple(match) for match in scores])
+                       for key, scores in found.items())
+        missing = []
+        for key, symbol in keys.items():
+            if key in found:
+                continue
+            if self._names is not None and symbol.split('.', 1)[0] not in self._names:
+                results[symbol] = []
+                self.prefilter_rejects += 1
+            else:
+                missing.append(symbol)
+        if missing:
+            computed = self.index.symbol_scores_many(missing, limit=limit, kinds=kinds)
+            results.update(computed)
+            if self._cacheable():
+                self._store.put_many(namespace, self._version,
+                                     [(json.dumps([symbol] + query), scores)
+                                      for symbol, scores in computed.items()])
+        return results
+
+    @property
+    def version(self):
+        """The hash of the index file (and key).
+
+        None if it doesn't exist, or if the index was loaded and is
+        incomplete, as answers aren't cached then.
+        """
+        if self._index is not None and not self._cacheable():
+            return None
+        return self._version
+
+    def location_for(self, path):
+        """See SymbolIndex.location_for()."""
+        namespace = 'location:' + self._namespace
+        if self._version is not None:
+            location = self._store.get(namespace, self._version, path)
+            if location is not None:
+                return location
+        location = self.index.location_for(path)
+        if self._cacheable():
+            self._store.put(namespace, self._version, path, location)
+        return location
+
+    def _file_version(self):
+        # file_hash() of the index file, computed only if its stamp changed.
+        stamp = file_stamp(self._filename)
+        if stamp is None:
+            return None
+        namespace = 'stamp:' + self._namespace
+        version = self._store.get(namespace, stamp, self._key)
+        if version is None:
+            version = file_hash(self._filename, self._key)
+            if version is not None:
+                self._store.put(namespace, stamp, self._key, version)
+        return version
+
+    def _cacheable(self):
+        return self._version is not None and self._index.is_complete()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.index, name)
+
+
+class CachedAnalysis(object):
+    """Answer analyses and import updates of unchanged sources from a CacheStore.
+
+    analyse() results are stored under the hash of the source, tagged with
+    ANALYSIS_VERSION. get_update() results are stored under the hash of the
+    source, tagged with the version of the index (and the import style), so
+    an unchanged source is answered with one hash and one lookup, without
+    parsing it or querying the index. The version of a CachedIndex costs a
+    stat of the index file and a lookup, see file_stamp().
+
+    :param store: A CacheStore. Defaults to one in get_cache_dir().
+    :param define_builtins: As for Scope.from_source().
+    """
+
+    def __init__(self, store=None, define_builtins=True):
+        self._store = store or CacheStore()
+        self._define_builtins = define_builtins
+        self._version = '%s:%d' % (ANALYSIS_VERSION, define_builtins)
+
+    def analyse(self, source):
+        """Return (unresolved, unreferenced, reference contexts) for source.
+
+        See Scope.find_unresolved_and_unreferenced_symbols() and
+        Scope.reference_contexts().
+        """
+        return self._analyse(source, source_hash(source))
+
+    def _analyse(self, source, digest):
+        found = self._store.get('analysis', self._version, digest)
+        if found is not None:
+            unresolved, unreferenced, contexts = found
+            return (set(unresolved), set(unreferenced),
+                    dict((name, set(found)) for name, found in contexts.items()))
+        scope = Scope.from_source(source, define_builtins=self._define_builtins)
+        unresolved, unreferenced = scope.find_unresolved_and_unreferenced_symbols()
+        contexts = scope.reference_contexts()
+        self._store.put('analysis', self._version, digest,
+                        [sorted(unresolved), sorted(unreferenced),
+                         dict((name, list(found)) for name, found in contexts.items())])
+        return unresolved, unreferenced, contexts
+
+    def get_update(self, source, index, index_version=None):
+        """Return (start line, end line, new import block) for source.
+
+        See importer.get_update().
+
+        :param index_version: Identifies the contents of index. Defaults to
+            index.version, eg. for a CachedIndex. Without one, updates are
+            computed every time, from the cached analysis.
+        """
+        digest = source_hash(source)
+        versioned = index_version is None and hasattr(index, 'version')
+        if versioned:
+            index_version = index.version
+        if index_version is not None:
+            found = self._store.get('update', self._update_version(index_version), digest)
+            if found is not None:
+                return tuple(found)
+        unresolved, unreferenced, contexts = self._analyse(source, digest)
+        update = get_update(source, index, unresolved, unreferenced, contexts=contexts)
+        if versioned:
+            # The index may have been loaded, and rebuilt, while answering.
+            index_version = index.version
+        if index_version is not None:
+            self._store.put('update', self._update_version(index_version), digest, list(update))
+        return update
+
+    def update_imports(self, source, index, index_version=None):
+        """Return source with its imports updated. See get_update()."""
+        return apply_update(source, self.get_update(source, index, index_version))
+
+    def purge(self, index_version=None):
+        """Drop analyses from other versions, and updates for other index versions."""
+        self._store.purge('analysis', self._version)
+        if index_version is not None:
+            self._store.purge('update', self._update_version(index_version))
+
+    def _update_version(self, index_version):
+        return json.dumps([index_version, self._version, sorted(Imports._style.items())])
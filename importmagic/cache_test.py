@@ -0,0 +1,160 @@
+import re
+
+import pytest
+
+from importmagic import cache
+from importmagic.cache import CachedAnalysis, CachedIndex, CacheStore
+from importmagic.importer import update_imports
+from importmagic.index import SymbolIndex
+from importmagic.symbols import Scope
+
+
+def test_cache_store(tmpdir):
+    store = CacheStore(str(tmpdir.join('cache.sqlite')))
+    store.put_many('ns', 'v1', [('a', [1, 'x']), ('b', None)])
+    store.put('other', 'v1', 'a', 2)
+    assert store.get_many('ns', 'v1', ['a', 'b', 'c']) == {'a': [1, 'x'], 'b': None}
+    assert store.get_many('ns', 'v2', ['a']) == {}
+    assert store.get('ns', 'v1', 'c', 'default') == 'default'
+
+    store.put('ns', 'v2', 'c', 3)
+    store.purge('ns', 'v2')
+    assert store.get_many('ns', 'v1', ['a', 'b']) == {}
+    assert store.get('ns', 'v2', 'c') == 3
+    assert store.get('other', 'v1', 'a') == 2
+    # Values are kept across connections.
+    store.close()
+    assert CacheStore(store.filename).get('ns', 'v2', 'c') == 3
+
+
+def test_cached_index(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('mod.py').write('def func():\n pass\n')
+    index_file = tmpdir.join('index.json')
+    loads = []
+
+    def load():
+        loads.append(1)
+        if index_file.check():
+            with index_file.open() as fd:
+                return SymbolIndex.deserialize(fd)
+        index = SymbolIndex(blacklist_re=re.compile('mytest_'))
+        index.build_index([str(src)])
+        index_file.write(index.serialize())
+        return index
+
+    store = CacheStore(str(tmpdir.join('cache.sqlite')))
+    cached = CachedIndex(str(index_file), load, store=store)
+    expected = cached.symbol_scores('func')
+    assert expected[0][1:] == ('mod', 'func')
+    assert cached.symbol_scores_many(['func', 'unknown'], limit=1) == {
+        'func': expected[:1], 'unknown': []}
+    assert cached.location_for('mod') == 'L'
+    assert len(loads) == 1
+
+    # A new process answers known queries, including misses, without loading.
+    cached = CachedIndex(str(index_file), load, store=store)
+    assert cached.symbol_scores('func') == expected
+    assert cached.symbol_scores_many(['func', 'unknown'], limit=1) == {
+        'func': expected[:1], 'unknown': []}
+    assert cached.location_for('mod') == 'L'
+    assert len(loads) == 1
+    # Names that are nowhere in the index are rejected without loading it.
+    rejects = cached.prefilter_rejects
+    assert cached.symbol_scores_many(['nothing', 'nothing.attr']) == {
+        'nothing': [], 'nothing.attr': []}
+    assert cached.prefilter_rejects == rejects + 2
+    assert len(loads) == 1
+    assert cached.symbol_scores('mod')[0][1:] == ('mod', None)
+    assert len(loads) == 2
+
+    # Rebuilding the index drops the old answers.
+    src.join('mod.py').write('def other_func():\n pass\n')
+    index_file.remove()
+    cached = CachedIndex(str(index_file), load, store=store)
+    assert cached.symbol_scores('func') == []
+    assert len(loads) == 3
+    assert cached.symbol_scores('other_func')[0][1:] == ('mod', 'other_func')
+    assert store.get_many('scores:' + str(index_file), cached._version, ['["func", null]']) == {
+        '["func", null]': []}
+    assert not store._db.execute("SELECT COUNT(*) FROM entries WHERE version != ?"
+                                 " AND namespace NOT LIKE 'stamp:%'",
+                                 (cached._version,)).fetchone()[0]
+    assert cached.load() is cached.index
+    assert len(loads) == 3
+
+
+def test_cached_index_hashes_index_file_only_when_rewritten(tmpdir, monkeypatch):
+    index_file = tmpdir.join('index.json')
+    index_file.write(SymbolIndex().serialize())
+    store = CacheStore(str(tmpdir.join('cache.sqlite')))
+    hashes = []
+    file_hash = cache.file_hash
+    monkeypatch.setattr(cache, 'file_hash', lambda *args: hashes.append(args) or file_hash(*args))
+
+    version = CachedIndex(str(index_file), None, store=store).version
+    assert version == file_hash(str(index_file))
+    assert len(hashes) == 1
+    assert CachedIndex(str(index_file), None, store=store).version == version
+    assert len(hashes) == 1
+    # Different rules, different version.
+    assert CachedIndex(str(index_file), None, store=store, key='rules').version != version
+    assert len(hashes) == 2
+
+    index_file.remove()
+    index_file.write(SymbolIndex().serialize())
+    assert CachedIndex(str(index_file), None, store=store).version == version
+    assert len(hashes) == 3
+
+
+def test_cached_analysis(tmpdir, index, monkeypatch):
+    src = 'def f():\n    return os.path.join(a, Error)\n'
+    store = CacheStore(str(tmpdir.join('cache.sqlite')))
+    scope = Scope.from_source(src)
+    expected = scope.find_unresolved_and_unreferenced_symbols() + (scope.reference_contexts(),)
+    assert CachedAnalysis(store).analyse(src) == expected
+    updated = CachedAnalysis(store).update_imports(src, index, index_version='v1')
+    assert updated == update_imports(src, index, *expected[:2], contexts=expected[2])
+
+    def fail(*args, **kwargs):
+        raise AssertionError('not cached')
+
+    # Unchanged sources are answered without parsing or querying the index.
+    monkeypatch.setattr(Scope, 'from_source', fail)
+    monkeypatch.setattr(cache, 'get_update', fail)
+    cached = CachedAnalysis(store)
+    assert cached.analyse(src) == expected
+    assert cached.update_imports(src, index, index_version='v1') == updated
+    # Updates for another version of the index are recomputed, from the
+    # cached analysis.
+    monkeypatch.undo()
+    monkeypatch.setattr(Scope, 'from_source', fail)
+    assert cached.update_imports(src, index, index_version='v2') == updated
+    # Without an index version, updates aren't cached.
+    monkeypatch.setattr(cache, 'get_update', fail)
+    with pytest.raises(AssertionError):
+        cached.get_update(src, index)
+
+
+def test_cached_analysis_hit_reads_nothing_but_the_store(tmpdir, index, monkeypatch):
+    # As the command line tool runs on an unchanged file.
+    index_file = tmpdir.join('index.json')
+    index_file.write(index.serialize())
+    store = CacheStore(str(tmpdir.join('cache.sqlite')))
+    src = 'def f():\n    return os.path.join(a, Error)\n'
+
+    def load():
+        with index_file.open() as fd:
+            return SymbolIndex.deserialize(fd)
+
+    cached_index = CachedIndex(str(index_file), load, store=store)
+    updated = CachedAnalysis(store).update_imports(src, cached_index)
+    assert 'import os.path\n' in updated
+
+    def fail(*args, **kwargs):
+        raise AssertionError('not cached')
+
+    monkeypatch.setattr(cache, 'file_hash', fail)
+    monkeypatch.setattr(Scope, 'from_source', fail)
+    cached_index = CachedIndex(str(index_file), fail, store=store)
+    assert CachedAnalysis(store).update_imports(src, cached_index) == updated
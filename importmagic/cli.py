@@ -1,10 +1,13 @@
 """Update python imports using importmagic."""
 
 import argparse
+import json
 import os
 import sys
 
 import importmagic
+from importmagic.cache import CachedAnalysis, CachedIndex, CacheStore
+from importmagic.index import get_index_file, get_index_rules_from_config
 
 
 def main():
@@ -22,20 +25,55 @@ def main():
         ' to the import path when building the index.'
     )
 
+    parser.add_argument(
+        '--index-timeout',
+        type=float,
+        default=None,
+        help='Stop building the index after this many seconds. The partial'
+        ' index is used and saved, and completed on subsequent runs.'
+    )
+
+    parser.add_argument(
+        '--exclude',
+        action='append',
+        default=[],
+        metavar='PATTERN',
+        help='Do not index modules whose dotted path matches this glob'
+        ' pattern, eg. "*.vendored". May be given multiple times, and is'
+        ' added to the "exclude" setting in setup.cfg.'
+    )
+    parser.add_argument(
+        '--include',
+        action='append',
+        default=[],
+        metavar='PATTERN',
+        help='Index modules matching this glob pattern even if they are'
+        ' excluded. May be given multiple times.'
+    )
+
     args = parser.parse_args()
 
     path = sys.path if args.exclude_current_path else sys.path + [os.getcwd()]
 
-    index = importmagic.SymbolIndex()
-    index.get_or_create_index(paths=path, refresh=args.refresh)
+    rules = get_index_rules_from_config(os.getcwd())
+    exclude, include = rules['exclude'] + args.exclude, rules['include'] + args.include
+
+    def load():
+        index = importmagic.SymbolIndex(exclude=exclude, include=include)
+        return index.get_or_create_index(paths=path, refresh=args.refresh,
+                                         timeout=args.index_timeout)
+
+    # Symbols resolved by earlier runs are answered without loading the index.
+    store = CacheStore()
+    index = CachedIndex(get_index_file(), load, store=store, key=json.dumps([exclude, include]))
+    if args.refresh:
+        index.load()
 
     with open(args.file_name) as f:
         python_source = f.read()
 
-    scope = importmagic.Scope.from_source(python_source)
-
-    unresolved, unreferenced = scope.find_unresolved_and_unreferenced_symbols()
-    python_source = importmagic.update_imports(python_source, index, unresolved, unreferenced)
+    # Unchanged files are answered without parsing them or querying the index.
+    python_source = CachedAnalysis(store).update_imports(python_source, index)
 
     with open(args.file_name, 'w') as f:
         f.write(python_source)
@@ -1,14 +1,10 @@
 """Imports new symbols."""
 
-import os
 import tokenize
 from collections import defaultdict
-try:
-    from ConfigParser import ConfigParser
-except ImportError:
-    from configparser import ConfigParser
 
 from importmagic.six import StringIO
+from importmagic.util import PROJECT_CONFIG_FILE, get_project_config  # noqa: F401
 
 
 class Iterator(object):
@@ -73,7 +69,14 @@ class Import(object):
 # See SymbolIndex.LOCATIONS for details.
 LOCATION_ORDER = 'FS3L'
 
-PROJECT_CONFIG_FILE = 'setup.cfg'
+# Kinds (see SymbolIndex.KINDS) of names that can be used in each context
+# reported by Scope.reference_contexts(). Variables, reimports and builtin
+# attributes can hold classes or functions.
+CONTEXT_KINDS = {
+    'call': 'bcfiv',
+    'except': 'bciv',
+    'base': 'bciv',
+}
 
 
 class Imports(object):
@@ -102,16 +105,13 @@ class Imports(object):
 
     def get_style_from_config(self):
         style = {}
-        cfg_path = os.path.join(self._root_dir, PROJECT_CONFIG_FILE)
-        config = ConfigParser()
-        config.read(cfg_path)
-        imp_cfg = dict(config.items('importmagic'))
+        imp_cfg = get_project_config(self._root_dir)
 
-        if imp_cfg['multiline']:
+        if imp_cfg.get('multiline'):
             style['multiline'] = imp_cfg['multiline']
-        if imp_cfg['max_columns']:
+        if imp_cfg.get('max_columns'):
             style['max_columns'] = int(imp_cfg['max_columns'])
-        if config.getboolean('importmagic', 'indent_with_tabs'):
+        if imp_cfg.get('indent_with_tabs', '').lower() in ('1', 'yes', 'true', 'on'):
             style['indent_with_tabs'] = True
         return style
 
@@ -195,10 +195,7 @@ class Imports(object):
         return start, end, text
 
     def update_source(self):
-        start, end, text = self.get_update()
-        lines = self._source.splitlines()
-        lines[start:end] = text.splitlines()
-        return '\n'.join(lines) + '\n'
+        return apply_update(self._source, self.get_update())
 
     def _parse(self, source):
         reader = StringIO(source)
@@ -341,11 +338,33 @@ class Imports(object):
         return 'Imports(imports=%r, imports_from=%r)' % (self._imports, self._imports_from)
 
 
-def _process_imports(src, index, unresolved, unreferenced, project_root):
+def _context_kinds(contexts):
+    # The kinds a symbol used in all of contexts can be, or None for any.
+    kinds = None
+    for context in contexts:
+        if context in CONTEXT_KINDS:
+            allowed = set(CONTEXT_KINDS[context])
+            kinds = allowed if kinds is None else kinds & allowed
+    return None if kinds is None else ''.join(sorted(kinds))
+
+
+def _process_imports(src, index, unresolved, unreferenced, project_root, contexts=None):
     imports = Imports(index, src, project_root)
     imports.remove(unreferenced)
+    by_kinds = defaultdict(list)
+    for symbol in unresolved:
+        by_kinds[_context_kinds((contexts or {}).get(symbol, ()))].append(symbol)
+    results = {}
+    for kinds, symbols in by_kinds.items():
+        results.update(index.symbol_scores_many(symbols, limit=1, kinds=kinds))
+    # A filter can be wrong (eg. a variable that is really a function), so
+    # fall back to any match rather than none.
+    retry = [symbol for kinds, symbols in by_kinds.items() if kinds is not None
+             for symbol in symbols if not results[symbol]]
+    if retry:
+        results.update(index.symbol_scores_many(retry, limit=1))
     for symbol in unresolved:
-        scores = index.symbol_scores(symbol)
+        scores = results[symbol]
         if not scores:
             continue
         _, module, variable = scores[0]
@@ -361,11 +380,25 @@ def _process_imports(src, index, unresolved, unreferenced, project_root):
     return imports
 
 
-def get_update(src, index, unresolved, unreferenced, project_root=None):
-    imports = _process_imports(src, index, unresolved, unreferenced, project_root)
+def get_update(src, index, unresolved, unreferenced, project_root=None, contexts=None):
+    """Return (start line, end line, new import block) for src.
+
+    :param contexts: Optionally, Scope.reference_contexts() for src, to
+        prefer names of a kind that fits how each symbol is used.
+    """
+    imports = _process_imports(src, index, unresolved, unreferenced, project_root, contexts)
     return imports.get_update()
 
 
-def update_imports(src, index, unresolved, unreferenced, project_root=None):
-    imports = _process_imports(src, index, unresolved, unreferenced, project_root)
+def apply_update(src, update):
+    """Return src with its import block replaced, given get_update() for it."""
+    start, end, text = update
+    lines = src.splitlines()
+    lines[start:end] = text.splitlines()
+    return '\n'.join(lines) + '\n'
+
+
+def update_imports(src, index, unresolved, unreferenced, project_root=None, contexts=None):
+    """Return src with its imports updated. See get_update()."""
+    imports = _process_imports(src, index, unresolved, unreferenced, project_root, contexts)
     return imports.update_source()
@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from textwrap import dedent
 
 from importmagic.importer import Imports, PROJECT_CONFIG_FILE, get_update, update_imports
+from importmagic.index import SymbolIndex
 from importmagic.symbols import Scope
 
 
@@ -276,6 +277,17 @@ def test_get_style_from_config(index, tmpdir):
     }
 
 
+def test_get_style_from_config_without_style_options(index, tmpdir):
+    # The index rules example from the README, with no style options.
+    tmpdir.join(PROJECT_CONFIG_FILE).write(dedent('''
+        [importmagic]
+        exclude = *.vendored botocore.data*
+        include = *.vendored.six
+    '''))
+    imports = Imports(index, 'import os\n', root_dir=tmpdir.strpath)
+    assert imports.get_style_from_config() == {}
+
+
 def test_importer_wrapping_escaped(index):
     Imports.set_style(multiline='backslash', max_columns=80, indent_with_tabs=False)
     src = dedent('''
@@ -499,3 +511,34 @@ def test_imports_partial_file(index):
         ''')
     imports = Imports(index, src)
     assert imports.update_source() == src
+
+
+def test_update_imports_filters_by_context():
+    tree = SymbolIndex()
+    with tree.enter('errors') as errors:
+        errors.add('Error', 1.1, 'c')
+    with tree.enter('helpers', score=1.2) as helpers:
+        helpers.add('Error', 1.1, 'f')
+        helpers.add('retry', 1.1, 'f')
+    src = dedent("""
+        try:
+            retry()
+        except Error:
+            pass
+        """).strip()
+    scope = Scope.from_source(src)
+    unresolved, unreferenced = scope.find_unresolved_and_unreferenced_symbols()
+    assert 'from helpers import Error' in update_imports(src, tree, unresolved, unreferenced)
+    new_src = update_imports(src, tree, unresolved, unreferenced,
+                             contexts=scope.reference_contexts())
+    assert dedent("""
+        from errors import Error
+        from helpers import retry
+        """).strip() in new_src
+
+    # Without a match of a fitting kind, any match is better than none.
+    src = 'class A(retry):\n    pass\n'
+    scope = Scope.from_source(src)
+    unresolved, unreferenced = scope.find_unresolved_and_unreferenced_symbols()
+    assert 'from helpers import retry' in update_imports(
+        src, tree, unresolved, unreferenced, contexts=scope.reference_contexts())
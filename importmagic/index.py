@@ -1,15 +1,26 @@
 """Build an index of top-level symbols from Python modules and packages."""
 
 import ast
+import bisect
+import fnmatch
+import functools
+import hashlib
+import heapq
+import inspect
 import json
 import logging
 import os
 import re
 import sys
 import sysconfig
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from concurrent.futures import Future
 from contextlib import contextmanager
 
-from importmagic.util import get_cache_dir, parse_ast
+from importmagic.util import edit_distance, get_cache_dir, get_project_config, parse_ast
 
 
 def _get_lib_locations():
@@ -41,8 +52,49 @@ DEFAULT_BLACKLIST_RE = re.compile(r'\btest[s]?|test[s]?\b', re.I)
 # vars() on it.
 BUILTIN_MODULES = sys.builtin_module_names + ('os', 'typing',)
 
+# Order in which build_index() works through its roots: local project, then
+# the standard library (builtin modules first), then third party packages.
+BUILD_PRIORITY = 'LS3'
+# Order for the initial index of a BackgroundIndex, which has a small time
+# budget: builtin modules and the standard library cover most imports.
+INITIAL_BUILD_PRIORITY = 'SL3'
+
+# Pseudo-root under which builtin modules are scheduled by build_index().
+_BUILTIN_ROOT = '<builtins>'
+
+
+class _BuildTimeout(Exception):
+    # Raised inside index_path() when build_index() runs out of time.
+    # remaining holds the unindexed entries of the interrupted packages,
+    # relative to the directory containing the outermost one.
+    def __init__(self, remaining):
+        super(_BuildTimeout, self).__init__()
+        self.remaining = remaining
+
+
 _PYTHON_VERSION = 'python{}.{}'.format(sys.version_info.major, sys.version_info.minor)
 
+# Default policies of SymbolIndex.prune().
+PRUNE_DEFAULTS = {
+    'drop_shadowed_reimports': True,
+    'max_leaves_per_module': None,
+    'max_depth': None,
+    'max_leaves': None,
+}
+
+# Symbol lengths for which SymbolIndex keeps exact score bounds, longer
+# symbols use a bound for any length.
+_SEGMENT_LIMITS = (1, 2, 3, None)
+_BOUNDED_SEGMENTS = len(_SEGMENT_LIMITS)
+
+# Score of names that a module imports from elsewhere.
+REIMPORT_SCORE = 0.25
+
+# Number of symbol_scores() results remembered per queried scope.
+QUERY_CACHE_SIZE = 1024
+
+QueryCacheInfo = namedtuple('QueryCacheInfo', 'hits misses maxsize currsize')
+
 LOCATION_BOOSTS = {
     '3': 1.2,
     'L': 1.5,
@@ -56,18 +108,159 @@ LOCATION_BOOSTS = {
 logger = logging.getLogger(__name__)
 
 
+def compile_rules(rules):
+    """Compile include/exclude rules for dotted module paths.
+
+    :param rules: Glob patterns (eg. '*.vendored', 'botocore.data*') and/or
+        compiled regular expressions, which are matched from the start of the
+        dotted path.
+    """
+    return [rule if hasattr(rule, 'match') else re.compile(fnmatch.translate(rule))
+            for rule in rules or ()]
+
+
+# Roughly how many postings entries fuzzy() can read in the time it takes to
+# compute one edit_distance().
+_EDIT_DISTANCE_COST = 2000
+
+
+def _trigrams(name):
+    padded = '^' + name + '$'
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def _kind_of(scope, sub_path):
+    """Return the KINDS code of what sub_path (see SymbolIndex._score_key()) resolves to in scope.
+
+    Names of unknown kind match any kind, so for them this returns ''.
+    """
+    if None not in sub_path:
+        return 'm'
+    for part in sub_path[:-2]:
+        scope = scope._tree[part]
+    return scope._kinds.get(sub_path[-1], '')
+
+
+def _locked(method):
+    """Run a SymbolIndex method holding the lock of its index."""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._root._state.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
+def describe_match(first, sub_path, path, parts):
+    """Return the (package, reference|None) to import for a match.
+
+    :param first: The first segment of the symbol.
+    :param sub_path: The segments matched below the scope, starting with
+        first, with None before the last one if it is a name rather than a
+        package.
+    :param path: The dotted path of the scope.
+    :param parts: path split into segments.
+    """
+    try:
+        i = sub_path.index(None)
+        sub_path, variable = sub_path[:i], '.'.join(sub_path[i + 1:])
+    except ValueError:
+        variable = None
+    module = '.'.join(filter(None, [path, '.'.join(sub_path)]))
+    prefix = parts + sub_path if parts or sub_path else ['']
+
+    # sys.path              sys path          ->    import sys
+    # os.path.basename      os.path basename  ->    import os.path
+    # basename              os.path basename   ->   from os.path import basename
+    # path.basename         os.path basename   ->   from os import path
+    if variable is not None:
+        prefix.append(variable)
+    new_module = []
+    while prefix and first != prefix[0]:
+        new_module.append(prefix.pop(0))
+    if new_module:
+        module, variable = '.'.join(new_module), prefix[0]
+    else:
+        variable = None
+    return module, variable
+
+
+def get_index_file(name=None):
+    """Return the file get_or_create_index() caches the index called name in."""
+    return os.path.join(get_cache_dir(), (name or 'default') + '.json')
+
+
+def get_index_rules_from_config(root_dir):
+    """Read index include/exclude rules from the project config file.
+
+    Rules are given as whitespace or comma separated glob patterns:
+
+        [importmagic]
+        exclude = *.vendored botocore.data
+        include = *.vendored.six
+
+    :returns: A dict with 'exclude' and 'include' lists.
+    """
+    config = get_project_config(root_dir)
+    rules = {}
+    for key in ('exclude', 'include'):
+        rules[key] = config.get(key, '').replace(',', ' ').split()
+    return rules
+
+
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, SymbolIndex):
             d = o._tree.copy()
             d.update(('.' + name, getattr(o, name))
                      for name in SymbolIndex._SERIALIZED_ATTRIBUTES)
-            if o._lib_locations is not None:
-                d['.lib_locations'] = o._lib_locations
+            if o._kinds:
+                # One code per name, in sorted order.
+                d['.kinds'] = ''.join(o._kinds.get(name, '-') for name in sorted(o._tree)
+                                      if type(o._tree[name]) is float)
+            if o._parent is None:
+                state = o._state
+                d['.lib_locations'] = state.lib_locations
+                if state.pending:
+                    d['.pending'] = state.pending
+                d.update((k, v) for k, v in o._manifest().items() if v)
             return d
         return super(JSONEncoder, self).default(o)
 
 
+class _IndexState(object):
+    """What a SymbolIndex keeps once, on its root, rather than on every node."""
+
+    __slots__ = ('lock', 'generation', 'derived', 'derived_generation', 'nodes_at',
+                 'memo_hits', 'memo_misses', 'prefilter_rejects', 'query_cache_size',
+                 'exclude', 'include', 'lib_locations', 'pending', 'deadline', 'prune_policy')
+
+    def __init__(self, exclude, include, lib_locations, prune_policy, query_cache_size):
+        # Held by queries and updates, see _locked().
+        self.lock = threading.RLock()
+        # Bumped by SymbolIndex._touch() whenever the index changes, to
+        # invalidate derived data such as SymbolIndex._scope_table().
+        self.generation = 0
+        # (what, node) -> data derived from the index as it was at
+        # derived_generation, see SymbolIndex._derived().
+        self.derived = {}
+        self.derived_generation = 0
+        # (generation, SymbolIndex._nodes()), kept up to date by
+        # SymbolIndex._touch_subtree() rather than dropped.
+        self.nodes_at = None
+        self.memo_hits = self.memo_misses = 0
+        # See SymbolIndex.prefilter_rejects.
+        self.prefilter_rejects = 0
+        self.query_cache_size = query_cache_size
+        self.exclude = exclude
+        self.include = include
+        self.lib_locations = lib_locations
+        # Roots and entries build_index() has yet to index.
+        self.pending = None
+        # Set by build_index() while it runs with a timeout.
+        self.deadline = None
+        self.prune_policy = prune_policy
+
+
 class SymbolIndex(object):
     PACKAGE_ALIASES = {
         # Give 'os.path' a score boost over posixpath and ntpath.
@@ -81,15 +274,59 @@ class SymbolIndex(object):
         'S': 'System',
         'L': 'Local',
     }
+    # Kinds of names, as recorded for each name in a module. Packages and
+    # modules themselves are subtrees, of kind 'm'.
+    KINDS = {
+        'c': 'Class',
+        'f': 'Function',
+        'v': 'Variable',
+        'i': 'Reimport',
+        'm': 'Module',
+        'b': 'Other attribute of a builtin module',
+    }
     _PACKAGE_ALIASES = dict((v[0], (k, v[1])) for k, v in PACKAGE_ALIASES.items())
+    # Paths of nodes sharing their table with an alias.
+    _ALIASED = frozenset(PACKAGE_ALIASES) | frozenset(_PACKAGE_ALIASES)
     _SERIALIZED_ATTRIBUTES = {'score': 1.0, 'location': '3'}
+    # Indexes have a node per module and package, so whatever is the same
+    # for every node is kept once, in the root's _state.
+    __slots__ = ('_name', '_tree', '_kinds', '_exports', '_shared', '_parent', '_root', '_path',
+                 '_blacklist_re', 'score', 'location', '_state')
 
     def __init__(self, name=None, parent=None, score=1.0, location='L',
-                 blacklist_re=None, locations=None):
+                 blacklist_re=None, locations=None, exclude=None, include=None, prune=None,
+                 query_cache_size=QUERY_CACHE_SIZE):
+        """
+        Only blacklist_re applies to subtrees (parent is not None), which
+        take the other settings from the root.
+
+        :param blacklist_re: Regex matching file names that are never indexed.
+        :param exclude: Rules (see compile_rules()) matching dotted module
+            paths that are never indexed, along with everything below them,
+            unless they also match an include rule. Excluded packages are
+            not read at all, only searched for included modules if there
+            are include rules.
+        :param include: Rules that take precedence over exclude rules,
+            including those matching a package above the module.
+        :param prune: If given, prune() is applied when a build completes,
+            with this dict of policies (or the defaults if True).
+        :param query_cache_size: How many symbol_scores() results to
+            remember until the index changes. 0 disables the cache.
+        """
         self._name = name
         self._tree = {}
+        # Name -> KINDS code, for names (not subtrees) whose kind is known.
+        self._kinds = {}
         self._exports = {}
+        # Whether _tree and _kinds may be shared with other subtrees by
+        # dedupe(). If so they are copied before being changed, see _unshare().
+        self._shared = False
         self._parent = parent
+        self._root = self if parent is None else parent._root
+        if parent is not None and parent._path:
+            self._path = parent._path + '.' + name
+        else:
+            self._path = name or ''
         if blacklist_re:
             self._blacklist_re = blacklist_re
         elif parent:
@@ -99,10 +336,14 @@ class SymbolIndex(object):
         self.score = score
         self.location = location
         if parent is None:
-            self._lib_locations = locations or LIB_LOCATIONS
-        else:
-            self._lib_locations = None
-        if parent is None:
+            prune_policy = None
+            if prune:
+                prune_policy = dict(PRUNE_DEFAULTS)
+                if prune is not True:
+                    prune_policy.update(prune)
+            self._state = _IndexState(compile_rules(exclude), compile_rules(include),
+                                      locations or LIB_LOCATIONS, prune_policy,
+                                      query_cache_size)
             self._merge_aliases()
             with self.enter('__future__', location='F'):
                 pass
@@ -111,13 +352,41 @@ class SymbolIndex(object):
 
     @property
     def lib_locations(self):
-        if self._parent:
-            return self._parent.lib_locations
-        return self._lib_locations
+        return self._root._state.lib_locations
+
+    @property
+    def prefilter_rejects(self):
+        """Queries answered without a search, as no scope holds their first segment."""
+        return self._root._state.prefilter_rejects
+
+    @property
+    def incomplete_roots(self):
+        """Roots that a time-limited build_index() has not finished yet."""
+        return [root for root, _ in self._root._state.pending or []]
+
+    def is_complete(self):
+        return not self._root._state.pending
 
     @classmethod
-    def deserialize(self, file):
+    def deserialize(self, file, **kwargs):
+        """Load an index from a file object; kwargs are passed to the constructor."""
+        tree = SymbolIndex(**kwargs)
+        tree._load(json.load(file))
+        if tree.is_complete():
+            tree.dedupe()
+        return tree
+
+    def _load(self, data):
         def load(tree, data, parent_location):
+            kinds = data.pop('.kinds', '')
+            if kinds:
+                names = sorted(key for key, value in data.items() if not isinstance(value, dict))
+                kinds = dict((name, kind) for name, kind in zip(names, kinds) if kind != '-')
+            else:
+                kinds = {}
+            tree._unshare()
+            table = tree._tree
+            added = False
             for key, value in data.items():
                 if isinstance(value, dict):
                     score = value.pop('.score', 1.0)
@@ -126,14 +395,67 @@ class SymbolIndex(object):
                         load(subtree, value, location)
                 else:
                     assert isinstance(value, float), '%s expected to be float was %r' % (key, value)
-                    tree.add(key, value)
+                    if key in table:
+                        tree.add(key, value, kinds.get(key))
+                        continue
+                    # As add(), touching the index once per node.
+                    table[key] = value
+                    if key in kinds:
+                        tree._kinds[key] = kinds[key]
+                    added = True
+            if added:
+                tree._touch_names()
 
-        data = json.load(file)
         data.pop('.location', None)
         data.pop('.score', None)
-        tree = SymbolIndex(locations=data.pop('.lib_locations', LIB_LOCATIONS))
-        load(tree, data, 'L')
-        return tree
+        state = self._state
+        state.lib_locations = data.pop('.lib_locations', state.lib_locations)
+        state.pending = data.pop('.pending', None)
+        state.exclude = compile_rules(re.compile(r) for r in data.pop('.exclude', ()))
+        state.include = compile_rules(re.compile(r) for r in data.pop('.include', ()))
+        state.prune_policy = data.pop('.prune', None)
+        load(self, data, 'L')
+
+    def _load_cache(self, filename):
+        """Load a cached index, unless it was built with different rules."""
+        with open(filename) as fd:
+            data = json.load(fd)
+        manifest = self._manifest()
+        if any((data.get(key) or None) != (value or None) for key, value in manifest.items()):
+            logger.debug('index rules changed, not using cached index %s', filename)
+            return False
+        self._load(data)
+        return True
+
+    def _manifest(self):
+        # Settings a cached index must have been built with to be reused.
+        state = self._root._state
+        return {
+            '.exclude': [rule.pattern for rule in state.exclude],
+            '.include': [rule.pattern for rule in state.include],
+            '.prune': state.prune_policy,
+        }
+
+    def _is_excluded(self, module):
+        # The rules matching the longest prefix of module decide, so that
+        # excluding a package excludes its modules unless they are included.
+        state = self._root._state
+        if not state.exclude:
+            return False
+        parts = module.split('.')
+        for i in range(len(parts), 0, -1):
+            prefix = '.'.join(parts[:i])
+            if any(rule.match(prefix) for rule in state.include):
+                return False
+            if any(rule.match(prefix) for rule in state.exclude):
+                return True
+        return False
+
+    def _may_include_below(self, root):
+        # Whether a package directory excluded by a rule has to be searched
+        # for modules matching include rules. Rules are arbitrary regexes, so
+        # any include rule might match below it.
+        return bool(self._root._state.include) and os.path.isdir(root)
 
     def index_source(self, filename, source):
         try:
@@ -155,6 +477,7 @@ class SymbolIndex(object):
             success = subtree.index_source(filename, source)
         if not success:
             self._tree.pop(module, None)
+            self._touch()
 
     def index_path(self, root):
         """Index a path.
@@ -162,7 +485,16 @@ class SymbolIndex(object):
         :param root: Either a package directory, a .so or a .py module.
         """
         basename = os.path.basename(root)
-        if os.path.splitext(basename)[0] != '__init__' and basename.startswith('_'):
+        module = os.path.splitext(basename)[0]
+        if module == '__init__':
+            # The package's own names.
+            if self.path() and self._is_excluded(self.path()):
+                return
+        elif basename.startswith('_'):
+            return
+        elif self._is_excluded('.'.join(filter(None, [self.path(), module]))) and \
+                not self._may_include_below(root):
+            logger.debug('excluded %s from index', root)
             return
         location = self._determine_location_for(root)
         if os.path.isfile(root):
@@ -173,8 +505,21 @@ class SymbolIndex(object):
     def _index_package(self, root, location):
         basename = os.path.basename(root)
         with self.enter(basename, location=location) as subtree:
-            for filename in os.listdir(root):
-                subtree.index_path(os.path.join(root, filename))
+            filenames = sorted(os.listdir(root))
+            for i, filename in enumerate(filenames):
+                deadline = self._root._state.deadline
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise _BuildTimeout([os.path.join(basename, f) for f in filenames[i:]])
+                try:
+                    subtree.index_path(os.path.join(root, filename))
+                except _BuildTimeout as e:
+                    e.remaining = [os.path.join(basename, f) for f in e.remaining] + \
+                        [os.path.join(basename, f) for f in filenames[i + 1:]]
+                    raise
+        if not subtree._tree and self._is_excluded(subtree.path()):
+            # Only searched for included modules, and there were none.
+            del self._tree[basename]
+            self._touch()
 
     def _index_module(self, root, location):
         basename, ext = os.path.splitext(os.path.basename(root))
@@ -189,9 +534,154 @@ class SymbolIndex(object):
         elif ext in ('.dll', '.so'):
             self.index_builtin(import_path, location=location)
 
+    @_locked
+    def update_path(self, root, path):
+        """Bring the index up to date after path under root changed.
+
+        path is a .py module or a package directory that was created,
+        modified or deleted. Only the affected module or package subtree is
+        rebuilt, and then swapped in. Queries and updates hold a lock on
+        the index, so update_path() can be called from another thread (eg.
+        by an IndexWatcher) while the index is queried.
+
+        :param root: The indexed root (eg. sys.path entry) containing path.
+        :returns: True if the index was updated.
+        """
+        index = self._root
+        root = os.path.abspath(root)
+        path = os.path.abspath(path)
+        parts = os.path.relpath(path, root).split(os.path.sep)
+        if parts[0] in (os.curdir, os.pardir):
+            return False
+        name, ext = os.path.splitext(parts[-1])
+        if name == '__init__':
+            # A package's own module: rebuild the whole package, as
+            # build_index() would.
+            parts.pop()
+            path = os.path.dirname(path)
+            if not parts:
+                return False
+        elif ext:
+            if ext != '.py':
+                return False
+            parts[-1] = name
+        module = '.'.join(parts)
+        if any(part.startswith('_') for part in parts) or module in BUILTIN_MODULES:
+            return False
+        excluded = index._is_excluded(module)
+        if excluded and not index._may_include_below(path):
+            return False
+
+        parent = index
+        for i, part in enumerate(parts[:-1]):
+            parent._unshare()
+            node = parent._tree.get(part)
+            if not isinstance(node, SymbolIndex):
+                # The enclosing package is new too, index all of it.
+                package = os.path.join(root, *parts[:i + 1])
+                if not os.path.exists(os.path.join(package, '__init__.py')):
+                    return False
+                return index.update_path(root, package)
+            parent = node
+
+        name = parts[-1]
+        parent._unshare()
+        subtree = SymbolIndex(name, parent, location=self._determine_location_for(path))
+        if os.path.isdir(path) and os.path.exists(os.path.join(path, '__init__.py')):
+            for filename in os.listdir(path):
+                subtree.index_path(os.path.join(path, filename))
+            if excluded and not subtree._tree:
+                subtree = None
+        elif not (os.path.isfile(path) and subtree._index_detached_file(path)):
+            subtree = None
+        return parent._replace_subtree(name, subtree)
+
+    @_locked
+    def replace_module(self, parts, tree, location='L', package=False):
+        """Replace the names indexed for one module with those defined in tree.
+
+        Unlike update_path(), the module is not read, eg. for modules that
+        are already parsed, or edited but not saved. Missing enclosing
+        packages are created.
+
+        :param parts: The dotted path of the module, split.
+        :param tree: The module's AST, or None to remove the module, with
+            every module below it.
+        :param location: Location of the module, see LOCATIONS.
+        :param package: If True, tree is the package's __init__.py, and
+            only the package's own names are replaced, keeping its modules.
+        :returns: True if the index was updated.
+        """
+        parent = self
+        for part in parts[:-1]:
+            parent._unshare()
+            node = parent._tree.get(part)
+            if not isinstance(node, SymbolIndex):
+                if tree is None:
+                    return False
+                with parent.enter(part, location=location) as node:
+                    pass
+            parent = node
+
+        name = parts[-1]
+        parent._unshare()
+        if not package:
+            module = None
+            if tree is not None:
+                module = SymbolIndex(name, parent, location=location)
+                SymbolVisitor(module).visit(tree)
+            return parent._replace_subtree(name, module)
+
+        module = parent._tree.get(name)
+        if not isinstance(module, SymbolIndex):
+            with parent.enter(name, location=location) as module:
+                pass
+        module._unshare()
+        for key in [key for key, value in module._tree.items() if type(value) is float]:
+            del module._tree[key]
+            module._kinds.pop(key, None)
+        module._exports = {}
+        if tree is not None:
+            SymbolVisitor(module).visit(tree)
+            if module._exports:
+                # As _prune_unexported(), but keeping the package's modules.
+                for key in set(module._tree) - set(module._exports):
+                    if type(module._tree[key]) is float:
+                        del module._tree[key]
+                        module._kinds.pop(key, None)
+        module._touch_names()
+        return True
+
+    def _replace_subtree(self, name, subtree):
+        # Swap in subtree for the entry for name, or remove the entry if
+        # subtree is None. Returns False if there was nothing to remove.
+        self._unshare()
+        self._kinds.pop(name, None)
+        if subtree is None:
+            old = self._tree.pop(name, None)
+            if old is None:
+                return False
+        else:
+            subtree._prune_unexported()
+            old = self._tree.get(name)
+            self._tree[name] = subtree
+        self._touch_subtree(name, old, subtree)
+        return True
+
+    def _index_detached_file(self, filename):
+        if self._blacklist_re.search(filename):
+            return False
+        try:
+            with open(filename, 'rb') as fd:
+                source = fd.read()
+        except (IOError, OSError) as e:
+            logger.debug('failed to read %s: %s', filename, e)
+            return False
+        return self.index_source(filename, source)
+
     def index_builtin(self, name, location):
         basename = name.rsplit('.', 1)[-1]
-        if basename.startswith('_'):
+        if basename.startswith('_') or self._is_excluded(name):
             return
         logger.debug('importing builtin module %s for indexing', name)
         try:
@@ -203,92 +693,782 @@ class SymbolIndex(object):
         with self.enter(basename, location=location) as subtree:
             for key, value in vars(module).items():
                 if not key.startswith('_'):
-                    subtree.add(key, 1.1)
+                    if inspect.isclass(value):
+                        kind = 'c'
+                    elif inspect.isroutine(value):
+                        kind = 'f'
+                    else:
+                        kind = 'b'
+                    subtree.add(key, 1.1, kind)
+
+    def build_index(self, paths, timeout=None, builtins=True, priority=BUILD_PRIORITY):
+        """Index builtin modules and all modules found in paths.
+
+        Roots are indexed in priority order. If the build is still
+        running after timeout seconds it stops, leaving a usable partial
+        index, even part way through a package. The remaining work is kept
+        (and serialized) so that calling build_index() again resumes where
+        it left off.
+
+        :param timeout: Optional time budget in seconds.
+        :param builtins: Whether to index builtin modules.
+        :param priority: Order of root locations, see BUILD_PRIORITY.
+        :returns: True if the index is complete.
+        """
+        state = self._root._state
+        if state.pending is None:
+            state.pending = self._plan_build(paths, builtins, priority)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        state.deadline = deadline
+        try:
+            while state.pending:
+                root, entries = state.pending[0]
+                while entries:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        logger.debug('index build timed out, incomplete roots: %s',
+                                     ', '.join(self.incomplete_roots))
+                        return False
+                    entry = entries.pop(0)
+                    if root == _BUILTIN_ROOT:
+                        self.index_builtin(entry, location='S')
+                        continue
+                    try:
+                        self._index_entry(root, entry)
+                    except _BuildTimeout as e:
+                        entries[:0] = e.remaining
+                        logger.debug('index build timed out in %s, incomplete roots: %s',
+                                     os.path.join(root, entry), ', '.join(self.incomplete_roots))
+                        return False
+                state.pending.pop(0)
+        finally:
+            state.deadline = None
+        state.pending = None
+        if self._parent is None:
+            if state.prune_policy is not None:
+                self.prune(**state.prune_policy)
+            self.dedupe()
+        return True
+
+    def _index_entry(self, root, entry):
+        # Index a pending entry, which is inside a package if the build
+        # timed out part way through it.
+        parts = entry.split(os.path.sep)
+        tree = self
+        for i, part in enumerate(parts[:-1]):
+            package = os.path.join(root, *parts[:i + 1])
+            with tree.enter(part, location=self._determine_location_for(package)) as tree:
+                pass
+        tree.index_path(os.path.join(root, entry))
 
-    def build_index(self, paths):
-        for builtin in BUILTIN_MODULES:
-            self.index_builtin(builtin, location='S')
+    def _plan_build(self, paths, builtins, priority):
+        roots = [(_BUILTIN_ROOT, 'S', list(BUILTIN_MODULES))] if builtins else []
+        seen = set()
         for path in paths:
             # for the implicit "" entry in sys.path
             path = path or '.'
-            if os.path.isdir(path):
-                for filename in os.listdir(path):
-                    filename = os.path.join(path, filename)
-                    self.index_path(filename)
-
-    def get_or_create_index(self, paths=None, name=None, refresh=False):
+            if path in seen or not os.path.isdir(path):
+                continue
+            seen.add(path)
+            location = self._determine_location_for(os.path.abspath(path))
+            roots.append((path, location, sorted(os.listdir(path))))
+        # Locations missing from priority come last.
+        rank = dict((location, i) for i, location in enumerate(priority))
+        roots.sort(key=lambda r: rank.get(r[1], len(priority)))
+        return [[root, entries] for root, _, entries in roots]
+
+    def get_or_create_index(self, paths=None, name=None, refresh=False, timeout=None,
+                            builtins=True):
         """
         Get index with given name from cache. Create if it doesn't exists.
+
+        If a cached index is incomplete (see build_index()), building resumes
+        from where it stopped.
+
+        :param timeout: Optional time budget in seconds for building.
         """
         if not paths:
             paths = sys.path
-        if not name:
-            name = 'default'
-        self._name = name
+        idx_file = get_index_file(name)
 
-        idx_dir = get_cache_dir()
-        idx_file = os.path.join(idx_dir, name + '.json')
-
-        if os.path.exists(idx_file) and not refresh:
-            with open(idx_file) as fd:
-                self.deserialize(fd)
+        if os.path.exists(idx_file) and not refresh and self._load_cache(idx_file):
+            if self.is_complete():
+                self.dedupe()
+                return self
         else:
-            self.build_index(paths)
-            with open(idx_file, 'w') as fd:
+            self._state.pending = None
+        self.build_index(paths, timeout=timeout, builtins=builtins)
+        self._write(idx_file)
+        return self
+
+    def _write(self, filename):
+        # Write to a temporary file first so that readers never see a
+        # partially written index.
+        fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(filename) + '.', suffix='.tmp',
+                                        dir=os.path.dirname(filename) or os.curdir)
+        try:
+            with os.fdopen(fd, 'w') as fd:
                 self.serialize(fd)
+            # mkstemp() creates the file readable by its owner only.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_file, 0o666 & ~umask)
+            os.replace(tmp_file, filename)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+
+    def dedupe(self):
+        """Store structurally identical subtrees only once.
+
+        Environments often contain several identical copies of a package
+        (eg. vendored libraries). Subtrees with the same children, scores,
+        kinds and locations are made to share one child table, the same way
+        package aliases do. Unlike an alias, a subtree changed afterwards
+        gets its own copy of the table first, leaving the others as they
+        were. Local ('L') subtrees are left alone, as they change often.
+
+        :returns: A dict with the number of shared subtrees, the number of
+            entries no longer stored, and an estimate of the bytes saved.
+        """
+        canonical = {}
+        seen = {}
+        stats = {'subtrees': 0, 'entries': 0, 'bytes': 0}
+
+        def signature(node):
+            tree = node._tree
+            if id(tree) in seen:
+                return seen[id(tree)][0]
+            kinds = node._kinds
+            # Keys are unique, so items never compare beyond them.
+            items = tuple(sorted(
+                (key, value, kinds.get(key)) if type(value) is float else
+                (key, value.score, value.location, signature(value))
+                for key, value in tree.items()))
+            sig = canonical.setdefault(items, len(canonical))
+            # Keep tree alive so that its id can't be reused.
+            seen[id(tree)] = sig, tree
+            return sig
+
+        def walk(node):
+            for value in list(node._tree.values()):
+                if type(value) is float:
+                    continue
+                walk(value)
+                if value.location == 'L' or not value._tree:
+                    continue
+                sig = signature(value)
+                owner = tables.setdefault(sig, value)
+                shared, kinds = owner._tree, owner._kinds
+                if shared is not value._tree:
+                    owner._shared = True
+                    value._shared = True
+                    stats['subtrees'] += 1
+                    stats['entries'] += len(value._tree)
+                    stats['bytes'] += sys.getsizeof(value._tree) + sum(
+                        sys.getsizeof(v) for v in value._tree.values() if type(v) is not float)
+                    value._tree = shared
+                    value._kinds = kinds
+
+        tables = {}
+        walk(self)
+        if stats['subtrees']:
+            self._touch()
+        logger.debug('shared %(subtrees)d identical subtrees, '
+                     'saving %(entries)d entries (~%(bytes)d bytes)', stats)
+        return stats
+
+    def prune(self, drop_shadowed_reimports=True, max_leaves_per_module=None, max_depth=None,
+              max_leaves=None):
+        """Drop low value entries from the index.
+
+        :param drop_shadowed_reimports: Drop names a module imports from
+            elsewhere if they can never be the best match, neither for the
+            name itself (it scores higher somewhere else) nor for
+            "<module>.<name>".
+        :param max_leaves_per_module: Keep at most this many of the highest
+            scoring names in each module.
+        :param max_depth: Drop packages nested deeper than this.
+        :param max_leaves: Then drop the lowest scoring names until the index
+            has at most this many.
+        :returns: A dict with the number of names and subtrees removed.
+        """
+        stats = {'leaves': 0, 'subtrees': 0}
+        # Tables shared by dedupe() may be reachable from outside this tree.
+        # Copy them, and share whatever is still identical afterwards.
+        shared = self._unshare_all()
+
+        def drop(table, key):
+            if type(table.pop(key)) is float:
+                stats['leaves'] += 1
+                leaf_scores.pop((id(table), key), None)
+                kinds[id(table)].pop(key, None)
+            else:
+                stats['subtrees'] += 1
 
-        return self
+        # Scope tables by id, with the shallowest depth each is found at.
+        # Tables can be shared (see dedupe()).
+        tables = {}
+
+        def walk_tables(scope, depth):
+            table = scope._tree
+            if id(table) in tables and tables[id(table)][1] <= depth:
+                return
+            tables[id(table)] = (table, depth)
+            for value in table.values():
+                if type(value) is not float:
+                    walk_tables(value, depth + 1)
+
+        if max_depth is not None:
+            walk_tables(self, 0)
+            for table, depth in list(tables.values()):
+                if depth >= max_depth:
+                    for key in [k for k, v in table.items() if type(v) is not float]:
+                        drop(table, key)
+            tables.clear()
+
+        # (id(table), name) -> best score of a leaf, over all paths to it.
+        leaf_scores = {}
+        # name -> best score of any match for that name.
+        best = {}
+        # name -> [(leaf or subtree, boost and scale of its scope)]
+        occurrences = {}
+        # id(table) -> [(name, subtree, boost and scale of its scope)]
+        owners = {}
+
+        # id(table) -> the kinds of its names.
+        kinds = {}
+
+        # Mirrors the scoring in symbol_scores() for a single name.
+        def walk(scope, scale):
+            table = scope._tree
+            tables[id(table)] = table
+            kinds[id(table)] = scope._kinds
+            boost = scope.boost()
+            for key, value in table.items():
+                if type(value) is float:
+                    score = value * boost
+                    leaf = (id(table), key)
+                    leaf_scores[leaf] = max(score * scale, leaf_scores.get(leaf, score * scale))
+                else:
+                    score = value.score * boost
+                    owners.setdefault(id(value._tree), []).append((key, value, boost, scale))
+                    walk(value, value.score * scale - 0.1)
+                occurrences.setdefault(key, []).append((value, boost, scale))
+                if score > 0.1:
+                    best[key] = max(score * scale, best.get(key, score * scale))
+
+        # Score of a match for "<name of value>.attribute", as symbol_scores() computes it.
+        def dotted_score(value, boost, scale, attribute):
+            if type(value) is float:
+                score = value * boost
+            else:
+                child = value._tree.get(attribute)
+                if child is None:
+                    child_score = 0.0
+                elif type(child) is float:
+                    child_score = child * value.boost()
+                else:
+                    child_score = (0.0 + child.score) * value.boost()
+                score = (child_score + value.score) * boost
+            return score * scale if score > 0.1 else float('-inf')
+
+        # Whether table[key] is what makes its module the best match for
+        # "<module>.<key>".
+        def decides_dotted_match(table, key):
+            for name, module, boost, scale in owners.get(id(table), ()):
+                competitor = max([dotted_score(value, boost_, scale_, key)
+                                  for value, boost_, scale_ in occurrences[name]
+                                  if type(value) is float or value._tree is not table] or
+                                 [float('-inf')])
+                if dotted_score(module, boost, scale, key) >= competitor >= \
+                        dotted_score(module, boost, scale, None):
+                    return True
+            return False
 
-    def symbol_scores(self, symbol):
+        walk(self, 1.0)
+
+        for table in list(tables.values()):
+            if drop_shadowed_reimports:
+                for key, value in list(table.items()):
+                    if type(value) is float and value == REIMPORT_SCORE and \
+                            leaf_scores[(id(table), key)] < best[key] and \
+                            not decides_dotted_match(table, key):
+                        drop(table, key)
+            if max_leaves_per_module is not None:
+                leaves = sorted((-v, k) for k, v in table.items() if type(v) is float)
+                for _, key in leaves[max_leaves_per_module:]:
+                    drop(table, key)
+
+        if max_leaves is not None and len(leaf_scores) > max_leaves:
+            lowest = sorted(leaf_scores.items(), key=lambda item: item[1])
+            for (table_id, key), _ in lowest[:len(leaf_scores) - max_leaves]:
+                drop(tables[table_id], key)
+
+        if stats['leaves'] or stats['subtrees']:
+            self._touch()
+        logger.debug('pruned %(leaves)d names and %(subtrees)d subtrees from the index', stats)
+        if shared:
+            self.dedupe()
+        return stats
+
+    def symbol_scores(self, symbol, limit=None, kinds=None):
         """Find matches for symbol.
 
         :param symbol: A . separated symbol. eg. 'os.path.basename'
+        :param limit: If given, only return this many of the best matches.
+            Parts of the index that can't score high enough are skipped.
+        :param kinds: If given, only return matches that resolve to one of
+            these KINDS codes, eg. 'c' for classes. Names whose kind isn't
+            known always match.
         :returns: A list of tuples of (score, package, reference|None),
             ordered by score from highest to lowest.
         """
-        scores = []
-        path = []
-
-        # sys.path              sys path          ->    import sys
-        # os.path.basename      os.path basename  ->    import os.path
-        # basename              os.path basename   ->   from os.path import basename
-        # path.basename         os.path basename   ->   from os import path
-        def fixup(module, variable):
-            prefix = module.split('.')
-            if variable is not None:
-                prefix.append(variable)
-            seeking = symbol.split('.')
-            new_module = []
-            while prefix and seeking[0] != prefix[0]:
-                new_module.append(prefix.pop(0))
-            if new_module:
-                module, variable = '.'.join(new_module), prefix[0]
-            else:
-                variable = None
-            return module, variable
+        return self.symbol_scores_many([symbol], limit=limit, kinds=kinds)[symbol]
 
-        def score_walk(scope, scale):
-            sub_path, score = self._score_key(scope, full_key)
-            if score > 0.1:
-                try:
-                    i = sub_path.index(None)
-                    sub_path, from_symbol = sub_path[:i], '.'.join(sub_path[i + 1:])
-                except ValueError:
-                    from_symbol = None
-                package_path = '.'.join(path + sub_path)
-                package_path, from_symbol = fixup(package_path, from_symbol)
-                scores.append((score * scale, package_path, from_symbol))
-
-            for key, subscope in scope._tree.items():
-                if type(subscope) is not float:
-                    path.append(key)
-                    score_walk(subscope, subscope.score * scale - 0.1)
-                    path.pop()
-
-        full_key = symbol.split('.')
-        score_walk(self, 1.0)
-        scores.sort(reverse=True)
-        return scores
+    @_locked
+    def symbol_scores_many(self, symbols, limit=None, kinds=None):
+        """Find matches for several symbols at once.
+
+        Only the scopes holding a symbol's first segment are visited, once for
+        all symbols sharing it (eg. os.path.join and os.path.exists).
+
+        :param symbols: An iterable of . separated symbols.
+        :param limit: As for symbol_scores(), applied to each symbol.
+        :param kinds: As for symbol_scores().
+        :returns: A dict mapping each symbol to what symbol_scores() would
+            return for it.
+        """
+        if kinds is not None:
+            kinds = ''.join(sorted(set(kinds)))
+        state = self._root._state
+        if not state.query_cache_size:
+            return self._symbol_scores_many(symbols, limit, kinds)
+        memo = self._derived('memo')
+        if memo is None:
+            memo = self._store_derived('memo', state.generation, OrderedDict())
+        results = {}
+        missing = []
+        for symbol in symbols:
+            if symbol in results:
+                continue
+            scores = memo.get((symbol, limit, kinds))
+            if scores is None:
+                results[symbol] = None
+                missing.append(symbol)
+            else:
+                memo.move_to_end((symbol, limit, kinds))
+                results[symbol] = list(scores)
+                state.memo_hits += 1
+        if missing:
+            state.memo_misses += len(missing)
+            for symbol, scores in self._symbol_scores_many(missing, limit, kinds).items():
+                memo[(symbol, limit, kinds)] = tuple(scores)
+                results[symbol] = scores
+            while len(memo) > state.query_cache_size:
+                memo.popitem(last=False)
+        return results
+
+    def query_cache_info(self):
+        """Return the hits, misses, maxsize and currsize of the symbol_scores() cache."""
+        state = self._root._state
+        memo = self._derived('memo')
+        return QueryCacheInfo(state.memo_hits, state.memo_misses, state.query_cache_size,
+                              0 if memo is None else len(memo))
+
+    def _symbol_scores_many(self, symbols, limit, kinds):
+        results = {}
+        groups = {}
+        for symbol in symbols:
+            if symbol not in results:
+                results[symbol] = []
+                full_key = symbol.split('.')
+                bound = min(len(full_key), _BOUNDED_SEGMENTS) - 1
+                groups.setdefault(full_key[0], []).append((full_key, bound, results[symbol]))
+        if not results or limit is not None and limit <= 0:
+            return results
+        table = self._scope_table()
+        positions = self._positions()
+        for first, group in groups.items():
+            if first not in positions:
+                self._root._state.prefilter_rejects += len(group)
+                continue
+            # Bounds only grow with the number of segments, so the longest
+            # symbol gives a bound that holds for the whole group.
+            segments = max(bound for _, bound, _ in group)
+            unfilled = len(group)
+            # The lowest score any symbol in the group still has to beat.
+            threshold = None
+            for i in positions[first]:
+                scope, scale, boost, path, parts, bounds = table[i]
+                if threshold is not None and bounds[segments] < threshold:
+                    continue
+                value = scope._tree[first]
+                # Names of unknown kind match any kinds.
+                if kinds is not None and type(value) is float and \
+                        scope._kinds.get(first, '') not in kinds:
+                    continue
+                for full_key, bound, scores in group:
+                    if limit is not None and len(scores) == limit and bounds[bound] < scores[0][0]:
+                        continue
+                    match = self._match(value, full_key, scale, boost, path, parts, kinds)
+                    if match is None:
+                        continue
+                    if limit is None:
+                        scores.append(match)
+                        continue
+                    if len(scores) < limit:
+                        heapq.heappush(scores, match)
+                        unfilled -= len(scores) == limit
+                    elif match > scores[0]:
+                        heapq.heapreplace(scores, match)
+                    else:
+                        continue
+                    if not unfilled:
+                        threshold = min(scores[0][0] for _, _, scores in group)
+
+        for scores in results.values():
+            scores.sort(reverse=True)
+        return results
+
+    def _match(self, value, full_key, scale, boost, path, parts, kinds=None):
+        """Score a match for full_key, whose first segment is value in the scope at path.
+
+        :param kinds: If given, the match must resolve to a name of one of
+            these kinds, or a module if it includes 'm'. Callers check
+            names that are value itself.
+        :returns: A tuple of (score, package, reference|None), or None.
+        """
+        first = full_key[0]
+        if type(value) is float:
+            sub_path, score = [None, first], value * boost
+        else:
+            sub_path, score = self._score_key(value, full_key[1:])
+            if kinds is not None and _kind_of(value, sub_path) not in kinds:
+                return None
+            sub_path.insert(0, first)
+            score = (score + value.score) * boost
+        if score <= 0.1:
+            return None
+        module, variable = describe_match(first, sub_path, path, parts)
+        return score * scale, module, variable
+
+    @_locked
+    def complete(self, prefix, limit=10):
+        """Find the best matches for names starting with prefix.
+
+        eg. 'defaul' -> (score, 'collections', 'defaultdict')
+
+        :param prefix: The start of a name, without any dots.
+        :param limit: The maximum number of matches to return.
+        :returns: A list of up to limit tuples of (score, package,
+            reference|None), at most one per name, as symbol_scores() would
+            return for the name, ordered by score from highest to lowest.
+        """
+        if limit <= 0:
+            return []
+        names, scores, tree, size = self._completions()
+        lo = bisect.bisect_left(names, prefix)
+        hi = bisect.bisect_left(names, prefix + u'\U0010ffff', lo)
+
+        # The name with the highest score in names[lo:hi].
+        def best(lo, hi):
+            found = len(names)
+            lo += size
+            hi += size
+            while lo < hi:
+                if lo & 1:
+                    if scores[tree[lo]] > scores[found]:
+                        found = tree[lo]
+                    lo += 1
+                if hi & 1:
+                    hi -= 1
+                    if scores[tree[hi]] > scores[found]:
+                        found = tree[hi]
+                lo >>= 1
+                hi >>= 1
+            return found
+
+        # Take the best name in the range, then search either side of it.
+        top = []
+        candidates = []
+        if lo < hi:
+            i = best(lo, hi)
+            candidates.append((-scores[i], i, lo, hi))
+        while candidates and len(top) < limit:
+            score, i, lo, hi = heapq.heappop(candidates)
+            if i == len(names):
+                break
+            top.append(names[i])
+            for lo, hi in ((lo, i), (i + 1, hi)):
+                if lo < hi:
+                    j = best(lo, hi)
+                    heapq.heappush(candidates, (-scores[j], j, lo, hi))
+
+        matches = self.symbol_scores_many(top, limit=1)
+        results = [matches[name][0] for name in top if matches[name]]
+        results.sort(reverse=True)
+        return results
+
+    def fuzzy(self, name, max_distance=2, limit=10):
+        """Find the best matches for names within a few typos of name.
+
+        eg. 'defualtdict' -> (score, 'collections', 'defaultdict')
+
+        Candidates are names sharing enough character trigrams with name,
+        checked with a bounded Levenshtein distance.
+
+        :param name: A name, without any dots.
+        :param max_distance: The most insertions, deletions or
+            substitutions allowed. Short names allow fewer, one for every
+            four characters.
+        :param limit: The maximum number of matches to return.
+        :returns: A list of up to limit tuples of (score, package,
+            reference|None), at most one per name, as symbol_scores() would
+            return for the name. Closer names come first, then higher
+            scores.
+        """
+        return [match for _, match in self._fuzzy(name, max_distance, limit)]
+
+    @_locked
+    def _fuzzy(self, name, max_distance, limit):
+        # fuzzy(), with the distance of each match.
+        distance = min(max_distance, len(name) // 4)
+        if limit <= 0 or not name or '.' in name:
+            return []
+        if not distance:
+            return [(0, match) for match in self.symbol_scores(name, limit=1)]
+        names, scores, _, _ = self._completions()
+        postings = self._fuzzy_postings()
+        query = _trigrams(name)
+        # Each edit changes at most three trigrams.
+        need = len(query) - 3 * distance
+        lists = dict((gram, []) for gram in query)
+        for length in range(len(name) - distance, len(name) + distance + 1):
+            by_gram = postings.get(length)
+            if by_gram:
+                for gram in query:
+                    if gram in by_gram:
+                        lists[gram].append(by_gram[gram])
+        grams = sorted(query, key=lambda gram: sum(map(len, lists[gram])))
+        # A match has need of the trigrams, so it has one of any
+        # len(query) - need + 1 of them. Count the rarest to find candidates,
+        # then the others only for candidates that can still get to need.
+        rare = len(query) - need + 1
+        counts = Counter()
+        for gram in grams[:rare]:
+            for posting in lists[gram]:
+                counts.update(posting)
+        common = grams[rare:]
+        unread = sum(len(posting) for gram in common for posting in lists[gram])
+        while common:
+            least = need - len(common)
+            counts = {i: count for i, count in counts.items() if count >= least}
+            # Checking a few candidates directly is cheaper than reading
+            # long postings lists to rule them out.
+            if len(counts) * _EDIT_DISTANCE_COST < unread:
+                break
+            candidates = set(counts)
+            for posting in lists[common.pop(0)]:
+                unread -= len(posting)
+                for i in candidates.intersection(posting):
+                    counts[i] += 1
+
+        found = []
+        least = need - len(common)
+        for i, count in counts.items():
+            if count >= least:
+                found_distance = edit_distance(name, names[i], distance)
+                if found_distance <= distance:
+                    found.append((found_distance, -scores[i], names[i]))
+        found.sort()
+        found = found[:limit]
+        matches = self.symbol_scores_many([candidate for _, _, candidate in found], limit=1)
+        return [(found_distance, matches[candidate][0])
+                for found_distance, _, candidate in found if matches[candidate]]
+
+    def _fuzzy_postings(self):
+        """Map name length and trigram to the positions of names in _completions() with them."""
+        postings = self._derived('fuzzy')
+        if postings is not None:
+            return postings
+        generation = self._root._state.generation
+        postings = {}
+        for i, name in enumerate(self._completions()[0]):
+            by_gram = postings.get(len(name))
+            if by_gram is None:
+                by_gram = postings[len(name)] = defaultdict(list)
+            for gram in _trigrams(name):
+                by_gram[gram].append(i)
+        return self._store_derived('fuzzy', generation, postings)
+
+    def _completions(self):
+        """Return the data complete() searches, building it if the index changed.
+
+        This is every undotted name in the index in sorted order, the score
+        of its best match (as symbol_scores() computes it), and a segment tree
+        over the scores, with the position of the best name in each node. The
+        last score, of no name, is -inf.
+        """
+        completions = self._derived('completions')
+        if completions is not None:
+            return completions
+        generation = self._root._state.generation
+        best = {}
+        for scope, scale, boost, path, parts, bounds in self._scope_table():
+            for key, value in scope._tree.items():
+                score = (value if type(value) is float else value.score) * boost
+                if score > 0.1 and best.get(key, -1e300) < score * scale:
+                    best[key] = score * scale
+        # Some keys are dotted reimports, which symbol_scores() can't look
+        # up as a single name.
+        names = sorted(name for name in self._positions() if '.' not in name)
+        scores = [best.get(name, float('-inf')) for name in names]
+        scores.append(float('-inf'))
+        size = 1
+        while size < len(names):
+            size *= 2
+        tree = [len(names)] * (2 * size)
+        tree[size:size + len(names)] = range(len(names))
+        for i in range(size - 1, 0, -1):
+            left, right = tree[2 * i], tree[2 * i + 1]
+            tree[i] = right if scores[right] > scores[left] else left
+        return self._store_derived('completions', generation, (names, scores, tree, size))
+
+    def _scope_table(self):
+        """Return every scope below (and including) this one, with precomputed scoring data.
+
+        Scopes reachable by several paths (see dedupe() and PACKAGE_ALIASES)
+        are listed once per path, in depth first order, as (scope, scale,
+        boost, dotted path, path segments, bounds). No match in the scope for
+        a symbol of n segments can score more than
+        bounds[min(n, _BOUNDED_SEGMENTS) - 1]. The table is cached until the
+        index changes.
+        """
+        table = self._derived('scopes')
+        if table is not None:
+            return table
+        generation = self._root._state.generation
+        upper_bounds = {}
+
+        # The highest score _score_key() can return for scope, with a key of
+        # up to segments segments (or any key if None).
+        def upper_bound(scope, segments):
+            boost = scope.boost()
+            key = (id(scope._tree), boost, segments)
+            if key not in upper_bounds:
+                bound = 0.0
+                if segments != 0:
+                    rest = None if segments is None else segments - 1
+                    for value in scope._tree.values():
+                        if type(value) is float:
+                            bound = max(bound, value * boost)
+                        else:
+                            bound = max(bound, (upper_bound(value, rest) + value.score) * boost)
+                upper_bounds[key] = bound
+            return upper_bounds[key]
+
+        def bounds(scope, scale):
+            if scale < 0:
+                # Matches only count if their unscaled score is > 0.1.
+                return [0.1 * scale] * _BOUNDED_SEGMENTS
+            return [upper_bound(scope, segments) * scale for segments in _SEGMENT_LIMITS]
+
+        table = []
+        stack = [(self, 1.0, '')]
+        while stack:
+            scope, scale, path = stack.pop()
+            table.append((scope, scale, scope.boost(), path, path.split('.') if path else [],
+                          bounds(scope, scale)))
+            children = [(subscope, subscope.score * scale - 0.1, path + '.' + key if path else key)
+                        for key, subscope in list(scope._tree.items()) if type(subscope) is not float]
+            # Visit the most promising subtrees first, so that limited
+            # queries can skip more of the others.
+            children.sort(key=lambda child: upper_bound(child[0], 1) * child[1])
+            stack.extend(children)
+        return self._store_derived('scopes', generation, table)
+
+    @_locked
+    def names(self):
+        """Return the frozenset of names found in any scope of the index."""
+        return frozenset(self._positions())
+
+    def _positions(self):
+        """Map each key in any scope to the _scope_table() positions of the scopes holding it."""
+        positions = self._derived('positions')
+        if positions is not None:
+            return positions
+        generation = self._root._state.generation
+        positions = {}
+        for i, entry in enumerate(self._scope_table()):
+            for key in entry[0]._tree:
+                positions.setdefault(key, []).append(i)
+        return self._store_derived('positions', generation, positions)
+
+    def _derived(self, what):
+        # Data derived from this node by a query, eg. _scope_table(), or
+        # None if it hasn't been since the index last changed.
+        state = self._root._state
+        if state.derived_generation != state.generation:
+            return None
+        return state.derived.get((what, self))
+
+    def _store_derived(self, what, generation, data):
+        # Remember data for _derived(), unless the index changed since
+        # generation, when the computation started. Data derived from
+        # earlier versions is dropped.
+        state = self._root._state
+        if generation == state.generation:
+            if state.derived_generation != generation:
+                state.derived = {}
+                state.derived_generation = generation
+            state.derived[(what, self)] = data
+        return data
+
+    def _touch(self):
+        self._root._state.generation += 1
+
+    def _touch_names(self):
+        # _touch() after a change to names, not subtrees, which leaves
+        # _nodes() as it is.
+        state = self._root._state
+        nodes_at = state.nodes_at
+        state.generation += 1
+        if nodes_at is not None and nodes_at[0] == state.generation - 1:
+            state.nodes_at = (state.generation, nodes_at[1])
+
+    def _touch_subtree(self, name, old, new):
+        # _touch() after the entry for name changed from old to new (either
+        # may be a subtree), updating the paths below it in _nodes() instead
+        # of dropping it, unless this node is reachable by several paths.
+        state = self._root._state
+        nodes_at = state.nodes_at
+        state.generation += 1
+        if nodes_at is None or nodes_at[0] != state.generation - 1:
+            return
+        nodes = nodes_at[1]
+        # Otherwise this node is not (or no longer) in the index.
+        if nodes.get(self._path) is self:
+            node = self
+            while node is not None:
+                if node._shared or node._path in SymbolIndex._ALIASED:
+                    return
+                node = node._parent
+            path = self._path + '.' + name if self._path else name
+            if isinstance(old, SymbolIndex):
+                for key, _ in old._walk_nodes(path):
+                    nodes.pop(key, None)
+            if isinstance(new, SymbolIndex):
+                nodes.update(new._walk_nodes(path))
+        state.nodes_at = (state.generation, nodes)
+
+    def _walk_nodes(self, path):
+        # Yield (dotted path, node) for this node, at path, and every node below it.
+        stack = [(path, self)]
+        while stack:
+            path, node = stack.pop()
+            yield path, node
+            stack.extend((path + '.' + key if path else key, value)
+                         for key, value in list(node._tree.items()) if type(value) is not float)
 
     def depth(self):
         depth = 0
@@ -299,66 +1479,127 @@ class SymbolIndex(object):
         return depth
 
     def path(self):
-        path = []
-        node = self
-        while node and node._name:
-            path.append(node._name)
-            node = node._parent
-        return '.'.join(reversed(path))
+        return self._path
 
     def add_explicit_export(self, name, score):
         self._exports[name] = score
         self.add(name, score)
 
+    @_locked
     def find(self, path):
         """Return the node for a path, or None."""
-        path = path.split('.')
-        node = self
-        while node._parent:
-            node = node._parent
-        for name in path:
-            node = node._tree.get(name, None)
-            if node is None or type(node) is float:
-                return None
-        return node
+        if not path:
+            return None
+        return self._nodes().get(path)
 
+    @_locked
     def location_for(self, path):
         """Return the location code for a path."""
-        path = path.split('.')
-        node = self
-        while node._parent:
-            node = node._parent
-        location = node.location
-        for name in path:
-            tree = node._tree.get(name, None)
-            if tree is None or type(tree) is float:
-                return location
-            location = tree.location
-        return location
-
-    def add(self, name, score):
+        nodes = self._nodes()
+        while path:
+            node = nodes.get(path)
+            if node is not None:
+                return node.location
+            path = path.rpartition('.')[0]
+        return self._root.location
+
+    def _nodes(self):
+        """Map the dotted path of every node in the index, including aliases, to the node."""
+        root = self._root
+        state = root._state
+        if state.nodes_at is not None and state.nodes_at[0] == state.generation:
+            return state.nodes_at[1]
+        nodes = dict(root._walk_nodes(''))
+        state.nodes_at = (state.generation, nodes)
+        return nodes
+
+    def add(self, name, score, kind=None):
+        """Add a name to the scope, keeping the highest score it is added with.
+
+        :param kind: The KINDS code of the name, if known. It replaces the
+            recorded kind unless the name was added with a higher score.
+        """
         current_score = self._tree.get(name, 0.0)
-        if isinstance(current_score, float) and score > current_score:
+        if not isinstance(current_score, float):
+            return
+        if score > current_score:
+            self._unshare()
             self._tree[name] = score
+            self._touch_names()
+        if kind is not None and self._kinds.get(name) != kind and \
+                (score >= current_score or name not in self._kinds):
+            self._unshare()
+            self._kinds[name] = kind
+            self._touch_names()
+
+    def _unshare(self):
+        # Give this subtree its own copy of a table shared by dedupe(), before
+        # changing it. The subtrees in the table are replaced by subtrees of
+        # this copy, with the right parent and path, that share their tables
+        # in turn.
+        if not self._shared:
+            return
+        self._tree = dict((key, value if type(value) is float else value._share(key, self))
+                          for key, value in self._tree.items())
+        self._kinds = dict(self._kinds)
+        self._shared = False
+        self._touch()
+
+    def _share(self, name, parent):
+        # A subtree for name under parent, sharing this one's table.
+        subtree = SymbolIndex(name, parent, score=self.score, location=self.location)
+        subtree._tree, subtree._kinds = self._tree, self._kinds
+        subtree._exports = dict(self._exports)
+        subtree._shared = self._shared = True
+        return subtree
+
+    def _unshare_all(self):
+        # _unshare() every subtree. Returns True if any table was shared.
+        unshared = self._shared
+        self._unshare()
+        for value in self._tree.values():
+            if type(value) is not float:
+                unshared = value._unshare_all() or unshared
+        return unshared
 
     @contextmanager
     def enter(self, name, location='L', score=1.0):
         if name is None:
             tree = self
         else:
+            self._unshare()
             tree = self._tree.get(name)
             if not isinstance(tree, SymbolIndex):
                 tree = self._tree[name] = SymbolIndex(name, self, score=score, location=location)
-                if tree.path() in SymbolIndex._PACKAGE_ALIASES:
-                    alias_path, _ = SymbolIndex._PACKAGE_ALIASES[tree.path()]
-                    alias = self.find(alias_path)
+                self._touch_subtree(name, None, tree)
+                if tree._path in SymbolIndex._PACKAGE_ALIASES:
+                    alias_path, _ = SymbolIndex._PACKAGE_ALIASES[tree._path]
+                    # Walk rather than find(), which would rebuild _nodes()
+                    # halfway through building the index.
+                    alias = self._root
+                    for part in alias_path.split('.'):
+                        alias = alias._tree[part]
                     alias._tree = tree._tree
+                    alias._kinds = tree._kinds
+                    self._touch()
         yield tree
-        if tree._exports:
+        tree._prune_unexported()
+
+    def _prune_unexported(self):
+        if self._exports:
             # Delete unexported variables
-            for key in set(tree._tree) - set(tree._exports):
-                del tree._tree[key]
+            unexported = set(self._tree) - set(self._exports)
+            if unexported:
+                self._unshare()
+            for key in unexported:
+                old = self._tree.pop(key)
+                self._kinds.pop(key, None)
+                if type(old) is float:
+                    self._touch_names()
+                else:
+                    self._touch_subtree(key, old, None)
 
+    @_locked
     def serialize(self, fd=None):
         if fd is None:
             return json.dumps(self, cls=JSONEncoder)
@@ -409,6 +1650,206 @@ class SymbolIndex(object):
         return 'L'
 
 
+class LayeredSymbolIndex(object):
+    """A writable local index stacked on top of read-only base indexes.
+
+    Queries go through each layer in turn, local first, without merging
+    them, so base layers (eg. the standard library, or a virtualenv's third
+    party packages) can be shared by reference between several projects.
+    Everything that modifies the index (build_index(), update_path(), ...)
+    applies to the local layer only.
+    """
+
+    def __init__(self, bases, local=None):
+        self.bases = list(bases)
+        self.local = SymbolIndex() if local is None else local
+
+    @property
+    def layers(self):
+        return [self.local] + self.bases
+
+    def build_index(self, paths, timeout=None):
+        return self.local.build_index(paths, timeout=timeout, builtins=False)
+
+    def get_or_create_index(self, paths=None, name=None, refresh=False, timeout=None):
+        """Get the local layer from the cache, creating it if needed.
+
+        See SymbolIndex.get_or_create_index().
+
+        :param name: The name to cache the local layer under. Defaults to
+            one derived from paths, which can't be that of a full index
+            (eg. the default one).
+        """
+        if not paths:
+            paths = sys.path
+        if name is None:
+            key = json.dumps([os.path.abspath(path or '.') for path in paths])
+            name = 'local-' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.local.get_or_create_index(paths=paths, name=name, refresh=refresh,
+                                       timeout=timeout, builtins=False)
+        return self
+
+    def symbol_scores(self, symbol, limit=None, kinds=None):
+        """Find matches for symbol in all layers.
+
+        See SymbolIndex.symbol_scores(). A match found in several layers is
+        returned once, with its highest score.
+        """
+        return self.symbol_scores_many([symbol], limit=limit, kinds=kinds)[symbol]
+
+    def symbol_scores_many(self, symbols, limit=None, kinds=None):
+        """Find matches for several symbols in all layers.
+
+        See SymbolIndex.symbol_scores_many() and symbol_scores().
+        """
+        symbols = list(symbols)
+        best = {symbol: {} for symbol in symbols}
+        for layer in self.layers:
+            for symbol, scores in layer.symbol_scores_many(symbols, limit=limit,
+                                                           kinds=kinds).items():
+                for score, module, variable in scores:
+                    key = (module, variable)
+                    if key not in best[symbol] or score > best[symbol][key]:
+                        best[symbol][key] = score
+        results = {}
+        for symbol, matches in best.items():
+            scores = [(score, module, variable) for (module, variable), score in matches.items()]
+            scores.sort(reverse=True)
+            results[symbol] = scores if limit is None else scores[:limit]
+        return results
+
+    def complete(self, prefix, limit=10):
+        """Find the best matches for names starting with prefix, in all layers.
+
+        See SymbolIndex.complete().
+        """
+        best = {}
+        for layer in self.layers:
+            for score, module, variable in layer.complete(prefix, limit=limit):
+                key = (module, variable)
+                if key not in best or score > best[key]:
+                    best[key] = score
+        results = [(score, module, variable) for (module, variable), score in best.items()]
+        results.sort(reverse=True)
+        return results[:limit]
+
+    def fuzzy(self, name, max_distance=2, limit=10):
+        """Find the best matches for names within a few typos of name, in all layers.
+
+        See SymbolIndex.fuzzy().
+        """
+        found = {}
+        for layer in self.layers:
+            for distance, match in layer._fuzzy(name, max_distance, limit):
+                key = (distance, -match[0])
+                if match[1:] not in found or key < found[match[1:]][0]:
+                    found[match[1:]] = (key, match)
+        return [match for _, match in sorted(found.values())][:limit]
+
+    def names(self):
+        """Return the frozenset of names found in any layer."""
+        return frozenset().union(*(layer.names() for layer in self.layers))
+
+    def find(self, path):
+        """Return the node for a path from the first layer that has it, or None."""
+        found = None
+        for layer in self.layers:
+            node = layer.find(path)
+            # Every layer has (usually empty) nodes for the package aliases.
+            if node is not None and node._tree:
+                return node
+            found = found or node
+        return found
+
+    def location_for(self, path):
+        """Return the location code for a path."""
+        top = path.split('.', 1)[0]
+        for layer in self.layers:
+            node = layer.find(top)
+            if node is not None and node._tree:
+                return layer.location_for(path)
+        return self.local.location_for(path)
+
+    def __getattr__(self, name):
+        return getattr(self.local, name)
+
+
+class BackgroundIndex(object):
+    """An index that can be queried immediately while it is built in the background.
+
+    Queries are answered straight away by a cached index if there is one
+    (possibly partial, see SymbolIndex.build_index()), otherwise by an index
+    built within initial_timeout seconds, in INITIAL_BUILD_PRIORITY order.
+
+    A daemon thread then carries on building a private copy of that index
+    from where it stopped, caches it once it is complete, and swaps it in.
+    Queries never see an index that is being built. ready is a Future
+    resolving to the full index. Use it or callback to re-run resolution.
+
+    Other keyword arguments are passed to the SymbolIndex constructor.
+    """
+
+    def __init__(self, paths=None, name=None, refresh=False, initial_timeout=0.5,
+                 callback=None, **kwargs):
+        if not paths:
+            paths = sys.path
+        self.ready = Future()
+        if callback is not None:
+            self.ready.add_done_callback(lambda future: callback(self))
+        self._index, complete = self._initial_index(paths, name, refresh, initial_timeout, kwargs)
+        if complete:
+            self.ready.set_result(self._index)
+            return
+        thread = threading.Thread(target=self._build, args=(self._index, paths, name, kwargs),
+                                  name='importmagic-index')
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def index(self):
+        """The SymbolIndex currently answering queries."""
+        return self._index
+
+    def is_ready(self):
+        return self.ready.done()
+
+    def wait(self, timeout=None):
+        """Block until the full index is ready and return it."""
+        return self.ready.result(timeout)
+
+    def _initial_index(self, paths, name, refresh, timeout, kwargs):
+        index = SymbolIndex(**kwargs)
+        idx_file = get_index_file(name)
+        if os.path.exists(idx_file) and not refresh and index._load_cache(idx_file):
+            if index.is_complete():
+                index.dedupe()
+                return index, True
+            return index, False
+        # Even if this finishes in time it is still written out in the
+        # background, so that the index is cached.
+        index.build_index(paths, timeout=timeout, priority=INITIAL_BUILD_PRIORITY)
+        return index, False
+
+    def _build(self, initial, paths, name, kwargs):
+        try:
+            # The initial index no longer changes, so it can be copied while
+            # it answers queries. The copy resumes its plan.
+            index = SymbolIndex(**kwargs)
+            index._load(json.loads(initial.serialize()))
+            if not index.is_complete():
+                index.build_index(paths)
+            index._write(get_index_file(name))
+        except Exception as e:
+            logger.exception('failed to build index in the background')
+            self.ready.set_exception(e)
+            return
+        self._index = index
+        self.ready.set_result(index)
+
+    def __getattr__(self, name):
+        return getattr(self._index, name)
+
+
 class SymbolVisitor(ast.NodeVisitor):
     def __init__(self, tree):
         self._tree = tree
@@ -417,21 +1858,21 @@ class SymbolVisitor(ast.NodeVisitor):
         for name in node.names:
             if name.name == '*' or name.name.startswith('_'):
                 continue
-            self._tree.add(name.name, 0.25)
+            self._tree.add(name.name, REIMPORT_SCORE, 'i')
 
     def visit_Import(self, node):
         for name in node.names:
             if name.name.startswith('_'):
                 continue
-            self._tree.add(name.name, 0.25)
+            self._tree.add(name.name, REIMPORT_SCORE, 'i')
 
     def visit_ClassDef(self, node):
         if not node.name.startswith('_'):
-            self._tree.add(node.name, 1.1)
+            self._tree.add(node.name, 1.1, 'c')
 
     def visit_FunctionDef(self, node):
         if not node.name.startswith('_'):
-            self._tree.add(node.name, 1.1)
+            self._tree.add(node.name, 1.1, 'f')
 
     def visit_Assign(self, node):
         # TODO: Handle __all__
@@ -442,7 +1883,7 @@ class SymbolVisitor(ast.NodeVisitor):
                     if isinstance(subnode, ast.Constant):
                         self._tree.add_explicit_export(subnode.value, 1.2)
             elif not name.id.startswith('_'):
-                self._tree.add(name.id, 1.1)
+                self._tree.add(name.id, 1.1, 'v')
 
     def visit_If(self, node):
         # NOTE: In lieu of actually parsing if/else blocks at the top-level,
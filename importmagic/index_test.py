@@ -1,11 +1,18 @@
 from __future__ import absolute_import
 
+import fnmatch
 import json
+import os
 import re
+import sys
+import threading
 from textwrap import dedent
 
-from importmagic.index import SymbolIndex
-from importmagic.six import b
+from importmagic.index import (
+    INITIAL_BUILD_PRIORITY, BackgroundIndex, LayeredSymbolIndex, SymbolIndex,
+    get_index_rules_from_config)
+from importmagic.six import StringIO, b
+from importmagic.util import edit_distance, parse_ast
 
 
 def serialize(tree):
@@ -44,10 +51,12 @@ def test_index_filesystem(tmpdir):
     assert serialize(subtree) == {
         ".location": "L",
         ".score": 1.0,
+        ".kinds": "c",
         "Cls": 1.1,
         "submod": {".location": "L", ".score": 1.0,
+                   ".kinds": "fii",
                    "func": 1.1, "sys": 0.25, "path": 0.25},
-        "encoded": {".location": "L", ".score": 1.0,
+        "encoded": {".location": "L", ".score": 1.0, ".kinds": "f",
                     "foo": 1.1}}
 
 
@@ -62,7 +71,7 @@ def test_index_file_with_all():
     tree = SymbolIndex()
     with tree.enter('test') as subtree:
         subtree.index_source('test.py', src)
-    assert serialize(subtree) == {".location": "L", ".score": 1.0, "one": 1.2}
+    assert serialize(subtree) == {".location": "L", ".score": 1.0, ".kinds": "v", "one": 1.2}
 
 
 def test_index_if_name_main():
@@ -114,3 +123,788 @@ def test_encoding_score(index):
 def test_score_boosts_apply_to_scopes(index):
     print(index.symbol_scores('basename'))
     assert index.symbol_scores('basename')[0][1:] == ('os.path', 'basename')
+
+
+# pytest's tmpdir names would match DEFAULT_BLACKLIST_RE.
+NO_BLACKLIST = re.compile('mytest_')
+
+
+def _make_build_roots(tmpdir):
+    version = 'python{}.{}'.format(*sys.version_info[:2])
+    local = tmpdir.mkdir('project')
+    local.join('localmod.py').write('def local_func():\n pass\n')
+    stdlib = tmpdir.mkdir('lib').mkdir(version)
+    stdlib.join('stdmod.py').write('def std_func():\n pass\n')
+    third = tmpdir.mkdir('site-packages')
+    third.join('thirdmod.py').write('def third_func():\n pass\n')
+    return [str(third), str(stdlib), str(local)]
+
+
+def test_index_build_priority(tmpdir):
+    third, stdlib, local = _make_build_roots(tmpdir)
+    tree = SymbolIndex()
+    assert tree.build_index([third, stdlib, local], timeout=0) is False
+    assert tree.incomplete_roots == [local, '<builtins>', stdlib, third]
+
+
+def test_index_build_resumes_after_timeout(tmpdir):
+    paths = _make_build_roots(tmpdir)
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST)
+    assert not tree.build_index(paths, timeout=0)
+    pending = serialize(tree)['.pending']
+    assert [root for root, _ in pending] == tree.incomplete_roots
+
+    resumed = SymbolIndex.deserialize(StringIO(tree.serialize()))
+    resumed._blacklist_re = NO_BLACKLIST
+    assert resumed.incomplete_roots == tree.incomplete_roots
+    # Resuming ignores the paths argument and finishes the recorded plan.
+    assert resumed.build_index([])
+    assert resumed.is_complete()
+    assert '.pending' not in serialize(resumed)
+    for module in ('localmod', 'stdmod', 'thirdmod'):
+        assert module in resumed._tree
+
+
+def test_index_build_times_out_inside_package(tmpdir, monkeypatch):
+    root = tmpdir.mkdir('project')
+    pkg = root.mkdir('pkg')
+    pkg.join('__init__.py').write('')
+    sub = pkg.mkdir('sub')
+    sub.join('__init__.py').write('')
+    for name in ('a', 'b'):
+        sub.join('%s.py' % name).write('def %s_func():\n pass\n' % name)
+    pkg.join('z.py').write('def z_func():\n pass\n')
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST)
+    index_file = SymbolIndex.index_file
+
+    def index_file_then_expire(self, module, filename):
+        index_file(self, module, filename)
+        if module == 'a':
+            self._root._state.deadline = 0
+
+    monkeypatch.setattr(SymbolIndex, 'index_file', index_file_then_expire)
+    assert not tree.build_index([str(root)], timeout=60, builtins=False)
+    assert tree.find('pkg.sub.a') is not None
+    assert tree.find('pkg.sub.b') is None
+    assert serialize(tree)['.pending'] == [
+        [str(root), [os.path.join('pkg', 'sub', 'b.py'), os.path.join('pkg', 'z.py')]]]
+
+    monkeypatch.setattr(SymbolIndex, 'index_file', index_file)
+    assert tree.build_index([])
+    for module in ('pkg.sub.a', 'pkg.sub.b', 'pkg.z'):
+        assert tree.find(module) is not None
+
+
+def test_index_build_priority_puts_missing_locations_last(tmpdir):
+    third, stdlib, local = _make_build_roots(tmpdir)
+    tree = SymbolIndex()
+    assert not tree.build_index([third, stdlib, local], timeout=0, priority='3')
+    # The others keep their order.
+    assert tree.incomplete_roots == [third, '<builtins>', stdlib, local]
+
+
+def test_index_file_respects_umask(tmpdir):
+    umask = os.umask(0o022)
+    try:
+        SymbolIndex()._write(str(tmpdir.join('index.json')))
+    finally:
+        os.umask(umask)
+    assert tmpdir.join('index.json').stat().mode & 0o777 == 0o644
+    assert tmpdir.listdir() == [tmpdir.join('index.json')]
+
+
+def test_get_or_create_index_resumes_partial_index(tmpdir, monkeypatch):
+    monkeypatch.setattr('importmagic.index.get_cache_dir', lambda: str(tmpdir))
+    paths = _make_build_roots(tmpdir)
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST).get_or_create_index(paths=paths, name='partial', timeout=0)
+    assert not tree.is_complete()
+    with open(str(tmpdir.join('partial.json'))) as fd:
+        assert '.pending' in json.load(fd)
+
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST).get_or_create_index(paths=paths, name='partial')
+    assert tree.is_complete()
+    assert tree.find('localmod') is not None
+    cached = SymbolIndex(blacklist_re=NO_BLACKLIST).get_or_create_index(paths=paths, name='partial')
+    assert cached.location_for('thirdmod') == '3'
+    assert cached.symbol_scores('std_func')[0][1:] == ('stdmod', 'std_func')
+
+
+def test_background_index_swaps_in_full_index(tmpdir, monkeypatch):
+    monkeypatch.setattr('importmagic.index.get_cache_dir', lambda: str(tmpdir))
+    paths = _make_build_roots(tmpdir)
+    notified = threading.Event()
+    handle = BackgroundIndex(paths=paths, name='background', initial_timeout=0,
+                             callback=lambda h: notified.set(), blacklist_re=NO_BLACKLIST)
+    # Usable straight away, even though nothing has been indexed yet.
+    assert handle.symbol_scores('third_func') is not None
+    index = handle.wait(timeout=60)
+    assert handle.is_ready()
+    assert handle.index is index
+    assert notified.wait(timeout=60)
+    assert handle.symbol_scores('third_func')[0][1:] == ('thirdmod', 'third_func')
+    assert tmpdir.join('background.json').check()
+
+    # A complete cached index is ready immediately.
+    cached = BackgroundIndex(paths=paths, name='background', blacklist_re=NO_BLACKLIST)
+    assert cached.is_ready()
+    assert cached.location_for('localmod') == 'L'
+
+
+def test_background_index_builds_stdlib_first_and_loads_cache_once(tmpdir, monkeypatch):
+    monkeypatch.setattr('importmagic.index.get_cache_dir', lambda: str(tmpdir))
+    third, stdlib, local = _make_build_roots(tmpdir)
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST)
+    assert not tree.build_index([third, stdlib, local], timeout=0, priority=INITIAL_BUILD_PRIORITY)
+    assert tree.incomplete_roots == ['<builtins>', stdlib, local, third]
+    tree._write(str(tmpdir.join('background.json')))
+
+    loads = []
+    load_cache = SymbolIndex._load_cache
+    monkeypatch.setattr(SymbolIndex, '_load_cache',
+                        lambda self, filename: loads.append(filename) or load_cache(self, filename))
+    handle = BackgroundIndex(paths=[third, stdlib, local], name='background',
+                             blacklist_re=NO_BLACKLIST)
+    index = handle.wait(timeout=60)
+    assert index.is_complete()
+    assert index.find('thirdmod') is not None
+    assert len(loads) == 1
+
+
+def test_background_index_answers_queries_during_build(tmpdir, monkeypatch):
+    monkeypatch.setattr('importmagic.index.get_cache_dir', lambda: str(tmpdir))
+    root = tmpdir.mkdir('project')
+    for i in range(200):
+        root.join('mod%d.py' % i).write(''.join('def f%d_%d():\n pass\n' % (i, j) for j in range(20)))
+    handle = BackgroundIndex(paths=[str(root)], name='queried', initial_timeout=0,
+                             blacklist_re=NO_BLACKLIST)
+    initial = handle.index
+    errors = []
+    queries = [0]
+
+    def query():
+        while not handle.is_ready():
+            try:
+                handle.symbol_scores('f10_0')
+                handle.symbol_scores_many(['f1_1', 'mod3.f3_3'])
+                handle.complete('f1')
+                handle.fuzzy('f1_0x')
+                handle.find('mod5')
+            except Exception as e:
+                errors.append(e)
+            queries[0] += 1
+
+    thread = threading.Thread(target=query)
+    thread.start()
+    index = handle.wait(timeout=60)
+    thread.join()
+    assert queries[0] and not errors
+    assert handle.index is index and index is not initial
+    assert initial.find('mod5') is None
+    assert handle.symbol_scores('f10_0')[0][1:] == ('mod10', 'f10_0')
+
+
+def test_layered_index_shares_bases(index, tmpdir):
+    projects = []
+    for name in ('one', 'two'):
+        root = tmpdir.mkdir(name)
+        root.join('%s_mod.py' % name).write('def %s_func():\n pass\n' % name)
+        layered = LayeredSymbolIndex([index])
+        layered.local._blacklist_re = NO_BLACKLIST
+        assert layered.build_index([str(root)])
+        projects.append(layered)
+    one, two = projects
+    assert one.bases[0] is two.bases[0] is index
+    # Builtin modules are only indexed in the base layers.
+    assert one.local.find('sys') is None
+
+    assert one.symbol_scores('one_func')[0][1:] == ('one_mod', 'one_func')
+    assert not two.symbol_scores('one_func')
+    assert one.symbol_scores('basename')[0][1:] == ('os.path', 'basename')
+    assert one.symbol_scores('os') == index.symbol_scores('os')
+    assert one.complete('one_f') == one.symbol_scores('one_func', limit=1)
+    assert one.complete('Canv', limit=1) == index.complete('Canv', limit=1)
+    assert one.fuzzy('one_fnuc') == one.symbol_scores('one_func', limit=1)
+    assert one.fuzzy('basenme', limit=3) == index.fuzzy('basenme', limit=3)
+    assert one.symbol_scores_many(['one_func', 'os'], limit=1) == {
+        'one_func': one.symbol_scores('one_func', limit=1), 'os': index.symbol_scores('os', limit=1)}
+    assert one.find('os.path') is index.find('os.path')
+    assert one.find('one_mod') is one.local.find('one_mod')
+    assert one.names() == index.names() | one.local.names()
+    assert isinstance(one.names(), frozenset) and isinstance(index.names(), frozenset)
+    assert one.location_for('one_mod') == 'L'
+    assert one.location_for('os.path') == 'S'
+    assert one.location_for('unknown.module') == 'L'
+    assert index.find('one_mod') is None
+
+
+def test_layered_index_leaves_default_cache_alone(tmpdir, monkeypatch, index):
+    monkeypatch.setattr('importmagic.index.get_cache_dir', lambda: str(tmpdir))
+    default = tmpdir.join('default.json')
+    default.write(index.serialize())
+    project = tmpdir.mkdir('project')
+    project.join('projmod.py').write('def proj_func():\n pass\n')
+    layered = LayeredSymbolIndex([index])
+    layered.local._blacklist_re = NO_BLACKLIST
+    layered.get_or_create_index(paths=[str(project)])
+    assert layered.symbol_scores('proj_func')[0][1:] == ('projmod', 'proj_func')
+    assert default.read() == index.serialize()
+    cached = [f.basename for f in tmpdir.listdir() if f.basename.startswith('local-')]
+    assert len(cached) == 1
+
+    other = tmpdir.mkdir('other')
+    LayeredSymbolIndex([index]).get_or_create_index(paths=[str(other)])
+    assert len([f for f in tmpdir.listdir() if f.basename.startswith('local-')]) == 2
+
+
+def test_dedupe_shares_identical_subtrees():
+    tree = SymbolIndex()
+    for vendor in ('pip', 'setuptools'):
+        with tree.enter(vendor, location='3') as pkg:
+            with pkg.enter('vendored', location='3') as vendored:
+                with vendored.enter('six', location='3') as six:
+                    six.add('moves', 1.1)
+                    six.add('with_metaclass', 1.1)
+                vendored.add('other', 1.1)
+            pkg.add(vendor + '_main', 1.1)
+    before = serialize(tree)
+    scores = tree.symbol_scores('with_metaclass')
+
+    stats = tree.dedupe()
+    # vendored and vendored.six
+    assert stats['subtrees'] == 2
+    assert stats['entries'] == 4
+    assert stats['bytes'] > 0
+    assert tree.find('pip.vendored')._tree is tree.find('setuptools.vendored')._tree
+    assert serialize(tree) == before
+    assert tree.symbol_scores('with_metaclass') == scores
+    assert sorted(s[1] for s in scores) == ['pip.vendored.six', 'setuptools.vendored.six']
+    assert tree.location_for('setuptools.vendored.six') == '3'
+    assert tree.dedupe()['subtrees'] == 0
+
+
+def test_dedupe_copies_shared_tables_on_write(tmpdir):
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST)
+    for vendor in ('pip', 'setuptools'):
+        with tree.enter(vendor, location='3') as pkg:
+            with pkg.enter('vendored', location='3') as vendored:
+                with vendored.enter('six', location='3') as six:
+                    six.add('moves', 1.1)
+                vendored.add('other', 1.1)
+    tree.dedupe()
+
+    with tree.enter('pip') as pip, pip.enter('vendored') as vendored:
+        vendored.add('only_pip', 1.1)
+        with vendored.enter('six') as six:
+            assert six.path() == 'pip.vendored.six'
+            six.add('only_pip_six', 1.1)
+    assert tree.find('pip.vendored.only_pip') is None
+    assert tree.symbol_scores('only_pip')[0][1:] == ('pip.vendored', 'only_pip')
+    assert tree.symbol_scores('only_pip_six')[0][1:] == ('pip.vendored.six', 'only_pip_six')
+    assert 'only_pip' not in tree.find('setuptools.vendored')._tree
+    assert 'only_pip_six' not in tree.find('setuptools.vendored.six')._tree
+
+    tree.dedupe()
+    root = tmpdir.mkdir('site-packages')
+    six = root.mkdir('setuptools').mkdir('vendored').join('six.py')
+    six.write('def only_setuptools():\n pass\n')
+    assert tree.update_path(str(root), str(six))
+    assert tree.symbol_scores('only_setuptools')[0][1:] == \
+        ('setuptools.vendored.six', 'only_setuptools')
+    assert tree.symbol_scores('moves')[0][1:] == ('pip.vendored.six', 'moves')
+    assert tree.find('setuptools.vendored.six').path() == 'setuptools.vendored.six'
+
+    tree.find('pip').prune(max_leaves_per_module=0)
+    assert [s[1] for s in tree.symbol_scores('other')] == ['setuptools.vendored']
+
+
+def test_replace_module_copies_shared_tables():
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST)
+    for vendor in ('pip', 'setuptools'):
+        with tree.enter(vendor, location='3') as pkg:
+            with pkg.enter('vendored', location='3') as vendored:
+                with vendored.enter('six', location='3') as six:
+                    six.add('moves', 1.1)
+                vendored.add('other', 1.1)
+    tree.dedupe()
+
+    tree.replace_module(['pip', 'vendored', 'six'], parse_ast('def only_pip():\n pass\n'),
+                        location='3')
+    assert tree.symbol_scores('only_pip')[0][1:] == ('pip.vendored.six', 'only_pip')
+    assert [s[1] for s in tree.symbol_scores('moves')] == ['setuptools.vendored.six']
+
+    # A package's own names are replaced, keeping its modules.
+    tree.dedupe()
+    tree.replace_module(['setuptools', 'vendored'], parse_ast('mine = 1\n'), location='3',
+                        package=True)
+    assert tree.symbol_scores('mine')[0][1:] == ('setuptools.vendored', 'mine')
+    assert [s[1] for s in tree.symbol_scores('other')] == ['pip.vendored']
+    assert tree.find('setuptools.vendored.six') is not None
+
+    assert tree.replace_module(['pip', 'vendored'], None)
+    assert tree.find('pip.vendored') is None
+    assert tree.find('setuptools.vendored.six') is not None
+    assert not tree.replace_module(['missing', 'module'], None)
+
+
+def test_dedupe_keeps_symbol_scores(index):
+    tree = SymbolIndex()
+    with open(os.path.join(os.path.dirname(__file__), 'test_index.json')) as fd:
+        tree._load(json.load(fd))
+    symbols = ['basename', 'os.path.join', 'Codec', 'iso8859_6.Codec', 'error', 'open']
+    scores = [tree.symbol_scores(symbol) for symbol in symbols]
+    assert tree.dedupe()['subtrees'] > 0
+    assert [tree.symbol_scores(symbol) for symbol in symbols] == scores
+
+
+def test_index_exclude_rules(tmpdir):
+    pkg = tmpdir.mkdir('pkg')
+    pkg.join('__init__.py').write('')
+    pkg.join('mod.py').write('def func():\n pass\n')
+    vendored = pkg.mkdir('vendored')
+    vendored.join('__init__.py').write('')
+    vendored.join('six.py').write('def with_metaclass():\n pass\n')
+    vendored.join('requests.py').write('def get():\n pass\n')
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST, exclude=['*.vendored.*', re.compile('pkg.mod$')],
+                       include=['pkg.vendored.six'])
+    tree.build_index([str(tmpdir)], builtins=False)
+    assert tree.find('pkg.vendored.six') is not None
+    assert tree.find('pkg.vendored.requests') is None
+    assert tree.find('pkg.mod') is None
+    assert serialize(tree)['.exclude'] == [fnmatch.translate('*.vendored.*'), 'pkg.mod$']
+    assert SymbolIndex.deserialize(StringIO(tree.serialize()))._is_excluded('pkg.mod')
+
+    tree.update_path(str(tmpdir), str(vendored.join('requests.py')))
+    assert tree.find('pkg.vendored.requests') is None
+
+
+def test_index_include_rules_below_excluded_package(tmpdir):
+    # The example from the README.
+    pkg = tmpdir.mkdir('pkg')
+    pkg.join('__init__.py').write('')
+    vendored = pkg.mkdir('vendored')
+    vendored.join('__init__.py').write('def vendored_func():\n pass\n')
+    vendored.join('six.py').write('def with_metaclass():\n pass\n')
+    vendored.join('requests.py').write('def get():\n pass\n')
+    other = pkg.mkdir('other')
+    other.join('__init__.py').write('')
+    other.mkdir('vendored').join('__init__.py').write('def other_func():\n pass\n')
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST, exclude=['*.vendored', 'botocore.data*'],
+                       include=['*.vendored.six'])
+    tree.build_index([str(tmpdir)], builtins=False)
+    assert tree.find('pkg.vendored.six') is not None
+    assert tree.symbol_scores('with_metaclass')[0][1:] == ('pkg.vendored.six', 'with_metaclass')
+    assert tree.find('pkg.vendored.requests') is None
+    assert tree.symbol_scores('vendored_func') == []
+    assert tree.find('pkg.other.vendored') is None
+
+    vendored.join('six.py').write('def add_metaclass():\n pass\n')
+    assert tree.update_path(str(tmpdir), str(vendored.join('six.py')))
+    assert tree.symbol_scores('add_metaclass')[0][1:] == ('pkg.vendored.six', 'add_metaclass')
+    assert not tree.update_path(str(tmpdir), str(vendored.join('requests.py')))
+
+
+def test_get_or_create_index_rebuilds_when_rules_change(tmpdir, monkeypatch):
+    monkeypatch.setattr('importmagic.index.get_cache_dir', lambda: str(tmpdir))
+    root = tmpdir.mkdir('root')
+    root.join('keep.py').write('def keep():\n pass\n')
+    root.join('skip.py').write('def skip():\n pass\n')
+
+    def create(**rules):
+        return SymbolIndex(blacklist_re=NO_BLACKLIST, **rules).get_or_create_index(
+            paths=[str(root)], name='rules', builtins=False)
+
+    assert create(exclude=['skip']).find('skip') is None
+    root.join('keep.py').remove()
+    # Same rules: served from the cache.
+    assert create(exclude=['skip']).find('keep') is not None
+    # Changed rules: rebuilt.
+    tree = create()
+    assert tree.find('skip') is not None
+    assert tree.find('keep') is None
+
+
+def test_index_rules_from_config(tmpdir):
+    tmpdir.join('setup.cfg').write(dedent('''
+        [importmagic]
+        exclude = *.vendored, botocore.data
+          *.tests
+        '''))
+    assert get_index_rules_from_config(str(tmpdir)) == {
+        'exclude': ['*.vendored', 'botocore.data', '*.tests'],
+        'include': [],
+    }
+    assert get_index_rules_from_config(str(tmpdir.mkdir('empty'))) == {'exclude': [], 'include': []}
+
+
+def _load_test_index():
+    with open(os.path.join(os.path.dirname(__file__), 'test_index.json')) as fd:
+        return SymbolIndex.deserialize(fd)
+
+
+def test_prune_keeps_top_answers():
+    tree = _load_test_index()
+    corpus = set()
+
+    def collect(node, path):
+        for key, value in node._tree.items():
+            corpus.add(key)
+            if path:
+                corpus.add(path[-1] + '.' + key)
+            if type(value) is not float:
+                collect(value, path + [key])
+
+    collect(tree, [])
+    # A sample keeps the test quick, all of them give the same answers too.
+    corpus = sorted(corpus)[::50]
+
+    def answers():
+        # The (module, variable) that would be imported for each symbol.
+        return [[score[1:] for score in tree.symbol_scores(symbol)[:1]] for symbol in corpus]
+
+    expected = answers()
+    original = tree.serialize()
+
+    stats = tree.prune()
+    assert stats['leaves'] > 0
+    assert answers() == expected
+
+    pruned = tree.serialize()
+    assert len(pruned) < len(original)
+    # Load time is proportional to the number of entries loaded, timings
+    # are too noisy to assert on (see benchmarks/prune.py).
+    assert _count_entries(SymbolIndex.deserialize(StringIO(pruned))) < \
+        _count_entries(SymbolIndex.deserialize(StringIO(original)))
+
+
+def _count_entries(tree):
+    return sum(1 + (_count_entries(value) if type(value) is not float else 0)
+               for value in tree._tree.values())
+
+
+def test_prune_policies():
+    tree = SymbolIndex()
+    with tree.enter('pkg', location='3') as pkg:
+        with pkg.enter('mod') as mod:
+            for i in range(5):
+                mod.add('name%d' % i, 1.0 + i / 10.0)
+            with mod.enter('deep') as deep:
+                deep.add('deeper', 1.1)
+    stats = tree.prune(max_leaves_per_module=2, max_depth=2)
+    assert stats == {'leaves': 3, 'subtrees': 1}
+    assert sorted(tree.find('pkg.mod')._tree) == ['name3', 'name4']
+    tree.prune(max_leaves=1)
+    assert sorted(tree.find('pkg.mod')._tree) == ['name4']
+
+
+def test_build_with_prune_policy(tmpdir):
+    tmpdir.join('one.py').write('import shared\ndef shared():\n pass\n')
+    tmpdir.join('two.py').write('def shared():\n pass\n')
+    tmpdir.join('three.py').write('import shared\n')
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST, prune={'max_leaves_per_module': 10})
+    tree.build_index([str(tmpdir)], builtins=False)
+    assert tree.find('one')._tree == {'shared': 1.1}
+    assert tree.find('three')._tree == {}
+    assert serialize(tree)['.prune']['max_leaves_per_module'] == 10
+
+
+def _recursive_symbol_scores(index, symbol):
+    # The original, recursive, implementation of SymbolIndex.symbol_scores().
+    scores = []
+    path = []
+
+    def fixup(module, variable):
+        prefix = module.split('.')
+        if variable is not None:
+            prefix.append(variable)
+        seeking = symbol.split('.')
+        new_module = []
+        while prefix and seeking[0] != prefix[0]:
+            new_module.append(prefix.pop(0))
+        if new_module:
+            module, variable = '.'.join(new_module), prefix[0]
+        else:
+            variable = None
+        return module, variable
+
+    def score_walk(scope, scale):
+        sub_path, score = index._score_key(scope, full_key)
+        if score > 0.1:
+            try:
+                i = sub_path.index(None)
+                sub_path, from_symbol = sub_path[:i], '.'.join(sub_path[i + 1:])
+            except ValueError:
+                from_symbol = None
+            package_path = '.'.join(path + sub_path)
+            package_path, from_symbol = fixup(package_path, from_symbol)
+            scores.append((score * scale, package_path, from_symbol))
+
+        for key, subscope in scope._tree.items():
+            if type(subscope) is not float:
+                path.append(key)
+                score_walk(subscope, subscope.score * scale - 0.1)
+                path.pop()
+
+    full_key = symbol.split('.')
+    score_walk(index, 1.0)
+    scores.sort(reverse=True)
+    return scores
+
+
+def test_symbol_scores_matches_recursive_walk(index):
+    symbols = ['basename', 'os', 'os.path', 'os.path.join', 'path.join', 'sys.path', 'Error',
+               'iso8859_6.Codec', 'encodings.iso8859_6', 'unknown', 'os.path.basename.unknown',
+               '__future__', 'print_function', 'Canvas.Canvas', 'walk']
+    for symbol in symbols:
+        assert index.symbol_scores(symbol) == _recursive_symbol_scores(index, symbol), symbol
+
+
+def test_symbol_scores_sees_changes():
+    tree = SymbolIndex()
+    assert tree.symbol_scores('func') == []
+    with tree.enter('mod') as mod:
+        mod.add('func', 1.1)
+    assert tree.symbol_scores('func')[0][1:] == ('mod', 'func')
+    assert tree.find('mod').symbol_scores('func')[0][1:] == ('', 'func')
+    tree.prune(max_depth=0)
+    assert tree.symbol_scores('func') == []
+
+
+def test_symbol_scores_limit(index):
+    symbols = ['basename', 'os', 'os.path.join', 'path', 'Error', 'error', 'open', 'unknown',
+               'iso8859_6.Codec', 'Canvas.Canvas']
+    for symbol in symbols:
+        scores = index.symbol_scores(symbol)
+        for limit in (1, 3, 50):
+            assert index.symbol_scores(symbol, limit=limit) == scores[:limit], (symbol, limit)
+    assert index.symbol_scores('basename', limit=0) == []
+
+
+def test_symbol_scores_many(index):
+    symbols = ['os.path.join', 'os.path.exists', 'os', 'os.getcwd', 'path', 'path.join',
+               'basename', 'Error', 'unknown', 'unknown.attr', 'os.path.join']
+    for limit in (None, 1, 3):
+        results = index.symbol_scores_many(symbols, limit=limit)
+        assert sorted(results) == sorted(set(symbols))
+        for symbol in symbols:
+            assert results[symbol] == index.symbol_scores(symbol, limit=limit), (symbol, limit)
+    assert index.symbol_scores_many([]) == {}
+    rejects = index.prefilter_rejects
+    index.symbol_scores_many(['unknown.one', 'unknown.two', 'os.unknown'])
+    assert index.prefilter_rejects == rejects + 2
+    assert index.symbol_scores_many(['os'], limit=0) == {'os': []}
+
+
+def test_symbol_scores_kinds(tmpdir):
+    tmpdir.join('errors.py').write('class Error(Exception):\n pass\n')
+    tmpdir.join('helpers.py').write(dedent('''
+        from errors import Error
+        import json
+
+        def Error():
+            pass
+
+        def parse():
+            pass
+        '''))
+    tmpdir.join('consts.py').write('parse = None\nError = None\n')
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST)
+    tree.build_index([str(tmpdir)], builtins=False)
+    # The reimport is replaced by the definition, which scores higher.
+    assert tree.find('helpers')._kinds == {'Error': 'f', 'json': 'i', 'parse': 'f'}
+    assert tree.find('errors')._kinds == {'Error': 'c'}
+
+    modules = lambda symbol, **kwargs: sorted(
+        module for _, module, _ in tree.symbol_scores(symbol, **kwargs))
+    assert modules('Error') == ['consts', 'errors', 'helpers']
+    assert modules('Error', kinds='c') == ['errors']
+    assert modules('Error', kinds='cv') == ['consts', 'errors']
+    assert modules('parse', kinds='c') == []
+    # Dotted symbols are filtered on what they resolve to.
+    assert modules('helpers.parse', kinds='f') == ['helpers']
+    assert modules('helpers.parse', kinds='c') == []
+    assert modules('helpers', kinds='m') == ['helpers']
+    assert modules('helpers.unknown', kinds='m') == ['helpers']
+    assert tree.symbol_scores_many(['Error', 'parse'], limit=1, kinds='c') == {
+        'Error': tree.symbol_scores('Error', limit=1, kinds='c'), 'parse': []}
+
+    # Kinds survive serialization, and names of unknown kind match any.
+    loaded = SymbolIndex.deserialize(StringIO(tree.serialize()))
+    assert loaded.find('helpers')._kinds == tree.find('helpers')._kinds
+    assert modules('Error', kinds='c') == \
+        sorted(module for _, module, _ in loaded.symbol_scores('Error', kinds='c'))
+    loaded.find('consts')._kinds.clear()
+    loaded._touch()
+    assert sorted(module for _, module, _ in loaded.symbol_scores('Error', kinds='c')) == \
+        ['consts', 'errors']
+
+    # Pruned names take their kinds with them.
+    tree.prune(max_leaves_per_module=1)
+    assert set(tree.find('helpers')._kinds) == set(tree.find('helpers')._tree)
+
+
+def test_dedupe_compares_kinds():
+    tree = SymbolIndex()
+    for vendor, kind in (('pip', 'c'), ('setuptools', 'f'), ('wheel', 'f')):
+        with tree.enter(vendor, location='3') as pkg:
+            with pkg.enter('six', location='3') as six:
+                six.add('with_metaclass', 1.1, kind)
+    # setuptools and wheel, and their six.
+    assert tree.dedupe()['subtrees'] == 2
+    assert tree.find('setuptools.six')._kinds is tree.find('wheel.six')._kinds
+    assert tree.find('pip.six')._tree is not tree.find('wheel.six')._tree
+    assert tree.symbol_scores('with_metaclass', kinds='c')[0][1:] == ('pip.six', 'with_metaclass')
+
+
+def test_symbol_scores_cache():
+    tree = SymbolIndex(query_cache_size=2)
+    with tree.enter('mod') as mod:
+        mod.add('func', 1.1)
+    assert tree.query_cache_info() == (0, 0, 2, 0)
+    scores = tree.symbol_scores('func')
+    assert tree.symbol_scores('func') == scores
+    assert tree.query_cache_info() == (1, 1, 2, 1)
+    # Results are copies, so callers can't change cached entries.
+    tree.symbol_scores('func').pop()
+    assert tree.symbol_scores('func') == scores
+
+    # Changes to the index invalidate the cache.
+    tree.find('mod').add('other_func', 1.1)
+    assert tree.query_cache_info().currsize == 0
+    assert tree.symbol_scores('func') == scores
+    with tree.enter('mod2') as mod2:
+        mod2.add('func', 2.0)
+    assert tree.symbol_scores('func')[0][1:] == ('mod2', 'func')
+
+    # The least recently used results are dropped.
+    tree.symbol_scores('other_func')
+    tree.symbol_scores('unknown')
+    assert tree.query_cache_info().currsize == 2
+    hits = tree.query_cache_info().hits
+    tree.symbol_scores('func')
+    assert tree.query_cache_info().hits == hits
+
+    uncached = SymbolIndex(query_cache_size=0)
+    uncached.symbol_scores('func')
+    uncached.symbol_scores('func')
+    assert uncached.query_cache_info() == (0, 0, 0, 0)
+
+
+def test_subtrees_keep_index_state_on_the_root(index):
+    node = index.find('os')
+    assert not hasattr(node, '__dict__')
+    assert not hasattr(node, '_state')
+    # Subtrees cache their own query results, in the root's state.
+    scores = node.symbol_scores('path')
+    assert scores != index.symbol_scores('path')
+    assert node.symbol_scores('path') == scores
+    assert node.query_cache_info().currsize == 1
+    assert node.lib_locations is index.lib_locations
+
+
+def _walk_location_for(index, path):
+    # The original, tree walking, implementation of SymbolIndex.location_for().
+    node = index._root
+    location = node.location
+    for name in path.split('.'):
+        node = node._tree.get(name, None)
+        if node is None or type(node) is float:
+            return location
+        location = node.location
+    return location
+
+
+def test_find_and_location_for_paths(index):
+    paths = [entry[3] for entry in index._scope_table()[1::10]]
+    for path in paths:
+        node = index.find(path)
+        assert node is not None and index.find('os').find(path) is node, path
+        assert index.location_for(path) == _walk_location_for(index, path), path
+        assert node.path() == path or path.startswith(('os.path', 'posixpath')), path
+    for path in ['os.path.join', 'os.path.join.unknown', 'unknown', 'unknown.os', '', 'os.']:
+        assert index.find(path) is None, path
+        assert index.location_for(path) == _walk_location_for(index, path), path
+
+    tree = SymbolIndex()
+    with tree.enter('pkg', location='3') as pkg:
+        with pkg.enter('mod'):
+            pass
+    assert tree.find('pkg.mod').path() == 'pkg.mod'
+    assert tree.location_for('pkg.func') == '3'
+    assert tree.location_for('pkg.mod.func') == 'L'
+    del tree.find('pkg')._tree['mod']
+    tree._touch()
+    assert tree.find('pkg.mod') is None
+
+
+def test_find_follows_changes_without_rebuilding(tmpdir):
+    root = tmpdir.mkdir('root')
+    pkg = root.mkdir('pkg')
+    pkg.join('__init__.py').write('')
+    pkg.join('mod.py').write('def func():\n pass\n')
+    tree = SymbolIndex(blacklist_re=NO_BLACKLIST)
+    tree.build_index([str(root)], builtins=False)
+    nodes = tree._nodes()
+
+    with tree.enter('pkg') as package:
+        package.add('name', 1.1)
+        with package.enter('sub') as sub:
+            sub.add('func', 1.1)
+    assert tree.find('pkg.sub') is sub
+    pkg.join('other.py').write('def other():\n pass\n')
+    assert tree.update_path(str(root), str(pkg.join('other.py')))
+    assert tree.find('pkg.other') is tree.find('pkg')._tree['other']
+    pkg.join('mod.py').remove()
+    assert tree.update_path(str(root), str(pkg.join('mod.py')))
+    assert tree.find('pkg.mod') is None
+    assert tree._nodes() is nodes
+    assert nodes == dict(tree._walk_nodes(''))
+
+    # Changes visible at several paths rebuild it.
+    with tree.enter('posixpath', location='S') as posixpath:
+        with posixpath.enter('sub'):
+            pass
+    assert tree.find('os.path.sub') is tree.find('posixpath.sub')
+    assert tree._nodes() == dict(tree._walk_nodes(''))
+
+
+def test_complete(index):
+    names = sorted(name for name in index.names() if '.' not in name)
+    for prefix in ['', 'd', 'defaul', 'os', 'Canv', 'iso8859_', 'unknown_prefix']:
+        expected = []
+        for name in names:
+            if name.startswith(prefix):
+                expected.extend(index.symbol_scores(name, limit=1))
+        expected.sort(reverse=True)
+        for limit in (1, 5, 20):
+            results = index.complete(prefix, limit=limit)
+            # Names with equal scores may be returned in any order.
+            assert [r[0] for r in results] == [e[0] for e in expected[:limit]], (prefix, limit)
+            cutoff = results[-1][0] if results else None
+            assert [r for r in results if r[0] != cutoff] == \
+                [e for e in expected[:limit] if e[0] != cutoff], (prefix, limit)
+    assert index.complete('Canv', limit=1) == [(1.5, 'Canvas', None)]
+    assert index.complete('os', limit=0) == []
+
+    tree = SymbolIndex()
+    with tree.enter('mod') as mod:
+        mod.add('defaultdict', 1.0)
+    assert [r[1:] for r in tree.complete('defaul')] == [('mod', 'defaultdict')]
+    with tree.enter('mod2') as mod2:
+        mod2.add('default_value', 1.1)
+    assert [r[2] for r in tree.complete('defaul')] == ['default_value', 'defaultdict']
+
+
+def test_fuzzy(index):
+    names, scores, _, _ = index._completions()
+    for query in ['defualtdict', 'OrderDict', 'basenme', 'Canvs', 'isoformat', 'pth', 'np',
+                  'jion', 'xyzzy_plugh']:
+        distance = min(2, len(query) // 4)
+        expected = sorted((edit_distance(query, name, distance), -score, name)
+                          for name, score in zip(names, scores)
+                          if edit_distance(query, name, distance) <= distance)
+        expected = [index.symbol_scores(name, limit=1)[0] for _, _, name in expected[:5]]
+        assert index.fuzzy(query, limit=5) == expected, query
+    assert index.fuzzy('OrderDict', limit=1) == index.symbol_scores('OrderedDict', limit=1)
+    assert index.fuzzy('OrderDict', max_distance=0) == []
+    assert index.fuzzy('basename', limit=1) == index.symbol_scores('basename', limit=1)
+    assert index.fuzzy('basenme', limit=0) == []
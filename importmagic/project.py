@@ -0,0 +1,164 @@
+"""Analyse and fix the imports of every module in a project, parsing each once.
+
+Resolving a module's references to other modules of the same project needs
+an index of the project, and fixing it needs its unresolved and unreferenced
+symbols. Project reads and parses each module once, and takes both from the
+same AST: the module's top level names go into a local SymbolIndex, layered
+over a shared index of everything else, and Scope analyses its symbols.
+"""
+
+import logging
+import os
+import tokenize
+from collections import namedtuple
+
+from importmagic.importer import update_imports
+from importmagic.index import BUILTIN_MODULES, LayeredSymbolIndex, SymbolIndex
+from importmagic.symbols import Scope
+from importmagic.util import parse_ast
+
+
+logger = logging.getLogger(__name__)
+
+
+# The analysis of one module. module is its dotted path, or None if it is not
+# indexed (eg. a script, or a private or test module).
+ModuleAnalysis = namedtuple('ModuleAnalysis', 'module source scope unresolved unreferenced')
+
+
+class Project(object):
+    """The modules under a project directory, and an index of their symbols.
+
+    :param root: The project directory, as it would appear on sys.path.
+    :param index: Index of everything outside the project (eg. the standard
+        library and installed packages), or None.
+    :param exclude: Rules for modules not to index, as for SymbolIndex.
+    :param include: Rules that take precedence over exclude rules.
+    """
+
+    def __init__(self, root, index=None, exclude=None, include=None):
+        self.root = os.path.abspath(root)
+        self.local = SymbolIndex(exclude=exclude, include=include)
+        self.index = LayeredSymbolIndex([] if index is None else [index], self.local)
+        # Filename -> ModuleAnalysis
+        self.modules = {}
+        # Filename -> the exception raised reading or parsing it.
+        self.errors = {}
+
+    def filenames(self):
+        """Return every .py file under root, outside hidden directories.
+
+        Packages' __init__.py files come before the rest of the package.
+        """
+        filenames = []
+        for directory, dirs, files in os.walk(self.root):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != '__pycache__')
+            files = sorted((f for f in files if f.endswith('.py')),
+                           key=lambda f: (f != '__init__.py', f))
+            filenames.extend(os.path.join(directory, f) for f in files)
+        return filenames
+
+    def analyse(self):
+        """Analyse every module, building the local index as it goes.
+
+        :returns: {filename: ModuleAnalysis}
+        """
+        for filename in self.filenames():
+            self.update(filename)
+        return self.modules
+
+    def update(self, filename, source=None):
+        """(Re)analyse one module and replace its names in the local index.
+
+        A module that no longer exists is removed, and so is a package whose
+        __init__.py no longer exists, with all of its modules.
+
+        :param source: The module's source, if not to be read from filename,
+            eg. an editor buffer.
+        :returns: The ModuleAnalysis, or None if the module could not be read
+            or parsed.
+        """
+        filename = os.path.abspath(filename)
+        parts = self._module_parts(filename)
+        self.modules.pop(filename, None)
+        self.errors.pop(filename, None)
+        if self._is_deleted_package(filename):
+            prefix = os.path.dirname(filename) + os.path.sep
+            for analyses in (self.modules, self.errors):
+                for key in [key for key in analyses if key.startswith(prefix)]:
+                    del analyses[key]
+        tree = None
+        try:
+            if source is None:
+                with tokenize.open(filename) as fd:
+                    source = fd.read()
+            tree = parse_ast(source, filename)
+        except (IOError, OSError) as e:
+            if os.path.exists(filename):
+                self.errors[filename] = e
+        except (SyntaxError, ValueError) as e:
+            logger.debug('failed to parse %s: %s', filename, e)
+            self.errors[filename] = e
+        if parts is not None:
+            self._index(parts, filename, tree)
+        if tree is None:
+            return None
+        scope = Scope.from_source(tree)
+        unresolved, unreferenced = scope.find_unresolved_and_unreferenced_symbols()
+        analysis = ModuleAnalysis('.'.join(parts) if parts else None, source, scope,
+                                  unresolved, unreferenced)
+        self.modules[filename] = analysis
+        return analysis
+
+    def fix(self, filename):
+        """Return the source of an analysed module with its imports updated."""
+        analysis = self.modules[os.path.abspath(filename)]
+        return update_imports(analysis.source, self.index, analysis.unresolved,
+                              analysis.unreferenced,
+                              contexts=analysis.scope.reference_contexts())
+
+    def fix_all(self):
+        """Analyse every module, and return {filename: source} for those whose imports change."""
+        self.analyse()
+        fixed = {}
+        for filename, analysis in sorted(self.modules.items()):
+            source = self.fix(filename)
+            if source != analysis.source:
+                fixed[filename] = source
+        return fixed
+
+    def _module_parts(self, filename):
+        # The dotted path of the module in filename, split, or None if
+        # SymbolIndex.index_path() would not index it. The blacklist applies
+        # to the path within the project, wherever the project is.
+        relative = os.path.relpath(filename, self.root)
+        if self.local._blacklist_re.search(relative):
+            return None
+        parts = relative.split(os.path.sep)
+        name = os.path.splitext(parts.pop())[0]
+        directory = self.root
+        # A deleted package is still a package, to remove it from the index.
+        checked = parts[:-1] if self._is_deleted_package(filename) else parts
+        for part in checked:
+            directory = os.path.join(directory, part)
+            if not os.path.exists(os.path.join(directory, '__init__.py')):
+                return None
+        if name != '__init__':
+            parts.append(name)
+        if not parts or any(part.startswith('_') for part in parts):
+            return None
+        module = '.'.join(parts)
+        if module in BUILTIN_MODULES or self.local._is_excluded(module):
+            return None
+        return parts
+
+    def _is_deleted_package(self, filename):
+        return os.path.basename(filename) == '__init__.py' and not os.path.exists(filename)
+
+    def _index(self, parts, filename, tree):
+        # Replace the names indexed for the module with those defined in
+        # tree, or remove them if tree is None.
+        location = self.local._determine_location_for(filename)
+        package = os.path.basename(filename) == '__init__.py' and \
+            not self._is_deleted_package(filename)
+        self.local.replace_module(parts, tree, location=location, package=package)
@@ -0,0 +1,92 @@
+import os
+import shutil
+from textwrap import dedent
+
+from importmagic.project import Project
+
+
+def make_project(tmpdir):
+    root = tmpdir.mkdir('project')
+    pkg = root.mkdir('pkg')
+    pkg.join('__init__.py').write('VERSION = 1\n')
+    pkg.join('models.py').write(dedent('''
+        class Model(object):
+            pass
+
+
+        def _private():
+            pass
+        '''))
+    pkg.join('views.py').write(dedent('''
+        def view(request):
+            return Model(os.path.join(request.path, VERSION))
+        '''))
+    root.mkdir('bin').join('script.py').write('print(view(1))\n')
+    root.join('broken.py').write('def (:\n')
+    return root
+
+
+def test_project_analyses_and_indexes_in_one_pass(tmpdir, index):
+    root = make_project(tmpdir)
+    project = Project(str(root), index)
+    modules = project.analyse()
+    views = modules[str(root.join('pkg', 'views.py'))]
+    assert views.module == 'pkg.views'
+    assert views.unresolved == set(['Model', 'os.path.join', 'VERSION'])
+    assert modules[str(root.join('bin', 'script.py'))].module is None
+    assert list(project.errors) == [str(root.join('broken.py'))]
+
+    assert project.local.find('pkg.models')._kinds == {'Model': 'c'}
+    assert project.index.symbol_scores('Model')[0][1:] == ('pkg.models', 'Model')
+
+    fixed = project.fix(str(root.join('pkg', 'views.py')))
+    assert 'from pkg import VERSION\n' in fixed
+    assert 'from pkg.models import Model\n' in fixed
+    assert 'import os.path\n' in fixed
+    fixed = project.fix_all()
+    assert sorted(fixed) == [str(root.join('bin', 'script.py')), str(root.join('pkg', 'views.py'))]
+    assert 'from pkg.views import view\n' in fixed[str(root.join('bin', 'script.py'))]
+
+
+def test_project_update_replaces_module_names(tmpdir):
+    root = make_project(tmpdir)
+    project = Project(str(root))
+    project.analyse()
+    models = str(root.join('pkg', 'models.py'))
+    project.update(models, source='class Renamed(object):\n    pass\n')
+    assert project.index.symbol_scores('Model') == []
+    assert project.index.symbol_scores('Renamed')[0][1:] == ('pkg.models', 'Renamed')
+
+    project.update(str(root.join('pkg', '__init__.py')), source='__all__ = []\n')
+    assert project.index.symbol_scores('VERSION') == []
+    assert project.local.find('pkg.models') is not None
+
+    root.join('pkg', 'models.py').remove()
+    assert project.update(models) is None
+    assert project.local.find('pkg.models') is None
+    assert models not in project.modules and models not in project.errors
+
+
+def test_project_update_removes_deleted_package(tmpdir):
+    root = make_project(tmpdir)
+    sub = root.join('pkg').mkdir('sub')
+    sub.join('__init__.py').write('SUB = 1\n')
+    sub.join('mod.py').write('def sub_func():\n    pass\n')
+    project = Project(str(root))
+    project.analyse()
+    assert project.local.find('pkg.sub.mod') is not None
+
+    shutil.rmtree(str(sub))
+    assert project.update(str(sub.join('__init__.py'))) is None
+    assert project.local.find('pkg.sub') is None
+    assert project.index.symbol_scores('sub_func') == []
+    assert not [filename for filename in project.modules if filename.startswith(str(sub))]
+    assert project.local.find('pkg.models') is not None
+
+
+def test_project_fix_relative_filename(tmpdir, monkeypatch):
+    root = make_project(tmpdir)
+    project = Project(str(root))
+    project.analyse()
+    monkeypatch.chdir(str(root))
+    assert 'from pkg.models import Model\n' in project.fix(os.path.join('pkg', 'views.py'))
@@ -1,7 +1,9 @@
 """Parse Python source and extract unresolved symbols."""
 
 import ast
+import hashlib
 import sys
+from bisect import bisect_right
 from contextlib import contextmanager
 from itertools import chain
 
@@ -14,69 +16,74 @@ try:
 except:
     import __builtin__
 
+try:
+    from sys import intern
+except ImportError:
+    from __builtin__ import intern
+
 
 class _InvalidSymbol(Exception):
     pass
 
 
+class _SymbolContext(object):
+    """Add symbols with add (inherited from the enclosing context if None) in
+    context until exited. Used by the UnknownSymbolVisitor.start_*() methods."""
+
+    __slots__ = ('_visitor', '_add', '_context')
+
+    def __init__(self, visitor, add, context):
+        self._visitor = visitor
+        self._add = add
+        self._context = context
+
+    def __enter__(self):
+        visitor = self._visitor
+        if self._add is None:
+            visitor._add_symbol.append(visitor._add_symbol[-1] if visitor._add_symbol
+                                       else visitor._reference)
+            visitor._context.append(visitor._context[-1] if visitor._context else None)
+        else:
+            visitor._add_symbol.append(self._add)
+            visitor._context.append(self._context)
+        return visitor._cursor
+
+    def __exit__(self, *exc_info):
+        self._visitor.flush_symbol()
+
+
+# Sets of contexts a reference is used in, shared between references.
+_CONTEXTS = {}
+_NO_CONTEXTS = frozenset()
+
+
 class Scope(object):
+    """The definitions and references of a module, class or function, and the
+    scopes nested in it.
+
+    Builtins are not stored, but are treated as defined in every scope if
+    define_builtins is set.
+    """
+
     GLOBALS = ['__name__', '__file__', '__loader__', '__package__', '__path__']
     PYTHON3_BUILTINS = ['PermissionError']
     ALL_BUILTINS = set(dir(__builtin__)) | set(GLOBALS) | set(PYTHON3_BUILTINS)
 
+    __slots__ = ('_parent', '_definitions', '_contexts', '_children', '_define_builtins',
+                 '_is_class')
+
     def __init__(self, parent=None, define_builtins=True, is_class=False):
         self._parent = parent
         self._definitions = set()
-        self._references = set()
+        # Reference -> the contexts (see reference_contexts()) it is used in.
+        self._contexts = {}
         self._children = []
-        self._cursors = [self]
-        self._cursor = self
         self._define_builtins = define_builtins
         self._is_class = is_class
-        if define_builtins:
-            self._define_builtin_symbols()
-        self._add_symbol = []
-        self._symbol = []
 
-    @contextmanager
-    def start_symbol(self):
-        self._add_symbol.append(self._add_symbol[-1] if self._add_symbol else self.reference)
-        try:
-            yield self
-        finally:
-            self.flush_symbol()
-
-    @contextmanager
-    def start_definition(self):
-        self._add_symbol.append(self.define)
-        try:
-            yield self
-        finally:
-            self.flush_symbol()
-
-    @contextmanager
-    def start_reference(self):
-        self._add_symbol.append(self.reference)
-        try:
-            yield self
-        finally:
-            self.flush_symbol()
-
-    def extend_symbol(self, segment, extend_only=False):
-        if extend_only and not self._symbol:
-            return
-        self._symbol.append(segment)
-
-    def end_symbol(self):
-        if self._symbol:
-            add = self._add_symbol[-1] if self._add_symbol else self.reference
-            add('.'.join(self._symbol))
-            self._symbol = []
-
-    def flush_symbol(self):
-        self.end_symbol()
-        if self._add_symbol:
-            self._add_symbol.pop()
+    @property
+    def _references(self):
+        return self._contexts.keys()
 
     @classmethod
     def from_source(cls, src, trace=False, define_builtins=True):
@@ -85,73 +92,120 @@ class Scope(object):
         if isinstance(src, string_types):
             src = parse_ast(src)
         visitor.visit(src)
-        scope.flush_symbol()
+        visitor.flush_symbol()
         return scope
 
-    def _define_builtin_symbols(self):
-        self._cursor._definitions.update(Scope.ALL_BUILTINS)
-
-    def define(self, name):
+    def define(self, name, context=None):
         if '.' in name:
-            self.reference(name)
+            self.reference(name, context)
         else:
-            self._cursor._definitions.add(name)
+            self._definitions.add(name)
 
-    def reference(self, name):
-        self._cursor._references.add(name)
-
-    @contextmanager
-    def enter(self, is_class=False):
-        child = Scope(self._cursor, is_class=is_class, define_builtins=self._define_builtins)
-        self._cursor._children.append(child)
-        self._cursors.append(child)
-        self._cursor = child
-        try:
-            yield child
-        finally:
-            child.end_symbol()
-            self._cursors.pop()
-            self._cursor = self._cursors[-1]
+    def reference(self, name, context=None):
+        found = self._contexts.get(name, _NO_CONTEXTS)
+        if context not in found:
+            found = found | frozenset((context,))
+            self._contexts[name] = _CONTEXTS.setdefault(found, found)
 
     def find_unresolved_and_unreferenced_symbols(self):
         """Find any unresolved symbols, and unreferenced symbols from this scope.
 
+        Scopes are walked once, depth first. Rather than building the set of
+        visible definitions for every scope, a count of the enclosing scopes
+        defining each name is kept up to date as scopes are entered and left.
+
         :returns: ({unresolved}, {unreferenced})
         """
         unresolved = set()
         unreferenced = self._definitions.copy()
-        self._collect_unresolved_and_unreferenced(set(), set(), unresolved, unreferenced,
-                                                  frozenset(self._definitions), start=True)
-        return unresolved, unreferenced - Scope.ALL_BUILTINS
-
-    def _collect_unresolved_and_unreferenced(self, definitions, definitions_excluding_top,
-                                             unresolved, unreferenced, top, start=False):
-        scope_definitions = definitions | self._definitions
-        scope_definitions_excluding_top = definitions_excluding_top | (set() if start else self._definitions)
-
-        # When we're in a class, don't export definitions to descendant scopes
-        if not self._is_class:
-            definitions = scope_definitions
-            definitions_excluding_top = scope_definitions_excluding_top
+        top = self._definitions
+        builtins = Scope.ALL_BUILTINS if self._define_builtins else _NO_CONTEXTS
+        # Whether definitions in this scope are visible in nested scopes.
+        top_visible = not self._is_class
+        series = {}
 
         for reference in self._references:
-            symbols = set(_symbol_series(reference))
-            # Symbol has no definition anywhere in ancestor scopes.
-            if symbols.isdisjoint(scope_definitions):
+            symbols = series.get(reference)
+            if symbols is None:
+                symbols = series[reference] = _symbol_series(reference)
+            if top.isdisjoint(symbols) and builtins.isdisjoint(symbols):
                 unresolved.add(reference)
-            # Symbol is referenced only in the top level scope.
-            elif not symbols.isdisjoint(top) and symbols.isdisjoint(scope_definitions_excluding_top):
-                unreferenced -= symbols
+            else:
+                unreferenced.difference_update(symbols)
 
-        # Recurse
-        for child in self._children:
-            child._collect_unresolved_and_unreferenced(
-                definitions, definitions_excluding_top, unresolved, unreferenced, top,
-            )
+        for reference in self._unresolved_below(series):
+            symbols = series[reference]
+            if top_visible and not top.isdisjoint(symbols):
+                unreferenced.difference_update(symbols)
+            else:
+                unresolved.add(reference)
+        return unresolved, unreferenced - Scope.ALL_BUILTINS
+
+    def _unresolved_below(self, series):
+        """Find references in nested scopes that no scope below this one defines.
+
+        :param series: Cache of reference -> _symbol_series(reference), updated
+            with the references found.
+        """
+        unresolved = set()
+        # Name -> number of scopes being visited, other than this one, that
+        # define it and whose definitions are visible in nested scopes. Only
+        # names with a count are kept, so the keys are the visible names.
+        visible = {}
+        visible_names = visible.keys()
+
+        # (scope, names it adds to visible when being left, or None)
+        stack = [(child, None) for child in reversed(self._children)]
+        while stack:
+            scope, added = stack.pop()
+            if added is not None:
+                for name in added:
+                    if visible[name] == 1:
+                        del visible[name]
+                    else:
+                        visible[name] -= 1
+                continue
+            definitions = scope._definitions
+            builtins = Scope.ALL_BUILTINS if scope._define_builtins else _NO_CONTEXTS
+            for reference in scope._references:
+                symbols = series.get(reference)
+                if symbols is None:
+                    symbols = series[reference] = _symbol_series(reference)
+                if definitions.isdisjoint(symbols) and visible_names.isdisjoint(symbols) \
+                        and builtins.isdisjoint(symbols):
+                    unresolved.add(reference)
+            if not scope._children:
+                continue
+            # Class attributes are not visible in nested scopes.
+            if not scope._is_class:
+                added = definitions
+                for name in added:
+                    visible[name] = visible.get(name, 0) + 1
+                stack.append((scope, added))
+            stack.extend((child, None) for child in reversed(scope._children))
+        return unresolved
+
+    def reference_contexts(self):
+        """Find the syntactic contexts each symbol is referenced in.
+
+        Contexts are 'call' (eg. X()), 'except' (except X:), 'base' (class
+        A(X):), and None for any other use.
+
+        :returns: {symbol: {context}}, for references in this scope and all
+            scopes below it.
+        """
+        contexts = {}
+        scopes = [self]
+        while scopes:
+            scope = scopes.pop()
+            for name, found in scope._contexts.items():
+                contexts.setdefault(name, set()).update(found)
+            scopes.extend(scope._children)
+        return contexts
 
     def __repr__(self):
         return 'Scope(definitions=%r, references=%r, children=%r)' \
-            % (self._definitions - Scope.ALL_BUILTINS, self._references, self._children)
+            % (self._definitions - Scope.ALL_BUILTINS, set(self._references), self._children)
 
 
 def _symbol_series(s):
@@ -159,164 +213,433 @@ def _symbol_series(s):
     return ['.'.join(tokens[:n + 1]) for n in range(len(tokens))]
 
 
+class IncrementalScope(object):
+    """Unresolved and unreferenced symbols of a buffer that is edited repeatedly.
+
+    The source is split into blocks of top level statements, each summarised
+    by the names it defines at the top level and the references it leaves to
+    be resolved there. update() diffs the new source against the old one and
+    only reparses and walks the blocks touched by the edit; module level
+    results are then recomputed from the summaries.
+
+    :param source: Python source.
+    :param define_builtins: As for Scope.from_source().
+    """
+
+    def __init__(self, source='', define_builtins=True):
+        self._define_builtins = define_builtins
+        self._lines = []
+        # First line (0 based) of each block. Blocks cover every line up to
+        # the first line of the next one.
+        self._starts = []
+        # Per block: (digest of its source, (definitions, references, contexts))
+        self._blocks = []
+        # Name -> number of blocks defining/referencing it.
+        self._defined = {}
+        self._referenced = {}
+        self._results = None
+        self.update(source)
+
+    def update(self, source):
+        """Reanalyse after the buffer changed to source.
+
+        :raises SyntaxError: If source does not parse. The previous source is
+            kept, so the next update() is diffed against that.
+        """
+        lines = source.splitlines(True)
+        old = self._lines
+        limit = min(len(old), len(lines))
+        prefix = 0
+        while prefix < limit and old[prefix] == lines[prefix]:
+            prefix += 1
+        if prefix == len(old) == len(lines) and self._starts:
+            return
+        suffix = 0
+        while suffix < limit - prefix and old[-1 - suffix] == lines[-1 - suffix]:
+            suffix += 1
+        delta = len(lines) - len(old)
+
+        # Blocks [first, last) contain the changed lines of old.
+        starts = self._starts
+        first = max(0, bisect_right(starts, prefix) - 1)
+        last = max(first + 1, bisect_right(starts, len(old) - suffix - 1)) if starts else 0
+        width = 1
+        while True:
+            start = starts[first] if starts else 0
+            end = (starts[last] if last < len(starts) else len(old)) + delta
+            try:
+                tree = parse_ast(''.join(lines[start:end]))
+                break
+            except SyntaxError:
+                # The edit may have joined the blocks to neighbouring ones.
+                if first == 0 and last >= len(starts):
+                    raise
+                first = max(0, first - width)
+                last = min(len(starts), last + width)
+                width *= 2
+
+        new_starts, groups = self._split(tree.body, start)
+        reused = dict(self._blocks[first:last])
+        blocks = []
+        for i, nodes in enumerate(groups):
+            text = ''.join(lines[new_starts[i]:new_starts[i + 1] if i + 1 < len(groups) else end])
+            digest = hashlib.sha1(text.encode('utf-8', 'surrogatepass')).digest()
+            summary = reused.get(digest)
+            if summary is None:
+                summary = self._summarise(nodes)
+            blocks.append((digest, summary))
+        for _, summary in self._blocks[first:last]:
+            self._count(summary, -1)
+        for _, summary in blocks:
+            self._count(summary, 1)
+
+        self._starts[first:] = new_starts + [line + delta for line in starts[last:]]
+        self._blocks[first:last] = blocks
+        self._lines = lines
+        self._results = None
+
+    def _split(self, nodes, start):
+        # Group statements parsed from lines[start:] into blocks, returning
+        # ([first line of each block], [[statements in each block]]).
+        starts = []
+        groups = []
+        end = -1
+        for node in nodes:
+            line = min([node.lineno] + [d.lineno for d in getattr(node, 'decorator_list', [])])
+            line += start - 1
+            if line <= end:
+                # Shares a line with the previous statement, eg. a = 1; b = 2
+                groups[-1].append(node)
+            else:
+                starts.append(line)
+                groups.append([node])
+            end = max(end, getattr(node, 'end_lineno', 0) + start - 1, line)
+        if not groups:
+            groups.append([])
+        starts[:1] = [start]
+        return starts, groups
+
+    def _summarise(self, nodes):
+        scope = Scope.from_source(ast.Module(body=nodes, type_ignores=[]),
+                                  define_builtins=self._define_builtins)
+        definitions = scope._definitions
+        if self._define_builtins:
+            definitions = definitions - Scope.ALL_BUILTINS
+        references = scope._references | scope._unresolved_below({})
+        return frozenset(definitions), frozenset(references), scope.reference_contexts()
+
+    def _count(self, summary, change):
+        for counts, names in ((self._defined, summary[0]), (self._referenced, summary[1])):
+            for name in names:
+                count = counts.get(name, 0) + change
+                if count:
+                    counts[name] = count
+                else:
+                    del counts[name]
+
+    def find_unresolved_and_unreferenced_symbols(self):
+        """See Scope.find_unresolved_and_unreferenced_symbols()."""
+        if self._results is None:
+            defined = self._defined.keys()
+            builtins = Scope.ALL_BUILTINS if self._define_builtins else frozenset()
+            unresolved = set()
+            unreferenced = set(defined)
+            for reference in self._referenced:
+                symbols = _symbol_series(reference)
+                if defined.isdisjoint(symbols) and builtins.isdisjoint(symbols):
+                    unresolved.add(reference)
+                else:
+                    unreferenced.difference_update(symbols)
+            self._results = (unresolved, unreferenced - Scope.ALL_BUILTINS)
+        return set(self._results[0]), set(self._results[1])
+
+    def reference_contexts(self):
+        """See Scope.reference_contexts()."""
+        contexts = {}
+        for _, summary in self._blocks:
+            for name, found in summary[2].items():
+                contexts.setdefault(name, set()).update(found)
+        return contexts
+
+
+class _EndSymbol(object):
+    """Visited after a node's children to end the symbol being collected."""
+
+
+_END_SYMBOL = _EndSymbol()
+
+
 class UnknownSymbolVisitor(ast.NodeVisitor):
+    """Collect definitions and references into a Scope.
+
+    Traversal uses an explicit stack rather than recursion, so deeply nested
+    expressions don't hit the recursion limit. visit_<NodeClass>() handlers
+    return an iterator (usually by being generators) of the child nodes, or
+    lists of them, or None, to visit; values that aren't nodes are ignored.
+    A handler that returns None visits nothing below the node. Nodes without
+    a handler have all their children visited, and then end the current
+    symbol. Handlers are looked up once per node class.
+    """
+
+    # Visitor class -> {node class: handler}
+    _dispatch_tables = {}
+
     def __init__(self, scope=None, trace=False):
         super(UnknownSymbolVisitor, self).__init__()
         self._scope = scope or Scope()
         self._trace = trace
+        # The scope being visited, and those enclosing it.
+        self._cursor = self._scope
+        self._cursors = [self._scope]
+        # How (self._define or self._reference) and in what context symbols
+        # are added, and the segments of the symbol being collected.
+        self._add_symbol = []
+        self._context = []
+        self._symbol = []
+        # These are entered for nearly every node, so reuse them.
+        self._symbol_context = _SymbolContext(self, None, None)
+        self._definition_context = _SymbolContext(self, self._define, None)
+        self._reference_context = _SymbolContext(self, self._reference, None)
+        if trace:
+            self._handlers = {}
+        else:
+            self._handlers = self._dispatch_tables.setdefault(type(self), {})
 
-    def visit(self, node):
-        if node is None:
-            return
-        elif isinstance(node, list):
-            for subnode in node:
-                self.visit(subnode)
+    def start_symbol(self):
+        return self._symbol_context
+
+    def start_definition(self):
+        return self._definition_context
+
+    def start_reference(self, context=None):
+        """Add symbols as references, used in context (see Scope.reference_contexts())."""
+        if context is None:
+            return self._reference_context
+        return _SymbolContext(self, self._reference, context)
+
+    def extend_symbol(self, segment, extend_only=False):
+        if extend_only and not self._symbol:
             return
-        if self._trace:
-            print(node, vars(node))
-        method = getattr(self, 'visit_%s' % node.__class__.__name__, None)
-        if method is not None:
-            try:
-                method(node)
-            except Exception:
-                # print >> sys.stderr, node, vars(node)
-                raise
+        self._symbol.append(segment)
+
+    def end_symbol(self):
+        if self._symbol:
+            add = self._add_symbol[-1] if self._add_symbol else self._reference
+            add(intern('.'.join(self._symbol)), self._context[-1] if self._context else None)
+            self._symbol = []
+
+    def flush_symbol(self):
+        self.end_symbol()
+        if self._add_symbol:
+            self._add_symbol.pop()
+            self._context.pop()
+
+    def _define(self, name, context=None):
+        self._cursor.define(name, context)
+
+    def _reference(self, name, context=None):
+        self._cursor.reference(name, context)
+
+    @contextmanager
+    def enter(self, is_class=False):
+        """Visit a nested scope, which is returned."""
+        child = Scope(self._cursor, is_class=is_class,
+                      define_builtins=self._cursor._define_builtins)
+        self._cursor._children.append(child)
+        self._cursors.append(child)
+        self._cursor = child
+        try:
+            yield child
+        finally:
+            self._cursors.pop()
+            self._cursor = self._cursors[-1]
+
+    def _handler(self, node_class):
+        if node_class is _EndSymbol:
+            handler = UnknownSymbolVisitor._end_symbol
+        elif not issubclass(node_class, ast.AST):
+            # Field values that aren't nodes, eg. Constant.value.
+            handler = UnknownSymbolVisitor._ignore
         else:
-            self.generic_visit(node)
-            self._scope.end_symbol()
+            handler = getattr(type(self), 'visit_%s' % node_class.__name__, None) or \
+                UnknownSymbolVisitor._visit_default
+        if self._trace:
+            untraced = handler
+
+            def handler(visitor, node):
+                print(node, vars(node))
+                return untraced(visitor, node)
+        self._handlers[node_class] = handler
+        return handler
+
+    def visit(self, node):
+        handlers = self._handlers
+        stack = [iter((node,))]
+        try:
+            while stack:
+                node = next(stack[-1], stack)
+                if node is stack:
+                    stack.pop()
+                elif node is None:
+                    continue
+                elif isinstance(node, list):
+                    stack.append(iter(node))
+                else:
+                    handler = handlers.get(node.__class__) or self._handler(node.__class__)
+                    children = handler(self, node)
+                    if children is not None:
+                        stack.append(children)
+        except BaseException:
+            # Unwind handlers in the same order recursion would.
+            while stack:
+                close = getattr(stack.pop(), 'close', None)
+                if close is not None:
+                    close()
+            raise
+
+    def _children(self, node):
+        return iter([getattr(node, field, None) for field in node._fields])
+
+    def _visit_default(self, node):
+        children = [getattr(node, field, None) for field in node._fields]
+        children.append(_END_SYMBOL)
+        return iter(children)
+
+    def _end_symbol(self, node):
+        self.end_symbol()
+
+    def _ignore(self, node):
+        pass
 
     def visit_Raise(self, node):
         if hasattr(node, 'type'):  # Python 2: raise A[, B[, C]]
-            with self._scope.start_reference():
-                self.visit(node.type)
-            with self._scope.start_reference():
-                self.visit(node.inst)
-            with self._scope.start_reference():
-                self.visit(node.tback)
+            with self.start_reference():
+                yield node.type
+            with self.start_reference():
+                yield node.inst
+            with self.start_reference():
+                yield node.tback
         else:                      # Python 3: raise A[ from B]
-            with self._scope.start_reference():
-                self.visit(node.exc)
-            with self._scope.start_reference():
-                self.visit(node.cause)
+            with self.start_reference():
+                yield node.exc
+            with self.start_reference():
+                yield node.cause
 
     def visit_TryExcept(self, node):
         for sub in node.body:
-            with self._scope.start_reference():
-                self.visit(sub)
-        self.visit(node.handlers)
+            with self.start_reference():
+                yield sub
+        yield node.handlers
         for n in node.orelse:
-            with self._scope.start_reference():
-                self.visit(n)
+            with self.start_reference():
+                yield n
 
     def visit_ExceptHandler(self, node):
-        with self._scope.start_reference():
-            self.visit(node.type)
-        with self._scope.start_definition():
+        with self.start_reference('except'):
+            yield node.type
+        with self.start_definition():
             if isinstance(node.name, str):
                 # Python 3
-                self._scope.extend_symbol(node.name)
+                self.extend_symbol(node.name)
             else:
-                self.visit(node.name)
+                yield node.name
         for n in node.body:
-            with self._scope.start_reference():
-                self.visit(n)
+            with self.start_reference():
+                yield n
 
     def visit_Return(self, node):
-        with self._scope.start_reference():
-            self.visit(node.value)
+        with self.start_reference():
+            yield node.value
 
     def visit_If(self, node):
-        with self._scope.start_reference():
-            self.visit(node.test)
+        with self.start_reference():
+            yield node.test
         for child in node.body:
-            with self._scope.start_reference():
-                self.visit(child)
+            with self.start_reference():
+                yield child
         for child in node.orelse:
-            with self._scope.start_reference():
-                self.visit(child)
+            with self.start_reference():
+                yield child
 
     def visit_While(self, node):
         return self.visit_If(node)
 
     def visit_FunctionDef(self, node):
-        self._scope.define(node.name)
-        self.visit_Lambda(node)
+        self._cursor.define(node.name)
+        return self.visit_Lambda(node)
 
     def visit_Lambda(self, node):
         for decorator in getattr(node, 'decorator_list', []):
-            with self._scope.start_reference() as scope:
-                self.visit(decorator)
-        with self._scope.enter() as scope:
-            with scope.start_definition():
-                args = node.args
-                for arg in [args.kwarg, args.vararg]:
-                    if arg:
-                        # arg is either an "arg" object (Python 3.4+) or a str
-                        scope.define(arg.arg if hasattr(arg, 'arg') else arg)
-                # kwonlyargs was added in Python 3
-                for arg in args.args + getattr(args, 'kwonlyargs', []):
-                    scope.define(arg.id if hasattr(arg, 'id') else arg.arg)
-
-                    # Python 3 arguments annotation
-                    if hasattr(arg, 'annotation') and arg.annotation:
-                        self.visit(arg.annotation)
-
-                for default in args.defaults:
-                    self.visit(default)
-                
-                # Python 3 return annotation
-                if hasattr(node, 'returns'):
-                    self.visit(node.returns)    
+            with self.start_reference():
+                yield decorator
+        with self.enter() as scope:
+            args = node.args
+            for arg in [args.kwarg, args.vararg]:
+                if arg:
+                    # arg is either an "arg" object (Python 3.4+) or a str
+                    scope.define(arg.arg if hasattr(arg, 'arg') else arg)
+            # kwonlyargs was added in Python 3
+            for arg in args.args + getattr(args, 'kwonlyargs', []):
+                scope.define(arg.id if hasattr(arg, 'id') else arg.arg)
+
+                # Python 3 arguments annotation
+                if hasattr(arg, 'annotation') and arg.annotation:
+                    yield arg.annotation
+
+            for default in args.defaults:
+                yield default
+
+            # Python 3 return annotation
+            if hasattr(node, 'returns'):
+                yield node.returns
             body = [node.body] if isinstance(node, ast.Lambda) else node.body
-            with scope.start_reference():
-                for statement in body:
-                    self.visit(statement)
+            for statement in body:
+                yield statement
 
     def visit_ListComp(self, node):
         return self.visit_GeneratorExp(node)
 
     def visit_Print(self, node):
         for value in node.values:
-            with self._scope.start_reference():
-                self.visit(value)
+            with self.start_reference():
+                yield value
         if node.dest:
-            with self._scope.start_reference():
-                self.visit(node.dest)
+            with self.start_reference():
+                yield node.dest
 
     def visit_GeneratorExp(self, node):
-        with self._scope.start_reference():
-            self.visit(node.elt)
-        for elt in node.generators:
-            self.visit(elt)
+        with self.start_reference():
+            yield node.elt
+        yield node.generators
 
     def visit_comprehension(self, node):
-        with self._scope.start_definition():
-            self.visit(node.target)
-        with self._scope.start_reference():
-            self.visit(node.iter)
+        with self.start_definition():
+            yield node.target
+        with self.start_reference():
+            yield node.iter
         for elt in node.ifs:
-            with self._scope.start_reference():
-                self.visit(elt)
+            with self.start_reference():
+                yield elt
 
     def visit_Assign(self, node):
         for target in node.targets:
-            with self._scope.start_definition():
-                self.visit(target)
-        with self._scope.start_reference():
-            self.visit(node.value)
+            with self.start_definition():
+                yield target
+        with self.start_reference():
+            yield node.value
 
     def visit_ClassDef(self, node):
         for decorator in getattr(node, 'decorator_list', []):
-            with self._scope.start_reference():
-                self.visit(decorator)
-        self._scope.define(node.name)
+            with self.start_reference():
+                yield decorator
+        self._cursor.define(node.name)
         for base in node.bases:
-            with self._scope.start_reference():
-                self.visit(base)
-        with self._scope.enter(is_class=True):
+            with self.start_reference('base'):
+                yield base
+        with self.enter(is_class=True):
             for body in node.body:
-                with self._scope.start_reference():
-                    self.visit(body)
+                with self.start_reference():
+                    yield body
 
     def visit_ImportFrom(self, node):
         for name in node.names:
@@ -324,67 +647,72 @@ class UnknownSymbolVisitor(ast.NodeVisitor):
                 # TODO: Do something?
                 continue
             symbol = name.asname or name.name.split('.')[0]
-            self._scope.define(symbol)
+            self._cursor.define(symbol)
             # Explicitly add a reference for __future__ imports so they don't
             # get pruned.
             if node.module == '__future__':
-                self._scope.reference(symbol)
-        self.generic_visit(node)
+                self._cursor.reference(symbol)
+        return self._children(node)
 
     def visit_Import(self, node):
         for name in node.names:
-            self._scope.define(name.asname or name.name)
-        self.generic_visit(node)
+            self._cursor.define(name.asname or name.name)
+        return self._children(node)
 
     def visit_With(self, node):
         if hasattr(node, 'items'):
             for item in node.items:
-                self._visit_withitem(item)
+                yield from self._visit_withitem(item)
         else:
-            self._visit_withitem(node)
-        with self._scope.start_reference():
-            self.visit(node.body)
+            yield from self._visit_withitem(node)
+        with self.start_reference():
+            yield node.body
 
     def _visit_withitem(self, node):
         if node.optional_vars:
-            with self._scope.start_definition():
-                self.visit(node.optional_vars)
-        with self._scope.start_reference():
-            self.visit(node.context_expr)
+            with self.start_definition():
+                yield node.optional_vars
+        with self.start_reference():
+            yield node.context_expr
 
     def visit_For(self, node):
-        with self._scope.start_definition():
-            self.visit(node.target)
-        with self._scope.start_reference():
-            self.visit(node.iter)
-        with self._scope.start_reference():
-            self.visit(node.body)
-        with self._scope.start_reference():
-            self.visit(node.orelse)
-
-    def visit_Attribute(self, node, chain=False):
+        with self.start_definition():
+            yield node.target
+        with self.start_reference():
+            yield node.iter
+        with self.start_reference():
+            yield node.body
+        with self.start_reference():
+            yield node.orelse
+
+    def visit_Attribute(self, node):
+        # a.b.c is Attribute(Attribute(Name(a), b), c); walk down to the
+        # innermost attribute first.
+        outer = []
+        while isinstance(node.value, ast.Attribute):
+            outer.append(node.attr)
+            node = node.value
         if isinstance(node.value, ast.Name):
-            self._scope.extend_symbol(node.value.id)
-            self._scope.extend_symbol(node.attr)
-            if not chain:
-                self._scope.end_symbol()
-        elif isinstance(node.value, ast.Attribute):
-            self.visit_Attribute(node.value, chain=True)
-            self._scope.extend_symbol(node.attr, extend_only=True)
+            self.extend_symbol(node.value.id)
+            self.extend_symbol(node.attr)
+            if not outer:
+                self.end_symbol()
         else:
-            self._scope.end_symbol()
-            self.visit(node.value)
-            self._scope.end_symbol()
+            self.end_symbol()
+            yield node.value
+            self.end_symbol()
+        for attr in reversed(outer):
+            self.extend_symbol(attr, extend_only=True)
 
     def visit_Subscript(self, node):
-        self._scope.end_symbol()
-        with self._scope.start_reference():
-            self.visit(node.value)
-        self.visit(node.slice)
+        self.end_symbol()
+        with self.start_reference():
+            yield node.value
+        yield node.slice
 
     def visit_Call(self, node):
-        with self._scope.start_reference():
-            self.visit(node.func)
+        with self.start_reference('call'):
+            yield node.func
         # Python 3.5 AST removed starargs and kwargs
         additional = []
         if getattr(node, 'starargs', None):
@@ -392,12 +720,12 @@ class UnknownSymbolVisitor(ast.NodeVisitor):
         if getattr(node, 'kwargs', None):
             additional.append(node.kwargs)
         for arg in chain(node.args, node.keywords, additional):
-            with self._scope.start_reference():
-                self.visit(arg)
+            with self.start_reference():
+                yield arg
 
     def visit_Name(self, node):
-        self._scope.extend_symbol(node.id)
-        self._scope.end_symbol()
+        self.extend_symbol(node.id)
+        self.end_symbol()
 
 
 if __name__ == '__main__':
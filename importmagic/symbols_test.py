@@ -3,7 +3,7 @@ from textwrap import dedent
 
 import pytest
 from importmagic.six import u
-from importmagic.symbols import Scope, _symbol_series
+from importmagic.symbols import IncrementalScope, Scope, _symbol_series
 
 
 def test_parser_symbol_in_global_function():
@@ -286,6 +286,91 @@ def test_annotations_from_typing():
     assert unresolved == set(['List'])
     assert unreferenced == set(['Tuple', 'Dict'])
 
+def test_reference_contexts():
+    src = dedent("""
+        class A(Base, mod.Mixin):
+            def f(self):
+                try:
+                    return make(os.path.join(a), Base)
+                except (Error, socket.timeout):
+                    raise Bad(1)
+        """)
+    scope = Scope.from_source(src)
+    contexts = scope.reference_contexts()
+    assert contexts['Base'] == set(['base', None])
+    assert contexts['mod.Mixin'] == set(['base'])
+    assert contexts['make'] == set(['call'])
+    assert contexts['os.path.join'] == set(['call'])
+    assert contexts['a'] == set([None])
+    assert contexts['Error'] == contexts['socket.timeout'] == set(['except'])
+    assert contexts['Bad'] == set(['call'])
+
+def _definitions(scope):
+    # Builtins are not stored in scopes.
+    return scope._definitions | (Scope.ALL_BUILTINS if scope._define_builtins else set())
+
+
+def _resolve_by_unions(scope, definitions, definitions_excluding_top, unresolved,
+                       unreferenced, top, start=False):
+    # The original resolution, which builds the visible definitions for each scope.
+    scope_definitions = definitions | _definitions(scope)
+    scope_definitions_excluding_top = definitions_excluding_top | \
+        (set() if start else _definitions(scope))
+    if not scope._is_class:
+        definitions = scope_definitions
+        definitions_excluding_top = scope_definitions_excluding_top
+    for reference in scope._references:
+        symbols = set(_symbol_series(reference))
+        if symbols.isdisjoint(scope_definitions):
+            unresolved.add(reference)
+        elif not symbols.isdisjoint(top) and symbols.isdisjoint(scope_definitions_excluding_top):
+            unreferenced -= symbols
+    for child in scope._children:
+        _resolve_by_unions(child, definitions, definitions_excluding_top, unresolved,
+                           unreferenced, top)
+
+
+@pytest.mark.parametrize('define_builtins', [True, False])
+def test_resolution_matches_set_unions(define_builtins):
+    src = dedent("""
+        import os
+        from collections import defaultdict as dd
+        top = 1
+        shadowed = 2
+        unused = 3
+
+        class Outer(Base):
+            attr = top
+            shadowed = attr
+
+            def method(self):
+                return attr, shadowed, os.path.join(self.x), len(dd)
+
+            class Inner(object):
+                inner_attr = Outer.attr
+
+                def deep(self, top):
+                    def deeper(arg=inner_attr):
+                        shadowed = top
+                        return [shadowed for x in range(top) if x.y.z], unknown.attr
+                    return deeper
+
+        def func(a, *args, **kwargs):
+            local = a.b.c
+            with open(local) as fd:
+                try:
+                    return lambda q: q + fd + missing
+                except (ValueError, errors.Error) as e:
+                    return e, unused_in_func
+        """)
+    scope = Scope.from_source(src, define_builtins=define_builtins)
+    for start in [scope] + scope._children + scope._children[0]._children:
+        unresolved, unreferenced = set(), _definitions(start)
+        _resolve_by_unions(start, set(), set(), unresolved, unreferenced,
+                           frozenset(_definitions(start)), start=True)
+        assert start.find_unresolved_and_unreferenced_symbols() == (
+            unresolved, unreferenced - Scope.ALL_BUILTINS)
+
 class TestSymbolCollection(object):
     def _collect(self, src, include_unreferenced=False):
         scope = Scope.from_source(src)
@@ -347,3 +432,64 @@ class TestSymbolCollection(object):
 
     def test_multiple_attributes(self):
         assert self._collect('a.c == b.d') == set(['a.c', 'b.d'])
+
+
+def test_deeply_nested_expression():
+    # Deeper than the recursion limit allows a recursive visitor to go.
+    names = ['a%d' % i for i in range(2000)]
+    scope = Scope.from_source('x = ' + ' + '.join(names))
+    unresolved, unreferenced = scope.find_unresolved_and_unreferenced_symbols()
+    assert unresolved == set(names)
+    assert unreferenced == set(['x'])
+
+
+def test_incremental_scope_matches_from_source():
+    src = dedent("""
+        import os
+        from sys import path
+
+
+        @decorator
+        def f(a, b=default):
+            return os.path.join(a, b, missing)
+
+
+        class A(Base):
+            def g(self):
+                return f(1); x = 2
+        """)
+    edits = [
+        ('missing', 'path'),
+        ('class A(Base):', 'class A(Base, Mixin):'),
+        ('import os\n', ''),
+        ('return f(1); x = 2', 'return (f(1) +\n                        other)'),
+        ('\n\nclass', 'unused = 1\n\n\nclass'),
+    ]
+    scope = IncrementalScope(src)
+    for old, new in edits:
+        src = src.replace(old, new)
+        scope.update(src)
+        expected = Scope.from_source(src)
+        assert scope.find_unresolved_and_unreferenced_symbols() == \
+            expected.find_unresolved_and_unreferenced_symbols()
+        assert scope.reference_contexts() == expected.reference_contexts()
+
+
+def test_incremental_scope_reparses_changed_statements(monkeypatch):
+    src = ''.join('def f%d():\n    return g%d()\n\n' % (i, i) for i in range(20))
+    scope = IncrementalScope(src)
+    summarised = []
+    original = IncrementalScope._summarise
+    monkeypatch.setattr(IncrementalScope, '_summarise',
+                        lambda self, nodes: summarised.append(nodes) or original(self, nodes))
+    scope.update(src.replace('return g7()', 'return h7()'))
+    assert len(summarised) == 1
+    assert 'h7' in scope.find_unresolved_and_unreferenced_symbols()[0]
+
+
+def test_incremental_scope_syntax_error_keeps_previous_source():
+    scope = IncrementalScope('a = 1\nb = (a\n)\n')
+    with pytest.raises(SyntaxError):
+        scope.update('a = 1\nb = (a\n\n')
+    scope.update('a = 1\nb = (c\n)\n')
+    assert scope.find_unresolved_and_unreferenced_symbols() == (set(['c']), set(['a', 'b']))
@@ -1,12 +1,22 @@
 import ast
+import base64
+import math
 import os
 import re
 import sys
+import zlib
 from sys import platform
 from ast import AST, iter_fields
 
 from importmagic.six import text_type
 
+try:
+    from ConfigParser import ConfigParser
+except ImportError:
+    from configparser import ConfigParser
+
+
+PROJECT_CONFIG_FILE = 'setup.cfg'
 
 CODING_COOKIE_RE = re.compile('(^\s*#.*)coding[:=]', re.M)
 
@@ -71,3 +81,103 @@ def get_cache_dir():
         os.makedirs(cache_dir)
 
     return cache_dir
+
+
+def get_project_config(root_dir):
+    """Return the options of the [importmagic] section of the project config file.
+
+    :returns: A dict of option name to string value, empty if there is no such section.
+    """
+    config = ConfigParser()
+    config.read(os.path.join(root_dir, PROJECT_CONFIG_FILE))
+    if not config.has_section('importmagic'):
+        return {}
+    return dict(config.items('importmagic'))
+
+
+def edit_distance(a, b, limit):
+    """Return the Levenshtein distance between a and b, or limit + 1 if it is more than limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    # Common prefixes and suffixes don't change the distance.
+    start, end_a, end_b = 0, len(a), len(b)
+    while start < end_a and start < end_b and a[start] == b[start]:
+        start += 1
+    while end_a > start and end_b > start and a[end_a - 1] == b[end_b - 1]:
+        end_a -= 1
+        end_b -= 1
+    a, b = a[start:end_a], b[start:end_b]
+    if len(a) > len(b):
+        a, b = b, a
+    # Only cells within limit of the diagonal can be within limit.
+    too_far = limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        lo, hi = max(1, i - limit), min(len(b), i + limit)
+        current = [too_far] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        best = current[0]
+        for j in range(lo, hi + 1):
+            cost = previous[j - 1] + (ca != b[j - 1])
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            current[j] = cost
+            if cost < best:
+                best = cost
+        if best > limit:
+            return too_far
+        previous = current
+    return min(previous[len(b)], too_far)
+
+
+class BloomFilter(object):
+    """A set of strings that may report false positives, but never false negatives.
+
+    :param capacity: The number of strings expected to be added.
+    :param error_rate: The false positive rate at that capacity.
+    """
+
+    def __init__(self, capacity=1000, error_rate=0.01, bits=None, hashes=None):
+        capacity = max(capacity, 1)
+        self.bits = bits or max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = hashes or max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self._array = bytearray((self.bits + 7) // 8)
+
+    @classmethod
+    def from_strings(cls, strings, error_rate=0.01):
+        strings = list(strings)
+        bloom = cls(len(strings), error_rate)
+        for string in strings:
+            bloom.add(string)
+        return bloom
+
+    def _positions(self, string):
+        # Double hashing, see Kirsch & Mitzenmacher, "Less Hashing, Same
+        # Performance: Building a Better Bloom Filter".
+        data = string.encode('utf-8')
+        h1 = zlib.crc32(data) & 0xffffffff
+        h2 = zlib.adler32(data) | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, string):
+        for position in self._positions(string):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, string):
+        array = self._array
+        return all(array[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(string))
+
+    def dumps(self):
+        """Return the filter as a JSON-compatible dict."""
+        return {'bits': self.bits, 'hashes': self.hashes,
+                'array': base64.b64encode(bytes(self._array)).decode('ascii')}
+
+    @classmethod
+    def loads(cls, data):
+        bloom = cls(bits=data['bits'], hashes=data['hashes'])
+        bloom._array = bytearray(base64.b64decode(data['array']))
+        return bloom
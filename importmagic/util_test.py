@@ -0,0 +1,26 @@
+from importmagic.util import BloomFilter, edit_distance
+
+
+def test_bloom_filter():
+    names = ['name%d' % i for i in range(2000)]
+    bloom = BloomFilter.from_strings(names, error_rate=0.01)
+    assert all(name in bloom for name in names)
+    false_positives = sum('other%d' % i in bloom for i in range(2000))
+    assert false_positives < 100
+
+    loaded = BloomFilter.loads(bloom.dumps())
+    assert (loaded.bits, loaded.hashes) == (bloom.bits, bloom.hashes)
+    assert all(name in loaded for name in names)
+    assert 'unknown' not in BloomFilter.from_strings([])
+
+
+def test_edit_distance():
+    assert edit_distance('defaultdict', 'defaultdict', 2) == 0
+    assert edit_distance('defualtdict', 'defaultdict', 2) == 2
+    assert edit_distance('OrderDict', 'OrderedDict', 2) == 2
+    assert edit_distance('basenme', 'basename', 2) == 1
+    assert edit_distance('kitten', 'sitting', 3) == 3
+    # Beyond the limit, the exact distance isn't computed.
+    assert edit_distance('kitten', 'sitting', 2) == 3
+    assert edit_distance('a', 'abcd', 1) == 2
+    assert edit_distance('', '', 0) == 0
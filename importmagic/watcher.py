@@ -0,0 +1,232 @@
+"""Keep a SymbolIndex up to date while modules under its roots change."""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Directories that are never watched.
+IGNORED_DIRS = ('__pycache__',)
+
+# inotify(7) constants.
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ISDIR = 0x40000000
+_IN_WATCH_MASK = (_IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+                  _IN_CREATE | _IN_DELETE)
+_IN_EVENT = struct.Struct('iIII')
+
+
+def _watched_dirs(root):
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.') and d not in IGNORED_DIRS]
+        yield dirpath
+
+
+class _InotifySource(object):
+    """Change notifications from Linux inotify, via ctypes."""
+
+    def __init__(self, roots):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._roots = roots
+        self._dirs = {}
+        for root in roots:
+            self._watch_tree(root)
+
+    def _watch_tree(self, root):
+        for path in _watched_dirs(root):
+            wd = self._add_watch(self._fd, os.fsencode(path), _IN_WATCH_MASK)
+            if wd < 0:
+                logger.debug('failed to watch %s: %s', path, os.strerror(ctypes.get_errno()))
+                continue
+            self._dirs[wd] = path
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds and return the paths that changed."""
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                logger.debug('inotify queue overflowed, rescanning roots')
+                changed.extend(_top_level_paths(self._roots))
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO) and os.path.isdir(path):
+                    self._watch_tree(path)
+                changed.append(path)
+            elif name.endswith('.py'):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _PollingSource(object):
+    """Change notifications from periodically comparing modification times."""
+
+    def __init__(self, roots, interval):
+        self._roots = roots
+        self._interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for root in self._roots:
+            for dirpath in _watched_dirs(root):
+                try:
+                    filenames = os.listdir(dirpath)
+                except OSError:
+                    continue
+                snapshot[dirpath] = None
+                for filename in filenames:
+                    if filename.endswith('.py'):
+                        path = os.path.join(dirpath, filename)
+                        try:
+                            snapshot[path] = os.stat(path).st_mtime_ns
+                        except OSError:
+                            pass
+        return snapshot
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self._interval))
+        snapshot = self._scan()
+        old = self._snapshot
+        self._snapshot = snapshot
+        return [path for path in set(old) | set(snapshot) if old.get(path, 0) != snapshot.get(path, 0)]
+
+    def close(self):
+        pass
+
+
+def _top_level_paths(roots):
+    for root in roots:
+        for filename in os.listdir(root):
+            yield os.path.join(root, filename)
+
+
+class IndexWatcher(object):
+    """Watch indexed roots and patch the index when modules change.
+
+    Changes are debounced: once no new change has been seen for debounce
+    seconds, each affected module or package is re-indexed with
+    SymbolIndex.update_path().
+
+    :param index: The SymbolIndex to update.
+    :param roots: Indexed roots to watch, eg. the project directory.
+    :param use_inotify: Use inotify if True, polling if False, and inotify
+        where available if None.
+    :param callback: Called with the list of updated paths after each update.
+    """
+
+    def __init__(self, index, roots, debounce=0.1, poll_interval=0.5,
+                 use_inotify=None, callback=None):
+        self._index = index
+        self._roots = sorted((os.path.abspath(r or '.') for r in roots), key=len, reverse=True)
+        self._debounce = debounce
+        self._poll_interval = poll_interval
+        self._use_inotify = use_inotify
+        self._callback = callback
+        self._source = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._use_inotify is not False and sys.platform.startswith('linux'):
+            try:
+                self._source = _InotifySource(self._roots)
+            except (AttributeError, OSError) as e:
+                if self._use_inotify:
+                    raise
+                logger.debug('inotify unavailable, polling instead: %s', e)
+        if self._source is None:
+            self._source = _PollingSource(self._roots, self._poll_interval)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='importmagic-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        changed = set()
+        last_change = 0.0
+        while not self._stopped.is_set():
+            timeout = self._debounce if changed else self._poll_interval
+            paths = self._source.wait(timeout)
+            if paths:
+                changed.update(paths)
+                last_change = time.monotonic()
+            elif changed and time.monotonic() - last_change >= self._debounce:
+                self._apply(sorted(changed))
+                changed.clear()
+
+    def _apply(self, paths):
+        updated = []
+        for path in paths:
+            root = self._root_for(path)
+            try:
+                if root is not None and self._index.update_path(root, path):
+                    updated.append(path)
+            except Exception:
+                logger.exception('failed to update index for %s', path)
+        if updated:
+            logger.debug('updated index for %s', ', '.join(updated))
+            if self._callback is not None:
+                self._callback(updated)
+
+    def _root_for(self, path):
+        for root in self._roots:
+            if path.startswith(root + os.path.sep):
+                return root
+        return None
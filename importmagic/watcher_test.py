@@ -0,0 +1,116 @@
+import re
+import sys
+import threading
+import time
+
+import pytest
+
+from importmagic.index import SymbolIndex
+from importmagic.watcher import IndexWatcher
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_update_path(tmpdir):
+    pkg = tmpdir.mkdir('pkg')
+    pkg.join('__init__.py').write('class Cls:\n pass\n')
+    tree = SymbolIndex(blacklist_re=re.compile('mytest_'))
+    tree.build_index([str(tmpdir)])
+    root = str(tmpdir)
+
+    mod = pkg.join('mod.py')
+    mod.write('def func():\n pass\n')
+    assert tree.update_path(root, str(mod))
+    assert tree.symbol_scores('func')[0][1:] == ('pkg.mod', 'func')
+
+    pkg.join('__init__.py').write('class Other:\n pass\n')
+    assert tree.update_path(root, str(pkg.join('__init__.py')))
+    assert tree.find('pkg.mod') is not None
+    assert 'Cls' not in tree.find('pkg')._tree
+    assert 'Other' in tree.find('pkg')._tree
+
+    mod.remove()
+    assert tree.update_path(root, str(mod))
+    assert tree.find('pkg.mod') is None
+
+    newpkg = tmpdir.mkdir('newpkg')
+    newpkg.join('__init__.py').write('')
+    newpkg.join('sub.py').write('def subfunc():\n pass\n')
+    assert tree.update_path(root, str(newpkg.join('sub.py')))
+    assert tree.find('newpkg.sub') is not None
+
+    assert not tree.update_path(root, str(tmpdir.join('_private.py')))
+    assert not tree.update_path(root, str(tmpdir.join('data.txt')))
+
+
+def test_update_path_while_queried(tmpdir):
+    pkg = tmpdir.mkdir('pkg')
+    pkg.join('__init__.py').write('')
+    source = ''.join('def helper%d():\n pass\n' % i for i in range(20)) + 'def helper():\n pass\n'
+    for i in range(20):
+        pkg.join('mod%d.py' % i).write(source)
+    tree = SymbolIndex(blacklist_re=re.compile('mytest_'))
+    tree.build_index([str(tmpdir)], builtins=False)
+    root = str(tmpdir)
+    stopped = threading.Event()
+    errors = []
+
+    def query():
+        while not stopped.is_set():
+            try:
+                tree.symbol_scores('helper')
+                tree.symbol_scores('mod3.helper1')
+                tree.complete('hel')
+                tree.fuzzy('helpr')
+                tree.find('pkg.mod3')
+            except Exception as e:
+                errors.append(e)
+
+    # Switch threads often, to interleave queries and updates.
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    thread = threading.Thread(target=query)
+    thread.start()
+    try:
+        for n in range(1000):
+            mod = pkg.join('mod%d.py' % (n % 20))
+            if n // 20 % 2:
+                mod.write(source)
+            else:
+                mod.remove()
+            tree.update_path(root, str(mod))
+    finally:
+        stopped.set()
+        thread.join()
+        sys.setswitchinterval(interval)
+    assert not errors
+
+
+@pytest.mark.parametrize('use_inotify', [False, None])
+def test_watcher_picks_up_new_functions(tmpdir, use_inotify):
+    root = tmpdir.mkdir('root')
+    root.join('existing.py').write('def old_func():\n pass\n')
+    tree = SymbolIndex(blacklist_re=re.compile('mytest_'))
+    tree.build_index([str(root)])
+
+    def resolves(symbol, module):
+        scores = tree.symbol_scores(symbol)
+        return bool(scores) and scores[0][1:] == (module, symbol)
+
+    watcher = IndexWatcher(tree, [str(root)], debounce=0.05, poll_interval=0.1,
+                           use_inotify=use_inotify)
+    with watcher:
+        root.join('existing.py').write('def old_func():\n pass\n\ndef new_func():\n pass\n')
+        root.join('created.py').write('def created_func():\n pass\n')
+        assert wait_for(lambda: resolves('new_func', 'existing'), timeout=1.0)
+        assert wait_for(lambda: resolves('created_func', 'created'), timeout=1.0)
+
+        root.join('created.py').remove()
+        assert wait_for(lambda: tree.find('created') is None, timeout=1.0)